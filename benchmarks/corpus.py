@@ -0,0 +1,153 @@
+import os
+import random
+import docx
+
+# Synthetic, deterministic inputs for the benchmarks: project documents
+# (PDF and DOCX) and a PDD template with a contents list, headings,
+# placeholder paragraphs and tables, shaped like the real ones.
+
+_WORDS = """
+project site location capacity installed solar wind hydro biomass megawatt MW tonnes CO2e emission reduction
+baseline scenario monitoring plan stakeholder consultation community village district province grid connection
+proponent company limited contact address telephone email validation verification crediting period start date
+technology turbine panel inverter transmission substation land lease environmental impact assessment gender
+poverty social analysis funding proposal budget financing loan grant safeguards no net harm additionality
+""".split()
+
+# Sizes used by run_benchmarks.py: (documents, pages per PDF, template sections)
+SIZES = {
+    "small": (2, 5, 6),
+    "medium": (4, 25, 15),
+    "large": (8, 60, 30),
+}
+
+
+def _sentence(rng, words=14):
+    return " ".join(rng.choice(_WORDS) for _ in range(words)).capitalize() + "."
+
+
+def _pdf_escape(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def _page_stream(rng, page_number, with_table):
+    """PDF content stream for one page: ~40 lines of text and, optionally, a ruled 3x4 table."""
+    ops = ["BT", "/F1 9 Tf", "11 TL", "50 800 Td"]
+    for _ in range(40 if not with_table else 24):
+        ops.append(f"({_pdf_escape(_sentence(rng, 12))}) Tj T*")
+    ops.append(f"(Page {page_number}) Tj")
+    ops.append("ET")
+    if with_table:
+        # Ruled grid (what pdfplumber's table finder looks for) with one word per cell
+        left, top, col_w, row_h, cols, rows = 50, 500, 160, 20, 3, 4
+        for r in range(rows + 1):
+            ops.append(f"{left} {top - r * row_h} m {left + cols * col_w} {top - r * row_h} l S")
+        for c in range(cols + 1):
+            ops.append(f"{left + c * col_w} {top} m {left + c * col_w} {top - rows * row_h} l S")
+        for r in range(rows):
+            for c in range(cols):
+                ops.append(f"BT /F1 9 Tf {left + c * col_w + 4} {top - (r + 1) * row_h + 6} Td "
+                           f"({_pdf_escape(rng.choice(_WORDS))}) Tj ET")
+    return "\n".join(ops).encode('latin-1')
+
+
+def write_pdf(path, pages, seed=0):
+    """Writes a minimal multi-page PDF (Helvetica text, some ruled tables) without any PDF library."""
+    rng = random.Random(seed)
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    page_ids = []
+    for page_number in range(1, pages + 1):
+        stream = _page_stream(rng, page_number, with_table=page_number % 4 == 0)
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >> "
+                       b"/Contents %d 0 R >>" % len(objects))
+        page_ids.append(len(objects))
+    kids = " ".join(f"{i} 0 R" for i in page_ids).encode()
+    objects[1] = b"<< /Type /Pages /Kids [" + kids + b"] /Count %d >>" % len(page_ids)
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    with open(path, 'wb') as f:
+        f.write(out)
+
+
+def write_docx(path, paragraphs, seed=0):
+    """Writes a .docx of body paragraphs plus one key/value table."""
+    rng = random.Random(seed)
+    document = docx.Document()
+    for _ in range(paragraphs):
+        document.add_paragraph(" ".join(_sentence(rng) for _ in range(4)))
+    table = document.add_table(rows=5, cols=2)
+    for r in range(5):
+        table.cell(r, 0).text = rng.choice(_WORDS).capitalize()
+        table.cell(r, 1).text = _sentence(rng, 5)
+    document.save(path)
+
+
+def write_rulebook(path, clauses, seed=0):
+    """Writes a methodology-style .docx of numbered clauses ("1 Title", "1.1 Title") with body text."""
+    rng = random.Random(seed)
+    document = docx.Document()
+    document.add_paragraph("METHODOLOGY RULEBOOK")
+    for i in range(clauses):
+        for j, number in enumerate((f"{i + 1}", f"{i + 1}.1", f"{i + 1}.2")):
+            document.add_paragraph(f"{number} {' '.join(rng.sample(_WORDS, 3 if j else 2)).title()}")
+            document.add_paragraph(" ".join(_sentence(rng) for _ in range(4)))
+    document.save(path)
+
+
+def make_corpus(folder, documents, pages_per_pdf, seed=0):
+    """Fills folder with documents (alternating PDF and DOCX). Returns the total page count."""
+    os.makedirs(folder, exist_ok=True)
+    pages = 0
+    for i in range(documents):
+        if i % 2 == 0:
+            write_pdf(os.path.join(folder, f"document_{i:02d}.pdf"), pages_per_pdf, seed + i)
+            pages += pages_per_pdf
+        else:
+            write_docx(os.path.join(folder, f"document_{i:02d}.docx"), pages_per_pdf * 4, seed + i)
+            pages += 1
+    return pages
+
+
+def section_titles(sections):
+    return [f"Section {i + 1} {' '.join(random.Random(i).sample(_WORDS, 3)).title()}" for i in range(sections)]
+
+
+def make_template(path, sections, seed=0):
+    """
+    Writes a PDD-style template: a contents list ("1.k Title page"), then
+    a heading, an instruction with [placeholders] and, for every other
+    section, a table per section, ending with an Appendix.
+    """
+    rng = random.Random(seed)
+    titles = section_titles(sections)
+    document = docx.Document()
+    document.add_paragraph("PROJECT DESCRIPTION TEMPLATE")
+    document.add_paragraph("Contents")
+    document.add_paragraph("1 Project Details 4")
+    for i, title in enumerate(titles):
+        document.add_paragraph(f"1.{i + 1} {title} {5 + i}")
+    document.add_paragraph("Appendix 1 99")
+
+    document.add_heading("Project Details", level=1)
+    for i, title in enumerate(titles):
+        document.add_heading(title, level=2)
+        document.add_paragraph(f"Describe the {rng.choice(_WORDS)} of the project, including "
+                               f"[{rng.choice(_WORDS)} {rng.choice(_WORDS)}] and [{rng.choice(_WORDS)}].")
+        if i % 2 == 0:
+            table = document.add_table(rows=4, cols=2)
+            for r in range(4):
+                table.cell(r, 0).text = rng.choice(_WORDS).capitalize()
+                table.cell(r, 1).text = f"[{rng.choice(_WORDS)}]"
+    document.add_heading("Appendix", level=1)
+    document.add_paragraph("Appendix text.")
+    document.save(path)
+    return titles
@@ -0,0 +1,302 @@
+import re
+import time
+import hashlib
+import datetime
+import threading
+
+# Local, deterministic stand-ins for the Gemini and llama.cpp models, so the
+# pipeline can be run and timed without an API key or a GPU. They replace
+# the model object, not ask_gemini()/ask_llama(), so the prompt assembly,
+# response cache and instrumentation around the call are exercised as usual.
+# FakeGeminiBackend likewise stands in for the file upload and cached-content
+# endpoints behind GeminiRegistry.
+#
+# Modes:
+#   "echo"   - returns the template part of the prompt with every
+#              [placeholder] filled in (a valid, fully completed section).
+#   "canned" - always returns the same fixed text.
+
+_PLACEHOLDER_RE = re.compile(r"\[([^\]]*)\]")
+_FIELD_LINE_RE = re.compile(r"^(\d+)\. ", re.M)
+_PACKED_RE = re.compile(r"^<<<SECTION (\d+)>>>\n(.*?)\n<<<END SECTION \1>>>$", re.M | re.S)
+# Streamed responses come in chunks of this many characters.
+STREAM_CHUNK_CHARS = 64
+
+
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+
+def fake_completion(prompt, mode="echo", canned_text="INFO_NOT_FOUND: everything"):
+    """The text a fake model answers to prompt."""
+    if mode == "canned":
+        return canned_text
+    if "these fields were not found" in prompt:
+        # Field refill: one numbered answer per field
+        fields = _FIELD_LINE_RE.findall(prompt.split("New documents")[0])
+        return "\n".join(f"{n}: synthetic value {n}" for n in fields)
+    if "FIELDS TO ANSWER:" in prompt:
+        # Field schema request: one numbered answer per field
+        fields = _FIELD_LINE_RE.findall(prompt.split("FIELDS TO ANSWER:")[1].split("THE TEMPLATE, FOR CONTEXT:")[0])
+        return "\n".join(f"{n}: synthetic value {n}" for n in fields)
+    template = prompt.split("TEMPLATE TO FILL:\n")[-1] if "TEMPLATE TO FILL:" in prompt else prompt.split("USER QUERY:\n")[-1]
+    sections = _PACKED_RE.findall(template)
+    if sections:
+        # Packed request: every section filled, between its delimiters
+        return "\n\n".join(f"<<<SECTION {n}>>>\n{_fill_template(section)}\n<<<END SECTION {n}>>>" for n, section in sections)
+    return _fill_template(template)
+
+
+def _fill_template(template):
+    # Drop the section heading line, as a model following the system prompt does
+    body = template.split("\n", 1)[1] if "\n" in template else template
+    return _PLACEHOLDER_RE.sub(lambda m: f"synthetic {m.group(1)}".strip(), body)
+
+
+class _Usage:
+    def __init__(self, prompt_token_count, candidates_token_count, cached_content_token_count=0):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+        self.cached_content_token_count = cached_content_token_count
+
+
+class _Response:
+    def __init__(self, text, usage_metadata):
+        self.text = text
+        self.usage_metadata = usage_metadata
+
+
+class _Chunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class _StreamedResponse(_Response):
+    """A stream=True response: iterating it yields the text in chunks, spread over the latency."""
+
+    def __init__(self, text, usage_metadata, latency=0.0):
+        super().__init__(text, usage_metadata)
+        self.latency = latency
+
+    def __iter__(self):
+        starts = range(0, len(self.text), STREAM_CHUNK_CHARS)
+        for start in starts:
+            if self.latency:
+                time.sleep(self.latency / len(starts))
+            yield _Chunk(self.text[start:start + STREAM_CHUNK_CHARS])
+
+
+class FakeGeminiAgent:
+    """
+    Drop-in for the genai.GenerativeModel returned by setup_gemini().
+
+    Args:
+        latency (float): Seconds each generate_content() call takes.
+        mode (str): "echo" or "canned" (see above).
+    """
+
+    def __init__(self, latency=0.0, mode="echo", canned_text="INFO_NOT_FOUND: everything", model_name="fake-gemini"):
+        self.latency = latency
+        self.mode = mode
+        self.canned_text = canned_text
+        self.model_name = model_name
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def generate_content(self, content, stream=False):
+        with self._lock:
+            self.calls += 1
+        prompt = content[0]
+        text = fake_completion(prompt, self.mode, self.canned_text)
+        usage = _Usage(estimate_tokens(prompt), estimate_tokens(text))
+        if stream:
+            return _StreamedResponse(text, usage, self.latency)
+        if self.latency:
+            time.sleep(self.latency)
+        return _Response(text, usage)
+
+
+class _FakeFile:
+    def __init__(self, name, sha256_hash, expiration_time):
+        self.name = name
+        self.sha256_hash = sha256_hash
+        self.expiration_time = expiration_time
+
+
+class NotFound(Exception):
+    """Named like the API's google.api_core.exceptions.NotFound, which ask_gemini() recognises."""
+
+
+class _FakeCachedModel:
+    """A model bound to fake cached content: rebuilds the full request and asks the agent."""
+
+    def __init__(self, backend, name, system_instruction, files):
+        self.backend = backend
+        self.name = name
+        self.agent = backend.agent
+        self.model_name = backend.agent.model_name
+        self.system_instruction = system_instruction
+        self.files = files
+
+    def generate_content(self, content, stream=False):
+        self.backend.cached_model(self.name)  # raises NotFound if the cache has gone
+        complete_prompt = f"SYSTEM INSTRUCTIONS:\n{self.system_instruction}\n\nUSER QUERY:\n{content[0]}"
+        response = self.agent.generate_content([complete_prompt] + list(self.files), stream=stream)
+        cached_tokens = estimate_tokens(self.system_instruction)
+        response.usage_metadata = _Usage(estimate_tokens(content[0]) + cached_tokens,
+                                         response.usage_metadata.candidates_token_count, cached_tokens)
+        return response
+
+
+class FakeGeminiBackend:
+    """
+    Local stand-in for the Gemini Files and cachedContents endpoints, as
+    used by GeminiRegistry (see GenaiBackend in gemini_registry.py).
+
+    Files and caches live in memory and expire on the backend's clock;
+    uploads/caches_created count the calls that would cost bandwidth or
+    storage. delete_file()/delete_cache() simulate the server dropping
+    something early.
+
+    Args:
+        agent (FakeGeminiAgent): Answers requests to cached-content models.
+        min_cache_tokens (int): Smaller cached content is refused, as the API does.
+        clock: Returns the current time in epoch seconds.
+    """
+
+    def __init__(self, agent=None, file_ttl_s=48 * 3600, min_cache_tokens=1024, clock=time.time):
+        self.agent = agent or FakeGeminiAgent()
+        self.file_ttl_s = file_ttl_s
+        self.min_cache_tokens = min_cache_tokens
+        self.clock = clock
+        self.files = {}
+        self.caches = {}
+        self.uploads = 0
+        self.caches_created = 0
+
+    def _expiry(self, ttl_s):
+        return datetime.datetime.fromtimestamp(self.clock() + ttl_s)
+
+    def upload(self, file_path):
+        with open(file_path, 'rb') as f:
+            data = f.read()
+        self.uploads += 1
+        handle = _FakeFile(f"files/fake-{self.uploads}", hashlib.sha256(data).hexdigest(), self._expiry(self.file_ttl_s))
+        self.files[handle.name] = handle
+        return handle, handle.expiration_time.timestamp()
+
+    def get_file(self, name):
+        handle = self.files.get(name)
+        if handle is None or handle.expiration_time.timestamp() <= self.clock():
+            raise NotFound(f"File {name} not found")
+        return handle
+
+    def delete_file(self, name):
+        self.files.pop(name, None)
+
+    def create_cache(self, model_name, system_instruction, files, ttl_s):
+        tokens = estimate_tokens(system_instruction) + sum(1000 for _ in files)
+        if tokens < self.min_cache_tokens:
+            raise ValueError(f"Cached content is too small: {tokens} < {self.min_cache_tokens} tokens")
+        self.caches_created += 1
+        name = f"cachedContents/fake-{self.caches_created}"
+        self.caches[name] = (system_instruction, list(files), self.clock() + ttl_s)
+        return name, self.caches[name][2]
+
+    def cached_model(self, name):
+        if name not in self.caches or self.caches[name][2] <= self.clock():
+            raise NotFound(f"Cached content {name} not found")
+        system_instruction, files, _ = self.caches[name]
+        return _FakeCachedModel(self, name, system_instruction, files)
+
+    def delete_cache(self, name):
+        self.caches.pop(name, None)
+
+
+class FakeLlama:
+    """
+    Drop-in for the llama_cpp.Llama returned by setup_llama(), for ask_llama()
+    with or without a PrefixStateCache.
+
+    Tokens are characters. The model keeps the ids it has "evaluated" like
+    llama.cpp's KV cache does: a completion only pays for the tokens past the
+    longest prefix it shares with them, and save_state()/load_state() snapshot
+    and restore them. evaluated_tokens counts the tokens actually evaluated.
+
+    Args:
+        latency (float): Seconds each completion call takes.
+        mode (str): "echo" or "canned" (see above).
+        token_latency (float): Seconds per evaluated prompt token.
+    """
+
+    def __init__(self, latency=0.0, mode="echo", canned_text="INFO_NOT_FOUND: everything", model_path="fake-llama.gguf",
+                 token_latency=0.0):
+        self.latency = latency
+        self.mode = mode
+        self.canned_text = canned_text
+        self.model_path = model_path
+        self.token_latency = token_latency
+        self.calls = 0
+        self.evaluated_tokens = 0
+        self._input_ids = []
+
+    def n_ctx(self):
+        return 10000
+
+    def tokenize(self, text, add_bos=True, special=False):
+        return ([0] if add_bos else []) + [ord(c) for c in text.decode('utf-8')]
+
+    def reset(self):
+        self._input_ids = []
+
+    def eval(self, tokens):
+        self.evaluated_tokens += len(tokens)
+        if self.token_latency:
+            time.sleep(self.token_latency * len(tokens))
+        self._input_ids = self._input_ids + list(tokens)
+
+    def save_state(self):
+        return list(self._input_ids)
+
+    def load_state(self, state):
+        self._input_ids = list(state)
+
+    def _stream(self, text, chunk):
+        """Yields text in llama.cpp-style streamed chunks, built by chunk(piece)."""
+        for start in range(0, len(text), STREAM_CHUNK_CHARS):
+            yield {"choices": [chunk(text[start:start + STREAM_CHUNK_CHARS])]}
+
+    def create_completion(self, prompt, max_tokens=None, stop=None, stream=False):
+        self.calls += 1
+        shared = 0
+        for a, b in zip(self._input_ids, prompt[:-1]):
+            if a != b:
+                break
+            shared += 1
+        self._input_ids = self._input_ids[:shared]
+        self.eval(prompt[shared:])
+        text_prompt = "".join(chr(t) for t in prompt if t)
+        if self.latency:
+            time.sleep(self.latency)
+        user_turn = text_prompt.split("<|im_start|>user\n")[-1].split("<|im_end|>")[0]
+        text = fake_completion(user_turn, self.mode, self.canned_text)
+        if stream:
+            return self._stream(text, lambda piece: {"text": piece})
+        return {
+            "choices": [{"text": text}],
+            "usage": {"prompt_tokens": len(prompt), "completion_tokens": estimate_tokens(text)},
+        }
+
+    def create_chat_completion(self, messages, max_tokens=None, stream=False):
+        self.calls += 1
+        prompt = "\n".join(message["content"] for message in messages if message["role"] == "user")
+        self.eval([ord(c) for c in "".join(message["content"] for message in messages)])
+        if self.latency:
+            time.sleep(self.latency)
+        text = fake_completion(prompt, self.mode, self.canned_text)
+        if stream:
+            return self._stream(text, lambda piece: {"delta": {"content": piece}})
+        return {
+            "choices": [{"message": {"role": "assistant", "content": text}}],
+            "usage": {"prompt_tokens": estimate_tokens(prompt), "completion_tokens": estimate_tokens(text)},
+        }
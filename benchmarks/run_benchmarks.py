@@ -0,0 +1,508 @@
+"""
+Offline end-to-end benchmarks for AutoPDD.
+
+Runs the pipeline's stages on synthetic corpora of increasing size with a
+fake, deterministic LLM (see fake_llm.py), and reports time, throughput and
+peak Python memory (tracemalloc) per stage:
+
+    extract        extract_text_from_folder() on a fresh folder
+    extract_warm   the same again, with everything already extracted
+    sections       ___main.fill_project(), headless, with the fake model
+                   behind its RateLimitedAgent
+    docx_replace   replace_section_in_word_doc() once per section
+    docx_session   the same replacements through one DocumentSession
+
+and, once per run rather than per corpus size, the start-up time of fresh
+interpreter processes (peak memory is not measured for these):
+
+    startup/import_main   python -c "import ___main"
+    startup/cli_help      python src/autopdd.py --help
+    startup/status        python src/autopdd.py status, on an extracted project
+
+and checks (pass/fail, not timed) that GeminiRegistry, run against the
+fake Files/cachedContents backend, reuses uploads and recreates expired
+cached content, and that every section rendered from its field schema
+replaces exactly that section of the document:
+
+    check/gemini_registry
+    check/field_schemas
+
+Each stage's time is the median of --repeat runs. Results are compared
+against benchmarks/baseline.json, and a stage slower than the baseline by
+more than both the tolerance and --time-floor seconds, or using more memory
+than the tolerance allows, is reported as a regression. Baselines hold
+absolute timings from one machine, so regressions fail the run (exit code 1)
+only with --fail-on-regression; refresh the baseline with --update-baseline
+after an intended change or on a new machine. A failed check always fails
+the run.
+
+Usage (from the repository root):
+    python benchmarks/run_benchmarks.py
+    python benchmarks/run_benchmarks.py --sizes small,medium,large --latency 0.05
+    python benchmarks/run_benchmarks.py --update-baseline
+    python benchmarks/run_benchmarks.py --fail-on-regression
+"""
+import os
+import sys
+import gc
+import io
+import json
+import time
+import shutil
+import argparse
+import statistics
+import platform
+import subprocess
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCH_DIR), "src")
+sys.path.insert(0, SRC_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import corpus
+from fake_llm import FakeGeminiAgent, FakeGeminiBackend
+from context_manager import extract_text_from_folder
+from section_outline import load_template_outline
+from word_editor import load_word_doc_to_string, replace_section_in_word_doc, DocumentSession
+from field_schema import load_field_schemas, render_section
+from gemini_registry import GeminiRegistry
+from gemini_interface import upload_files_to_gemini, ask_gemini
+from text_processing import assemble_system_prompt
+
+BASELINE_PATH = os.path.join(BENCH_DIR, "baseline.json")
+STAGES = ("extract", "extract_warm", "sections", "docx_replace", "docx_session", "startup", "registry", "schemas")
+CLI = os.path.join(SRC_DIR, "autopdd.py")
+STARTUP_COMMANDS = {
+    "import_main": [sys.executable, "-c", "import ___main"],
+    "cli_help": [sys.executable, CLI, "--help"],
+    "status": [sys.executable, CLI, "status", "bench"],
+}
+
+
+# --- Fixtures ---
+
+def make_fixture(root, size):
+    """Creates a project (template, documents, output folder) for one corpus size."""
+    documents, pages_per_pdf, sections = corpus.SIZES[size]
+    os.makedirs(os.path.join(root, "pdd_template"))
+    os.makedirs(os.path.join(root, "auto_pdd_output"))
+    titles = corpus.make_template(os.path.join(root, "pdd_template", "template.docx"), sections)
+    pages = corpus.make_corpus(os.path.join(root, "corpus"), documents, pages_per_pdf)
+    os.makedirs(os.path.join(root, "rulebooks"))
+    corpus.write_rulebook(os.path.join(root, "rulebooks", "rulebook.docx"), 8)
+    return {"root": root, "titles": titles, "pages": pages, "documents": documents}
+
+
+def fresh_project(fixture):
+    """A clean copy of the corpus as the project folder (nothing extracted yet)."""
+    project = os.path.join(fixture["root"], "provided_documents", "bench")
+    if os.path.exists(project):
+        shutil.rmtree(project)
+    shutil.copytree(os.path.join(fixture["root"], "corpus"), project)
+    return project
+
+
+def fresh_output(fixture):
+    output_path = os.path.join(fixture["root"], "auto_pdd_output", "AutoPDD_bench.docx")
+    shutil.copy(os.path.join(fixture["root"], "pdd_template", "template.docx"), output_path)
+    return output_path
+
+
+def filled_sections(fixture):
+    """One (start_marker, end_marker, response) per section, as the fake model fills them."""
+    _, outline = load_template_outline(os.path.join(fixture["root"], "pdd_template"))
+    agent = FakeGeminiAgent()
+    jobs = []
+    for section in outline:
+        response = agent.generate_content([f"TEMPLATE TO FILL:\n{section['body']}"]).text
+        jobs.append((section["target"][1], section["end_marker"], f"SECTION_COMPLETE\n\n{response}"))
+    return jobs
+
+
+# --- Stages ---
+# Each stage is (prepare, run): prepare() sets up untimed state and returns
+# the argument for run(), which is the timed part and returns the number of
+# units processed (pages or sections).
+
+def stage_extract(fixture, args):
+    def prepare():
+        return fresh_project(fixture)
+
+    def run(project):
+        extract_text_from_folder(project, max_workers=args.workers)
+        return fixture["pages"]
+    return prepare, run, "pages"
+
+
+def stage_extract_warm(fixture, args):
+    def prepare():
+        project = fresh_project(fixture)
+        extract_text_from_folder(project, max_workers=args.workers)
+        return project
+
+    def run(project):
+        extract_text_from_folder(project, max_workers=args.workers)
+        return fixture["pages"]
+    return prepare, run, "pages"
+
+
+def stage_sections(fixture, args):
+    import ___main
+
+    def prepare():
+        project = fresh_project(fixture)
+        extract_text_from_folder(project, max_workers=args.workers)
+        # A cold response cache, so every run makes the same requests
+        shutil.rmtree(os.path.join(fixture["root"], ".llm_cache"), ignore_errors=True)
+        fresh_output(fixture)
+        return os.path.basename(project)
+
+    def run(name):
+        # ___main.fill_project() itself, with the fake model behind its RateLimitedAgent
+        ___main.headless = True
+        ___main.max_concurrent_sections = args.concurrency
+        ___main.setup_gemini = lambda: FakeGeminiAgent(latency=args.latency)
+        ___main.requests_per_minute = 1000000  # The scheduler is exercised, but never waits for quota
+        # GeminiRegistry talks to the real Files API; it is checked against the fake on its own (check/gemini_registry)
+        ___main.reuse_gemini_uploads = False
+        cwd = os.getcwd()
+        os.chdir(fixture["root"])
+        try:
+            return ___main.fill_project(name, there_are_new_files=True, trace=False)["sections"]
+        finally:
+            os.chdir(cwd)
+    return prepare, run, "sections"
+
+
+def stage_docx_replace(fixture, args):
+    def prepare():
+        return fresh_output(fixture), filled_sections(fixture)
+
+    def run(prepared):
+        output_path, jobs = prepared
+        for start_marker, end_marker, response in jobs:
+            replace_section_in_word_doc(output_path, start_marker, end_marker, response)
+        return len(jobs)
+    return prepare, run, "sections"
+
+
+def stage_docx_session(fixture, args):
+    def prepare():
+        return fresh_output(fixture), filled_sections(fixture)
+
+    def run(prepared):
+        output_path, jobs = prepared
+        with DocumentSession(output_path) as session:
+            for start_marker, end_marker, response in jobs:
+                session.replace_section(start_marker, end_marker, response)
+        return len(jobs)
+    return prepare, run, "sections"
+
+
+STAGE_FUNCTIONS = {
+    "extract": stage_extract,
+    "extract_warm": stage_extract_warm,
+    "sections": stage_sections,
+    "docx_replace": stage_docx_replace,
+    "docx_session": stage_docx_session,
+}
+
+
+def measure(prepare, run, repeat):
+    """
+    Median wall time over `repeat` runs, then one more run under tracemalloc
+    for the peak memory (kept separate so tracing does not skew the timing).
+    """
+    times, units = [], 0
+    # The pipeline's progress printing is not part of what is measured
+    with redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            prepared = prepare()
+            gc.collect()
+            start = time.perf_counter()
+            units = run(prepared)
+            times.append(time.perf_counter() - start)
+
+        prepared = prepare()
+        gc.collect()
+        tracemalloc.start()
+        try:
+            run(prepared)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return statistics.median(times), units, peak / (1024 * 1024)
+
+
+def measure_startup(fixture, repeat):
+    """
+    Best wall time of each STARTUP_COMMANDS entry, run as a fresh process
+    in the fixture's root.
+    """
+    project = fresh_project(fixture)
+    with redirect_stdout(io.StringIO()):
+        extract_text_from_folder(project, max_workers=1)
+    fresh_output(fixture)
+    env = dict(os.environ, PYTHONPATH=SRC_DIR, PYTHONWARNINGS="ignore")
+
+    results = {}
+    for name, command in STARTUP_COMMANDS.items():
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            process = subprocess.run(command, cwd=fixture["root"], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            elapsed = time.perf_counter() - start
+            if process.returncode != 0:
+                raise RuntimeError(f"{' '.join(command)} failed: {process.stderr.decode(errors='replace')[-500:]}")
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = best
+    return results
+
+
+def check_gemini_registry(root):
+    """
+    Runs upload_files_to_gemini() and ask_gemini() with a GeminiRegistry on
+    FakeGeminiBackend through several simulated runs (a new registry loaded
+    from the same file each time), so the fake can't drift from what the
+    registry expects of GenaiBackend. Raises AssertionError on a failure.
+
+    Returns:
+        int: The number of checks passed.
+    """
+    offset = [0.0]  # Seconds the backend's clock is ahead of real time
+    backend = FakeGeminiBackend(clock=lambda: time.time() + offset[0])
+    registry_path = os.path.join(root, "gemini_registry.json")
+    context_path = os.path.join(root, "all_context.txt")
+    with open(context_path, 'w', encoding='utf-8') as f:
+        f.write("Prime Road is a solar project in Kenya.\n" * 50)
+    system_prompt = assemble_system_prompt()
+    prompt = "TEMPLATE TO FILL:\nLocation\n[project location]"
+    checks = []
+
+    def check(condition, message):
+        checks.append(message)
+        assert condition, message
+
+    def run():
+        registry = GeminiRegistry(registry_path, cache_ttl_s=3600, backend=backend)
+        files = upload_files_to_gemini([context_path], registry=registry)
+        answer = ask_gemini(backend.agent, prompt, system_prompt, files)
+        check(answer == "synthetic project location", f"unexpected answer {answer!r}")
+        return registry, files
+
+    with redirect_stdout(io.StringIO()):
+        run()
+        check(backend.uploads == 1 and backend.caches_created == 1, "the first run uploads once and creates one cache")
+        registry, files = run()
+        check(backend.uploads == 1 and registry.uploads_reused == 1, "an unchanged file is not uploaded again")
+        check(backend.caches_created == 1 and registry.caches_reused == 1, "live cached content is reused")
+
+        # Dropped by the server mid-run: the request falls back to the full prompt
+        for name in list(backend.caches):
+            backend.delete_cache(name)
+        answer = ask_gemini(backend.agent, prompt, system_prompt, files)
+        check(answer == "synthetic project location", "a request whose cache is gone is answered in full")
+        run()
+        check(backend.caches_created == 2, "deleted cached content is recreated")
+
+        # Expired by the server's clock, though not yet by the registry's
+        offset[0] = 2 * 3600
+        run()
+        check(backend.caches_created == 3, "cached content expired on the server is recreated")
+
+        # Within the registry's expiry margin: not reused at all
+        offset[0] = -3500
+        for name in list(backend.caches):
+            backend.delete_cache(name)
+        run()
+        created = backend.caches_created
+        run()
+        check(backend.caches_created == created + 1, "cached content close to expiry is recreated")
+
+        offset[0] = -48 * 3600 + 100
+        registry = GeminiRegistry(registry_path, cache_ttl_s=3600, backend=backend)
+        registry.data["files"].clear()
+        registry.upload(context_path)
+        uploads = backend.uploads
+        offset[0] = 0.0
+        run()
+        check(backend.uploads == uploads + 1, "an upload close to expiry is made again")
+    return len(checks)
+
+
+def check_field_schemas(root):
+    """
+    Renders every section of a corpus template from its field schema, with
+    every field answered, and replaces it in a copy of the template, so a
+    schema compiled from more than its section (the last one running on
+    into the Appendix) shows up as duplicated text. Raises AssertionError
+    on a failure.
+
+    Returns:
+        int: The number of checks passed.
+    """
+    template_folder = os.path.join(root, "pdd_template")
+    os.makedirs(template_folder)
+    template_path = os.path.join(template_folder, "template.docx")
+    titles = corpus.make_template(template_path, 6)
+    output_path = os.path.join(root, "output.docx")
+    shutil.copy(template_path, output_path)
+    checks = []
+
+    def check(condition, message):
+        checks.append(message)
+        assert condition, message
+
+    with redirect_stdout(io.StringIO()):
+        _, outline = load_template_outline(template_folder)
+        schemas = load_field_schemas(template_folder, outline)
+        with DocumentSession(output_path) as session:
+            for section in outline:
+                schema = schemas[section["target"][2]]
+                if schema is None:
+                    continue
+                rendered = render_section(schema, {i: "ANSWER" for i in range(len(schema["fields"]))})
+                check("Appendix" not in rendered and not any(title in rendered for title in titles),
+                      f"section {section['target'][2]} renders only its own body, got {rendered!r}")
+                session.replace_section(section["target"][1], section["end_marker"], f"SECTION_COMPLETE\n\n{rendered}")
+    lines = [line.strip() for line in load_word_doc_to_string(output_path).splitlines()]
+    check(lines.count("Appendix") == 1 and lines.count("Appendix text.") == 1,
+          "the Appendix follows the last rendered section once")
+    check(lines.count("SECTION_COMPLETE") == sum(schema is not None for schema in schemas.values()),
+          "every rendered section is in the document")
+    return len(checks)
+
+
+CHECK_FUNCTIONS = {
+    "registry": ("check/gemini_registry", check_gemini_registry),
+    "schemas": ("check/field_schemas", check_field_schemas),
+}
+
+
+# --- Baseline ---
+
+def load_baseline():
+    try:
+        with open(BASELINE_PATH, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def compare(results, baseline, time_tolerance, memory_tolerance, time_floor):
+    """
+    Returns:
+        list: Regression messages, empty if every stage is within tolerance.
+    """
+    regressions = []
+    for key, result in results.items():
+        base = baseline["results"].get(key)
+        if not base:
+            continue
+        # Absolute floors keep scheduling and disk noise from counting as a regression.
+        if result["seconds"] > base["seconds"] * (1 + time_tolerance) and result["seconds"] - base["seconds"] > time_floor:
+            regressions.append(f"{key}: {result['seconds']:.3f}s vs baseline {base['seconds']:.3f}s")
+        if result["peak_mb"] > base["peak_mb"] * (1 + memory_tolerance) + 0.5:
+            regressions.append(f"{key}: peak {result['peak_mb']:.1f} MB vs baseline {base['peak_mb']:.1f} MB")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline AutoPDD benchmarks with a fake LLM.")
+    parser.add_argument("--sizes", default="small,medium", help=f"Comma-separated corpus sizes ({', '.join(corpus.SIZES)}).")
+    parser.add_argument("--stages", default=",".join(STAGES), help="Comma-separated stages to run.")
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds per fake LLM call.")
+    parser.add_argument("--concurrency", type=int, default=4, help="Sections in flight at once in the section loop.")
+    parser.add_argument("--workers", type=int, default=1, help="Extraction processes (1 keeps memory measurable in-process).")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per stage; the median is kept.")
+    parser.add_argument("--time-tolerance", type=float, default=0.25, help="Allowed slowdown vs the baseline (0.25 = 25%%).")
+    parser.add_argument("--time-floor", type=float, default=0.25, help="Slowdowns of up to this many seconds are never regressions.")
+    parser.add_argument("--memory-tolerance", type=float, default=0.25, help="Allowed peak memory growth vs the baseline.")
+    parser.add_argument("--update-baseline", action="store_true", help="Store this run's results as the new baseline.")
+    parser.add_argument("--fail-on-regression", action="store_true",
+                        help="Exit with code 1 on a regression (only meaningful on the machine that recorded the baseline).")
+    args = parser.parse_args()
+
+    sizes = args.sizes.split(",")
+    stages = args.stages.split(",")
+    results = {}
+    print(f"{'benchmark':<26}{'seconds':>10}{'throughput':>22}{'peak MB':>10}")
+    for size in sizes:
+        root = tempfile.mkdtemp(prefix=f"autopdd_bench_{size}_")
+        try:
+            fixture = make_fixture(root, size)
+            for stage in stages:
+                if stage == "startup" or stage in CHECK_FUNCTIONS:
+                    continue
+                prepare, run, unit = STAGE_FUNCTIONS[stage](fixture, args)
+                seconds, units, peak_mb = measure(prepare, run, args.repeat)
+                key = f"{size}/{stage}"
+                results[key] = {"seconds": round(seconds, 4), "units": units, "unit": unit,
+                                "throughput": round(units / seconds, 2) if seconds else None, "peak_mb": round(peak_mb, 2)}
+                throughput = f"{units / seconds:.1f} {unit}/s" if seconds else "-"
+                print(f"{key:<26}{seconds:>10.3f}{throughput:>22}{peak_mb:>10.1f}")
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+
+    if "startup" in stages:
+        root = tempfile.mkdtemp(prefix="autopdd_bench_startup_")
+        try:
+            # Start-up time is noisy; always take the best of a few runs
+            for name, seconds in measure_startup(make_fixture(root, "small"), max(args.repeat, 5)).items():
+                key = f"startup/{name}"
+                results[key] = {"seconds": round(seconds, 4), "units": 1, "unit": "runs",
+                                "throughput": round(1 / seconds, 2), "peak_mb": 0.0}
+                print(f"{key:<26}{seconds:>10.3f}{f'{1 / seconds:.1f} runs/s':>22}{'-':>10}")
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+
+    failed_checks = []
+    for stage, (name, check) in CHECK_FUNCTIONS.items():
+        if stage not in stages:
+            continue
+        root = tempfile.mkdtemp(prefix=f"autopdd_bench_{stage}_")
+        try:
+            passed = check(root)
+            print(f"{name:<26}{'passed':>10}{f'{passed} checks':>22}{'-':>10}")
+        except AssertionError as e:
+            print(f"{name:<26}{'FAILED':>10}  {e}")
+            failed_checks.append(f"{name}: {e}")
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+
+    settings = {"latency": args.latency, "concurrency": args.concurrency, "workers": args.workers}
+    if args.update_baseline:
+        baseline = load_baseline() or {"results": {}}
+        baseline.update({"machine": platform.platform(), "python": platform.python_version(), "settings": settings})
+        baseline["results"].update(results)
+        with open(BASELINE_PATH, 'w', encoding='utf-8') as f:
+            json.dump(baseline, f, indent=4, sort_keys=True)
+        print(f"\nBaseline updated: {BASELINE_PATH}")
+        return 1 if failed_checks else 0
+
+    if failed_checks:
+        print("\nFAILED CHECKS:")
+        for message in failed_checks:
+            print(f"  {message}")
+        return 1
+    baseline = load_baseline()
+    if baseline is None:
+        print("\nNo baseline stored yet; run with --update-baseline to create one.")
+        return 0
+    if baseline.get("settings") != settings:
+        print(f"\nWarning: baseline was recorded with {baseline.get('settings')}, this run used {settings}.")
+    regressions = compare(results, baseline, args.time_tolerance, args.memory_tolerance, args.time_floor)
+    if regressions:
+        print("\nREGRESSIONS:")
+        for message in regressions:
+            print(f"  {message}")
+        return 1 if args.fail_on_regression else 0
+    print("\nNo regressions against the baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -18,90 +18,409 @@
 #           I'm going to also start looking at algorithmic methods to improve attention with longer contexts.
 
 import os
-from gemini_interface import setup_gemini, ask_gemini, upload_files_to_gemini
+import time
+from gemini_interface import setup_gemini, ask_gemini, upload_files_to_gemini, RateLimitedAgent
+from gemini_registry import GeminiRegistry
 from context_manager import extract_text_from_folder
-from text_processing import retrieve_contents_list, get_pdd_targets, find_target_location, cleanup_response, assemble_system_prompt, assemble_user_prompt, is_valid_response
-from word_editor import load_word_doc_to_string, create_output_doc_from_template, replace_section_in_word_doc
-from _section_filler import fill_section, refill_section
+from context_index import ContextIndex
+from context_store import ContextStore
+from rulebook_index import RulebookIndex
+from section_attempts import SectionAttempts
+from llm_cache import ResponseCache
+from instrumentation import start_trace, print_summary
+from section_outline import load_template_outline, build_outline
+from response_parser import find_missing_fields
+from text_processing import cleanup_response, assemble_system_prompt, assemble_user_prompt, is_valid_response
+from word_editor import load_word_doc_to_string, create_output_doc_from_template, replace_section_in_word_doc, DocumentSession
+from field_schema import load_field_schemas
+from _section_filler import fill_section, refill_section, fill_packed_sections, fill_section_fields, refill_fields, finalize_response, failed_section_response, fill_sections_concurrently
 
-os.system('cls' if os.name == 'nt' else 'clear')
+# --- CONFIGURATION ---
+from project_config import project_name  # The project to fill; set it in project_config.py.
+extraction_workers = None  # Processes used for PDF/DOCX extraction. None = all cores, 1 = no pool.
+dedupe_context = True  # Write boilerplate repeated within and across documents to all_context.txt only once.
+use_retrieval = True  # Send each section only its most relevant context chunks instead of uploading all_context.txt.
+reuse_gemini_uploads = True  # Remember uploads and cached content in .llm_cache/gemini_registry.json, so unchanged context is never re-uploaded.
+context_cache_minutes = 60  # Keep the system prompt (and uploaded context) in server-side cached content for this long. 0 = off.
+retrieval_top_k = 12
+retrieval_token_budget = 8000
+use_rulebooks = True  # Send each section the relevant clauses of the methodology rulebooks (e.g. VM0047) in rulebook_folder.
+rulebook_folder = "rulebooks"
+rulebook_top_k = 6
+rulebook_token_budget = 2000
+rulebook_min_score = 6.0  # Clauses scoring lower are not sent; sections no clause matches well get none.
+headless = False  # Fill sections concurrently without waiting for Enter after each one.
+max_concurrent_sections = 4  # Section requests in flight at once in headless mode.
+requests_per_minute = 60  # Gemini quota of the API key. Every request is scheduled under it, with tokens_per_minute.
+tokens_per_minute = 1000000  # Input tokens per minute. 0 = not limited.
+max_requests_in_flight = 8
+rate_limit_retries = 5  # Retries, with jittered exponential backoff, of a request refused for rate limiting.
+use_field_schemas = True  # Ask only for the values of each section's fields (compiled from the template, cached in pdd_template/) and render the sections locally.
+pack_small_sections = True  # Fill runs of adjacent small sections (contact tables, one-field paragraphs) with one request.
+pack_section_chars = 600  # Sections with a template body up to this long can be packed...
+pack_budget_chars = 2400  # ...into requests of up to this many template characters,
+pack_max_sections = 6  # and this many sections.
+stream_responses = True  # Check responses while they are generated and abort (and retry) one that diverges from the template. Shown live unless headless.
+use_llm_cache = True  # Answer repeated, identical requests from the on-disk response cache (.llm_cache/).
+llm_cache_bypass = False  # Ignore cached responses for this run (fresh responses still refresh the cache).
+llm_cache_max_mb = 256
+document_checkpoint_every = 10  # Headless mode: save the output document after this many sections (0 = only at the end).
+trace_run = True  # Record per-stage timings, tokens and retries to <project folder>/trace.jsonl and print a summary at the end.
 
-# --- 1. SETUP ---
-project_name = "prime_road"
 
-# Create the single output document from the template if it doesn't exist yet
-output_path = create_output_doc_from_template(project_name)
-output_text = load_word_doc_to_string("auto_pdd_output")
+def plan_sections(template_outline, output_outline, there_are_new_files, attempts):
+    """
+    Works out which sections need filling, and everything needed to fill
+    them, without calling the model.
 
-# Load the template's structure into a string for analysis and for generating prompts
-template_text = load_word_doc_to_string("pdd_template")
-contents_list = retrieve_contents_list(template_text)
-pdd_targets = get_pdd_targets(contents_list)
+    Args:
+        template_outline (list): Section outline of the template (see section_outline.py).
+        output_outline (list): Section outline of the output document, for the same targets.
+        there_are_new_files (bool): Whether the provided documents changed since the last run.
+                                    Only used for attempted sections with no record in attempts.
+        attempts (SectionAttempts): Which documents each section was last attempted with.
 
-there_are_new_files = extract_text_from_folder(f"provided_documents/{project_name}")
-GEMINI_CLIENT = setup_gemini()
-uploaded_files_cache = upload_files_to_gemini([f"provided_documents/{project_name}/all_context.txt"])
+    Returns:
+        list: One dict per section to process, in document order.
+    """
+    jobs = []
+    for template_section, output_section in zip(template_outline, output_outline):
+        # 'target' is a tuple: (section_heading, subheading, subheading_idx, page_num)
+        target = template_section["target"]
+        start_marker = target[1]  # The subheading title is our start marker for replacement
+        # The next subheading, or FINAL_END_MARKER for the last section (see section_outline.py)
+        end_marker = template_section["end_marker"]
 
-# --- 2. MAIN PROCESSING LOOP ---
-for target_idx, target in enumerate(pdd_targets):
-    # 'target' is a tuple: (section_heading, subheading, subheading_idx, page_num)
-    start_marker = target[1]  # The subheading title is our start marker for replacement
+        # The original placeholder text from the template becomes the user prompt
+        infilling_info = template_section["body"]
 
-    # Determine the end marker to define the section's boundaries
-    if target_idx + 1 < len(pdd_targets):
-        end_marker = pdd_targets[target_idx + 1][1]
-    else:
-        # For the last section, use a known final heading like "Appendix". Adjust if your template differs.
-        end_marker = "Appendix" 
-
-    # Get the original placeholder text from the template to create the user prompt
-    template_start_loc = find_target_location(target, template_text)
-    template_end_loc = find_target_location(pdd_targets[target_idx + 1], template_text) if target_idx + 1 < len(pdd_targets) else -1
-    infilling_info = template_text[template_start_loc:template_end_loc] if template_end_loc != -1 else template_text[template_start_loc:]
-
-    output_start_loc = find_target_location(target, output_text)
-    output_end_loc = find_target_location(pdd_targets[target_idx + 1], output_text) if target_idx + 1 < len(pdd_targets) else -1
-    #print(f"Section:\n {output_text[output_start_loc:output_end_loc]}")
-    
-    response = None
-    section_status = output_text[output_start_loc:output_end_loc].split("\n")[2]
-    if("SECTION_COMPLETE" in section_status):
-        print(f"\nSection '{start_marker}' is already complete. Skipping...")
-        continue
-    if("SECTION_ATTEMPTED" in section_status):
-        if(not there_are_new_files):
-            print(f"\nSection '{start_marker}' has previously been attempted and no new files are available. Skipping...")
+        section_status = output_section["status"]
+        fields, new_files = None, None
+        if("SECTION_COMPLETE" in section_status):
+            print(f"\nSection '{start_marker}' is already complete. Skipping...")
+            continue
+        if("SECTION_ATTEMPTED" in section_status):
+            # The record of the last attempt decides; without one, fall back to whether anything changed this run
+            new_files = attempts.new_files_since(start_marker)
+            if(new_files == [] or (new_files is None and not there_are_new_files)):
+                print(f"\nSection '{start_marker}' has previously been attempted and no new files are available. Skipping...")
+                continue
+            # With a record of the last attempt, only the missing fields are asked for, from only the new files
+            fields = find_missing_fields(output_section["body"]) if new_files else None
+            if fields:
+                print(f"\nSection '{start_marker}' has {len(fields)} missing field(s) and {len(new_files)} new file(s). Will refill those fields.")
+            else:
+                print(f"\nSection '{start_marker}' has previously been attempted, but there are new files! Will retry.")
+
+        jobs.append({
+            "target": target,
+            "start_marker": start_marker,
+            "end_marker": end_marker,
+            "infilling_info": infilling_info,
+            "refill": "SECTION_ATTEMPTED" in section_status,
+            "fields": fields or None,
+            "new_files": new_files,
+            # The section as filled so far, without its heading and status lines
+            "section_text": output_section["body"].split("\n", 3)[-1] if fields else None,
+            "context_text": None,
+            "rulebook_text": None,
+        })
+    return jobs
+
+
+def pack_jobs(jobs):
+    """
+    Groups runs of adjacent small section fills (see pack_section_chars) into
+    packed jobs, each filled with a single request (see
+    fill_packed_sections()). A packed job holds its sections in "packed".
+    Field refills and larger sections are left as they are.
+    """
+    packed_jobs, run = [], []
+
+    def close_run():
+        if len(run) > 1:
+            packed_jobs.append({"packed": list(run), "start_marker": " + ".join(job["start_marker"] for job in run),
+                                "fields": None, "context_text": None, "rulebook_text": None})
+        else:
+            packed_jobs.extend(run)
+        run.clear()
+
+    for job in jobs:
+        size = len(job["infilling_info"])
+        if job["fields"] or size > pack_section_chars:
+            close_run()
+            packed_jobs.append(job)
             continue
-        print(f"\nSection '{start_marker}' has previously been attempted, but there are new files! Retrying...")
-        response = refill_section(GEMINI_CLIENT, infilling_info, uploaded_files_cache)
-    if not response:
-        print(f"\n{'='*20}\nProcessing section: {start_marker}\n{'='*20}")
-        response = fill_section(GEMINI_CLIENT, infilling_info, uploaded_files_cache)
+        if len(run) >= pack_max_sections or sum(len(j["infilling_info"]) for j in run) + size > pack_budget_chars:
+            close_run()
+        run.append(job)
+    close_run()
+    return packed_jobs
+
 
-    print("\n--- Response ---")
-    print(response)
-    print("-----------------------\n")
+def _section_query(job):
+    """The retrieval query of a job: its section's heading, subheading and template text (all of them, for a packed job)."""
+    return " ".join(f"{j['target'][0]} {j['target'][1]} {j['infilling_info']}" for j in job.get("packed", [job]))
 
-    response = cleanup_response(response)
 
-    print("\n--- Revised response ---")
-    print(response)
-    print("-----------------------\n")
+def _unpack(job, response):
+    """(section job, response) pairs of a job; a packed job's response is the list of its sections' responses."""
+    if "packed" not in job:
+        return [(job, response)]
+    return list(zip(job["packed"], response or [None] * len(job["packed"])))
 
 
-    if("INFO_NOT_FOUND" not in response):
-        response = "SECTION_COMPLETE\n\n"+response
-        print("SECTION_COMPLETE")
+def apply_section(job, response, output_doc, attempts):
+    """
+    Writes one generated section into output_doc. A field refill patches the
+    found fields in place; anything else replaces the whole section. A
+    section that could not be filled is left as it is, unless it was still
+    unfilled. Returns the section's status line, as it now reads in the
+    document.
+    """
+    if job["fields"]:
+        if response is None:
+            return "SECTION_ATTEMPTED (unchanged)"
+        patched, left = output_doc.patch_fields(job["start_marker"], job["end_marker"], response)
+        if patched < 0:
+            return "SECTION_ATTEMPTED (unchanged; section not found)"
+        attempts.record(job["start_marker"])
+        # patch_fields() marks the section complete only once it has no INFO_NOT_FOUND left
+        found = f"{patched} field(s) filled, {left} still missing"
+        return f"SECTION_COMPLETE ({found})" if patched and not left else f"SECTION_ATTEMPTED ({found})"
+
+    if response:
+        response = finalize_response(response)
+        attempts.record(job["start_marker"])
+    elif job["refill"]:
+        # Keep whatever an earlier attempt already found
+        return "SECTION_ATTEMPTED (unchanged)"
+    else:
+        response = failed_section_response(job["infilling_info"])
+    output_doc.replace_section(job["start_marker"], job["end_marker"], response)
+    return response.split("\n")[0]
+
+
+def process_sections(jobs, generate, output_doc, attempts):
+    """
+    Generates every planned section and writes the results into output_doc
+    (a DocumentSession) in section order. generate() sets "shown" on a
+    section's job when it already printed its response as it streamed.
+
+    Returns:
+        list: The status line of every section written.
+    """
+    statuses = []
+    if headless:
+        sections = sum(len(job.get("packed", [job])) for job in jobs)
+        print(f"\nFilling {sections} section(s) with {len(jobs)} request(s), up to {max_concurrent_sections} at a time...")
+        for job, response, error in fill_sections_concurrently(jobs, generate, max_concurrent_sections):
+            if error:
+                print(f"Section '{job['start_marker']}' failed: {error}")
+            for section_job, section_response in _unpack(job, response):
+                status = apply_section(section_job, section_response, output_doc, attempts)
+                statuses.append(status)
+                print(f"{status}: {section_job['start_marker']}")
     else:
-        response = "SECTION_ATTEMPTED\n\n"+response
-        print("SECTION_ATTEMPTED")
-    replace_section_in_word_doc(output_path, start_marker, end_marker, response)
+        for job in jobs:
+            print(f"\n{'='*20}\nProcessing section: {job['start_marker']}\n{'='*20}")
+            try:
+                response = generate(job)
+            except Exception as e:
+                print(f"Section '{job['start_marker']}' failed: {e}")
+                response = None
+
+            for section_job, section_response in _unpack(job, response):
+                # Skip a response already shown as it streamed
+                if section_response and not section_job.get("shown"):
+                    print(f"\n--- Response ({section_job['start_marker']}) ---" if "packed" in job else "\n--- Response ---")
+                    print(section_response)
+                    print("-----------------------\n")
+
+                statuses.append(apply_section(section_job, section_response, output_doc, attempts))
+                print(statuses[-1])
+
+            user_input = input("\nPress Enter to continue to the next section, or 'q' to quit: ")
+            if user_input.lower() == 'q':
+                break
+    return statuses
+
+
+def _warm_context_index(project_folder, warm):
+    """ContextIndex.build(), reusing the index held in warm while the project's documents are unchanged."""
+    if warm is None:
+        return ContextIndex.build(project_folder)
+    with ContextStore(project_folder) as store:
+        signature = store.signature()
+    held = warm.setdefault("indexes", {}).get(project_folder)
+    if held and held[0] == signature:
+        return held[1]
+    index = ContextIndex.build(project_folder)
+    warm["indexes"][project_folder] = (signature, index)
+    return index
+
+
+def fill_project(name, sections=None, warm=None, template=None, there_are_new_files=None, trace=None):
+    """
+    Fills (or continues filling) one project's output document.
+
+    Args:
+        name (str): Project folder name under provided_documents/.
+        sections (list): Only process these sections, each given by its number
+                         ("1.2") or part of its subheading (case-insensitive).
+                         None = all.
+        warm (dict): Objects kept alive between calls by the daemon (see
+                     daemon.py): the model client, response cache, upload
+                     registry, context indexes and uploads. None loads
+                     everything fresh.
+        template (tuple): (pdd_targets, outline) from load_template_outline(),
+                          if the caller already has it.
+        there_are_new_files (bool): The result of extract_text_from_folder(),
+                                    if the caller already extracted the project.
+        trace (bool): Record and summarize this project's own trace. None
+                      uses trace_run.
+
+    Returns:
+        dict: "project", "output_path", "sections" (number processed),
+              "statuses" (count per status) and "seconds".
+    """
+    started = time.perf_counter()
+    trace = trace_run if trace is None else trace
+    # --- 1. SETUP ---
+    project_folder = f"provided_documents/{name}"
+    if not os.path.isdir(project_folder):
+        raise FileNotFoundError(f"No project folder '{project_folder}'")
+    if trace:
+        start_trace(os.path.join(project_folder, "trace.jsonl"))
+
+    # Create the single output document from the template if it doesn't exist yet
+    output_path = create_output_doc_from_template(name)
+    output_text = load_word_doc_to_string(output_path)
+
+    # Load the template's section outline (cached by template hash) for analysis and for generating prompts,
+    # and locate the same sections in the output document in one pass
+    pdd_targets, template_outline = template or load_template_outline("pdd_template")
+    schemas = load_field_schemas("pdd_template", template_outline) if use_field_schemas else {}
+    output_outline = build_outline(output_text, pdd_targets)
+
+    if there_are_new_files is None:
+        there_are_new_files = extract_text_from_folder(project_folder, max_workers=extraction_workers, dedupe=dedupe_context)
+    with ContextStore(project_folder) as store:
+        attempts = SectionAttempts(project_folder, store.documents())
+    persistent = warm is not None
+    warm = warm if persistent else {}
+    if warm.get("gemini") is None:
+        agent = setup_gemini()
+        warm["gemini"] = RateLimitedAgent(agent, requests_per_minute, max_requests_in_flight, tokens_per_minute,
+                                          rate_limit_retries) if agent else None
+    GEMINI_CLIENT = warm["gemini"]
+    if "llm_cache" not in warm:
+        warm["llm_cache"] = ResponseCache(max_bytes=llm_cache_max_mb * 1024 * 1024, bypass=llm_cache_bypass) if use_llm_cache else None
+    llm_cache = warm["llm_cache"]
+    if "gemini_registry" not in warm:
+        warm["gemini_registry"] = GeminiRegistry(cache_ttl_s=context_cache_minutes * 60) if reuse_gemini_uploads else None
+    gemini_registry = warm["gemini_registry"]
+    if use_retrieval:
+        context_index = _warm_context_index(project_folder, warm if persistent else None)
+        # Nothing is uploaded, but the system prompt can still be cached server-side
+        uploaded_files_cache = gemini_registry.context() if gemini_registry else None
+    else:
+        context_index = None
+        uploads = warm.setdefault("uploads", {})
+        # With the registry, an unchanged all_context.txt costs a hash, not an upload
+        if gemini_registry or there_are_new_files or not uploads.get(project_folder):
+            uploads[project_folder] = upload_files_to_gemini([f"{project_folder}/all_context.txt"], registry=gemini_registry)
+        uploaded_files_cache = uploads[project_folder]
+
+    rulebook_index = None
+    if use_rulebooks:
+        rulebook_index = warm.get("rulebook_index")
+        if rulebook_index is None or not rulebook_index.is_current():
+            rulebook_index = RulebookIndex.build(rulebook_folder)
+            if persistent:
+                warm["rulebook_index"] = rulebook_index
+
+    jobs = plan_sections(template_outline, output_outline, there_are_new_files, attempts)
+    if sections:
+        wanted = [section.lower() for section in sections]
+        jobs = [job for job in jobs if any(w == job["target"][2] or w in job["start_marker"].lower() for w in wanted)]
+    if pack_small_sections:
+        jobs = pack_jobs(jobs)
+    # A packed job's sections share one selection, retrieved for all of them together
+    if context_index:
+        for job in jobs:
+            if not job["fields"]:
+                job["context_text"] = context_index.context_for_section(job["start_marker"], _section_query(job), retrieval_top_k, retrieval_token_budget)
+    if rulebook_index:
+        for job in jobs:
+            if not job["fields"]:
+                job["rulebook_text"] = rulebook_index.context_for_section(job["start_marker"], _section_query(job), rulebook_top_k, rulebook_token_budget, min_score=rulebook_min_score) or None
+    # Field refills search only the files added since the section's last attempt
+    field_jobs = [job for job in jobs if job["fields"]]
+    if field_jobs:
+        field_index = context_index or _warm_context_index(project_folder, warm if persistent else None)
+        for job in field_jobs:
+            job["context_text"] = field_index.context_for_section(job["start_marker"], " ".join(job["fields"]), retrieval_top_k, retrieval_token_budget, filenames=set(job["new_files"]))
+
+    # Concurrent sections would interleave their live output. Packed and field
+    # schema requests are printed once they have been rendered; only their
+    # per-section fallbacks stream live.
+    live = stream_responses and not headless
+
+    def generate(job):
+        members = job.get("packed", [job])
+        shown = []
+        if not job["fields"] and all(schemas.get(member["target"][2]) for member in members):
+            responses = fill_section_fields(GEMINI_CLIENT, [member["infilling_info"] for member in members],
+                                            [schemas[member["target"][2]] for member in members], uploaded_files_cache,
+                                            job["context_text"], llm_cache, job["rulebook_text"], stream_responses, live, shown)
+            for n in shown:
+                members[n]["shown"] = True
+            return responses if "packed" in job else responses[0]
+        if "packed" in job:
+            responses = fill_packed_sections(GEMINI_CLIENT, [j["infilling_info"] for j in job["packed"]], uploaded_files_cache, job["context_text"], llm_cache,
+                                             job["rulebook_text"], stream_responses, live, shown)
+            for n in shown:
+                members[n]["shown"] = True
+            return responses
+        if job["fields"]:
+            return refill_fields(GEMINI_CLIENT, job["section_text"], job["fields"], job["context_text"], llm_cache)
+        job["shown"] = live
+        if job["refill"]:
+            return refill_section(GEMINI_CLIENT, job["infilling_info"], uploaded_files_cache, job["context_text"], llm_cache, job["rulebook_text"],
+                                  stream_responses, live)
+        return fill_section(GEMINI_CLIENT, job["infilling_info"], uploaded_files_cache, job["context_text"], llm_cache, job["rulebook_text"],
+                            stream_responses, live)
+
+    # --- 2. MAIN PROCESSING LOOP ---
+    # The output document is loaded once and written back in as few saves as possible.
+    # Interactive mode saves after every section so it can be reviewed as we go.
+    checkpoint_every = document_checkpoint_every if headless else 1
+    with DocumentSession(output_path, checkpoint_every=checkpoint_every) as output_doc:
+        statuses = process_sections(jobs, generate, output_doc, attempts)
 
-    user_input = input("\nPress Enter to continue to the next section, or 'q' to quit: ")
-    if user_input.lower() == 'q':
-        break
+    if llm_cache:
+        print(llm_cache.summary())
+    if gemini_registry:
+        print(gemini_registry.summary())
+    if isinstance(GEMINI_CLIENT, RateLimitedAgent):
+        print(GEMINI_CLIENT.scheduler.summary())
+    if trace:
+        print_summary()
+    print(f"\nProcessing complete. The final document has been saved at: {output_path}\n")
+    counts = {}
+    for status in statuses:
+        counts[status.split(" ")[0]] = counts.get(status.split(" ")[0], 0) + 1
+    return {"project": name, "output_path": output_path, "sections": len(statuses),
+            "statuses": counts, "seconds": time.perf_counter() - started}
 
-print(f"\nProcessing complete. The final document has been saved at: {output_path}\n")
 
+def main():
+    os.system('cls' if os.name == 'nt' else 'clear')
+    fill_project(project_name)
 
 
+# The guard matters: extraction runs on a process pool, and on Windows each
+# worker re-imports this module.
+if __name__ == "__main__":
+    main()
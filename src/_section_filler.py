@@ -1,32 +1,310 @@
 
-from gemini_interface import ask_gemini
-from text_processing import assemble_user_prompt, assemble_system_prompt, is_valid_response
+import re
+from concurrent.futures import ThreadPoolExecutor
+from gemini_interface import ask_gemini, discard_cached_response
+from instrumentation import span
+from text_processing import assemble_user_prompt, assemble_packed_prompt, assemble_schema_prompt, assemble_schema_system_prompt, assemble_system_prompt, assemble_row_repair_prompt, assemble_field_refill_prompt, assemble_field_refill_system_prompt, cleanup_response
+from response_parser import validate_response, repair_headers, malformed_rows, patch_rows, parse_field_answers, StreamingResponseParser, StreamDiverged, split_packed_response, parse_schema_answers
+from field_schema import render_section
 
 
-def fill_section(GEMINI_CLIENT, infilling_info, uploaded_files_cache):
+# A line of a "<number>: <value>" answer.
+_FIELD_ANSWER_LINE_RE = re.compile(r"^\s*\d+\s*[.:)]", re.M)
 
+
+class SectionFillError(Exception):
+    """Raised by fill_section() when no valid response could be obtained."""
+
+
+def _is_error_response(response):
+    # ask_gemini() reports failures as text rather than raising.
+    return response.startswith(("An error occurred while asking Gemini", "Error: Gemini agent is not initialized."))
+
+
+def _section_name(infilling_info):
+    # infilling_info starts with the section heading.
+    return infilling_info.strip().split("\n", 1)[0]
+
+
+def _repair_rows(GEMINI_CLIENT, infilling_info, response, problems, uploaded_files_cache, context_text, cache, rulebook_text=None):
+    """
+    Re-requests only the malformed table rows of a response, with the same
+    sources as the section's own request, and patches them in. Returns the
+    repaired response, or None if the repair failed.
+    """
+    rows = malformed_rows(response, problems)
+    print(f"  > Re-requesting {len(rows)} malformed table row(s)...")
+    prompt = assemble_row_repair_prompt(infilling_info, rows, context_text, rulebook_text)
+    replacement = ask_gemini(GEMINI_CLIENT, prompt, assemble_system_prompt(), uploaded_files_cache, cache=cache)
+    if _is_error_response(replacement):
+        return None
+    repaired = patch_rows(response, rows, replacement)
+    if repaired is None or validate_response(repaired, infilling_info):
+        discard_cached_response(GEMINI_CLIENT, prompt, assemble_system_prompt(), uploaded_files_cache, cache)
+        return None
+    return repaired
+
+
+def _echo(text):
+    print(text, end="", flush=True)
+
+
+def fill_section(GEMINI_CLIENT, infilling_info, uploaded_files_cache, context_text=None, cache=None, rulebook_text=None,
+                 stream=False, live=False):
+    """
+    Args:
+        stream (bool): Stream each response through a StreamingResponseParser,
+                       abandoning (and retrying) a response as soon as it
+                       diverges from the template.
+        live (bool): With stream, also print the response as it arrives.
+    """
     # Assemble prompts for Gemini
     system_prompt = assemble_system_prompt()
-    user_prompt = assemble_user_prompt(infilling_info)
+    user_prompt = assemble_user_prompt(infilling_info, context_text, rulebook_text)
     # Ask Gemini for the content, with a few retries for validation
     response = ""
-    for i in range(3):  # Retry up to 3 times
-        print(f"  > Gemini API Call (Attempt {i+1})...")
-        response = ask_gemini(GEMINI_CLIENT, user_prompt, system_prompt, uploaded_files_cache)
-        if is_valid_response(response, infilling_info):
-            print("  > Valid response received from Gemini.")
-            break
-        elif i < 2:
-            print("  > Invalid response format, retrying...")
-        else:
-            print("  > Failed to get a valid response after 3 attempts.")
-            exit()
+    with span("section.fill", section=_section_name(infilling_info), prompt_chars=len(user_prompt)) as s:
+        for i in range(3):  # Retry up to 3 times
+            print(f"  > Gemini API Call (Attempt {i+1})...")
+            s["retries"] = i
+            parser = StreamingResponseParser(infilling_info, on_text=_echo if live else None) if stream else None
+            try:
+                # Retries must not be answered with the cached (invalid) response again.
+                response = ask_gemini(GEMINI_CLIENT, user_prompt, system_prompt, uploaded_files_cache, cache=cache,
+                                      bypass_cache=i > 0, stream=parser)
+                diverged = None
+            except StreamDiverged as e:
+                response, diverged = e.partial_text, e
+            if live:
+                print()
+            if diverged is not None:
+                # Abandoned mid-generation: the rest of the response was never paid for
+                print(f"  > Aborted after {len(response)} characters.")
+                problems = [{"kind": "diverged", "message": diverged.reason}]
+                s["aborted"] = s.get("aborted", 0) + 1
+            elif _is_error_response(response):
+                problems = [{"kind": "error", "message": response[:200]}]
+            else:
+                response = cleanup_response(response)
+                problems = validate_response(response, infilling_info)
+                # Wrong headers are put back locally; malformed rows are re-requested on their own.
+                response, problems = repair_headers(response, infilling_info, problems)
+                if problems and all(p["kind"] == "row" for p in problems):
+                    repaired = _repair_rows(GEMINI_CLIENT, infilling_info, response, problems, uploaded_files_cache, context_text, cache,
+                                            rulebook_text)
+                    s["repaired_rows"] = s.get("repaired_rows", 0) + sum(p["kind"] == "row" for p in problems)
+                    if repaired is not None:
+                        response, problems = repaired, []
+            if not problems:
+                print("  > Valid response received from Gemini.")
+                break
+            # Don't let a later run start from the same invalid response
+            discard_cached_response(GEMINI_CLIENT, user_prompt, system_prompt, uploaded_files_cache, cache)
+            for problem in problems:
+                print(f"    - {problem['message']}")
+            if i < 2:
+                print("  > Invalid response format, retrying...")
+            else:
+                print("  > Failed to get a valid response after 3 attempts.")
+                raise SectionFillError(f"no valid response after 3 attempts (last: {response[:200]!r})")
     return response
 
 
-def refill_section(GEMINI_CLIENT, infilling_info, uploaded_files_cache):
+def refill_section(GEMINI_CLIENT, infilling_info, uploaded_files_cache, context_text=None, cache=None, rulebook_text=None,
+                   stream=False, live=False):
     # For now just call fill_section
-    return fill_section(GEMINI_CLIENT, infilling_info, uploaded_files_cache)
+    return fill_section(GEMINI_CLIENT, infilling_info, uploaded_files_cache, context_text, cache, rulebook_text, stream, live)
+
+
+
+def fill_packed_sections(GEMINI_CLIENT, infilling_infos, uploaded_files_cache, context_text=None, cache=None, rulebook_text=None,
+                         stream=False, live=False, shown=None):
+    """
+    Fills several small sections with a single request. Sections whose part
+    of the response is missing or invalid (or all of them, if the response
+    can't be split cleanly) are then filled one by one with fill_section().
+
+    The packed request itself is deliberately not streamed: its response
+    holds several sections between delimiters, which a
+    StreamingResponseParser (built for one section's template) can't check
+    as it arrives. stream and live apply to the fallback fill_section() calls.
+
+    Args:
+        shown (list): If given, the index of every section whose response was
+                      printed live (by a fallback) is appended to it.
+
+    Returns:
+        list: One response per section, None for a section that could not
+              be filled.
+    """
+    names = [_section_name(info) for info in infilling_infos]
+    user_prompt = assemble_packed_prompt(infilling_infos, context_text, rulebook_text)
+    responses = [None] * len(infilling_infos)
+    with span("section.fill_packed", sections=len(infilling_infos), prompt_chars=len(user_prompt)) as s:
+        print(f"  > Gemini API Call for {len(infilling_infos)} packed sections...")
+        response = ask_gemini(GEMINI_CLIENT, user_prompt, assemble_system_prompt(), uploaded_files_cache, cache=cache)
+        parts = split_packed_response(response, len(infilling_infos)) if not _is_error_response(response) else None
+        if parts is None:
+            print("  > The packed response could not be split into its sections.")
+            discard_cached_response(GEMINI_CLIENT, user_prompt, assemble_system_prompt(), uploaded_files_cache, cache)
+        else:
+            for i, (info, part) in enumerate(zip(infilling_infos, parts)):
+                # The headings were sent inside the delimiters, and may come back
+                first_line, _, rest = part.strip().partition("\n")
+                if first_line.strip("# ") == names[i].strip():
+                    part = rest
+                part = cleanup_response(part)
+                problems = validate_response(part, info)
+                part, problems = repair_headers(part, info, problems)
+                if problems:
+                    print(f"  > Invalid packed response for '{names[i]}': {problems[0]['message']}")
+                else:
+                    responses[i] = part
+        s["unpacked"] = sum(response is None for response in responses)
+
+    for i, info in enumerate(infilling_infos):
+        if responses[i] is None:
+            print(f"  > Filling '{names[i]}' on its own...")
+            if live and shown is not None:
+                shown.append(i)
+            try:
+                responses[i] = fill_section(GEMINI_CLIENT, info, uploaded_files_cache, context_text, cache, rulebook_text, stream, live)
+            except SectionFillError as e:
+                print(f"Section '{names[i]}' failed: {e}")
+    return responses
+
+
+def fill_section_fields(GEMINI_CLIENT, infilling_infos, schemas, uploaded_files_cache, context_text=None, cache=None, rulebook_text=None,
+                        stream=False, live=False, shown=None):
+    """
+    Fills one or more sections from their compiled field schemas (see
+    field_schema.py): the model is asked only for the field values, and
+    each section is rendered locally. A section that still doesn't validate
+    after 3 attempts is filled whole with fill_section() instead.
+
+    The field request itself is deliberately not streamed: its answers are
+    "<number>: <value>" lines, not the section's template, so a
+    StreamingResponseParser has nothing to check them against. stream and
+    live apply to the fallback fill_section() calls.
+
+    Args:
+        shown (list): If given, the index of every section whose response was
+                      printed live (by a fallback) is appended to it.
+
+    Returns:
+        list: One response per section, None for a section that could not
+              be filled.
+    """
+    names = [_section_name(info) for info in infilling_infos]
+    sections = list(zip(infilling_infos, schemas))
+    user_prompt = assemble_schema_prompt(sections, context_text, rulebook_text)
+    field_count = sum(len(schema["fields"]) for schema in schemas)
+    responses = [None] * len(infilling_infos)
+    with span("section.fill_fields", sections=len(sections), fields=field_count, prompt_chars=len(user_prompt)) as s:
+        for i in range(3):  # Retry up to 3 times
+            print(f"  > Gemini API Call for {field_count} field(s) (Attempt {i+1})...")
+            s["retries"] = i
+            answer = ask_gemini(GEMINI_CLIENT, user_prompt, assemble_schema_system_prompt(), uploaded_files_cache,
+                                cache=cache, bypass_cache=i > 0)
+            if _is_error_response(answer):
+                print(f"    - {answer[:200]}")
+                continue
+            # Answers are numbered across all the sections
+            values = parse_schema_answers(answer, field_count)
+            if not values and not _FIELD_ANSWER_LINE_RE.search(answer):
+                print("    - The response has no numbered answers.")
+                discard_cached_response(GEMINI_CLIENT, user_prompt, assemble_schema_system_prompt(), uploaded_files_cache, cache)
+                continue
+            first = 1
+            for n, (info, schema) in enumerate(sections):
+                response = render_section(schema, {index: values.get(first + index) for index in range(len(schema["fields"]))})
+                first += len(schema["fields"])
+                problems = validate_response(response, info)
+                if problems:
+                    print(f"    - '{names[n]}': {problems[0]['message']}")
+                else:
+                    responses[n] = response
+            s["found"] = len(values)
+            print(f"  > Found {len(values)} of {field_count} field(s).")
+            break
+
+    for n, info in enumerate(infilling_infos):
+        if responses[n] is None:
+            print(f"  > Filling '{names[n]}' whole...")
+            if live and shown is not None:
+                shown.append(n)
+            try:
+                responses[n] = fill_section(GEMINI_CLIENT, info, uploaded_files_cache, context_text, cache, rulebook_text, stream, live)
+            except SectionFillError as e:
+                print(f"Section '{names[n]}' failed: {e}")
+    return responses
+
+
+def refill_fields(GEMINI_CLIENT, section_text, fields, context_text=None, cache=None):
+    """
+    Asks only for the INFO_NOT_FOUND fields of an already filled section,
+    against the documents added since it was last attempted.
+
+    Returns:
+        dict: {field: value} for the fields that were found.
+    """
+    system_prompt = assemble_field_refill_system_prompt()
+    user_prompt = assemble_field_refill_prompt(section_text, fields, context_text)
+    with span("section.refill_fields", fields=len(fields), prompt_chars=len(user_prompt)) as s:
+        for i in range(3):  # Retry up to 3 times
+            print(f"  > Gemini API Call for {len(fields)} missing field(s) (Attempt {i+1})...")
+            s["retries"] = i
+            response = ask_gemini(GEMINI_CLIENT, user_prompt, system_prompt, cache=cache, bypass_cache=i > 0)
+            if not _is_error_response(response):
+                answers = parse_field_answers(response, fields)
+                print(f"  > Found {len(answers)} of {len(fields)} field(s).")
+                s["found"] = len(answers)
+                return answers
+            print(f"  > {response[:200]}")
+    raise SectionFillError("no valid response to the field refill after 3 attempts")
+
+
+def finalize_response(response):
+    """Cleans up a raw model response and prefixes it with the section status line."""
+    response = cleanup_response(response)
+    status = "SECTION_COMPLETE" if "INFO_NOT_FOUND" not in response else "SECTION_ATTEMPTED"
+    return f"{status}\n\n{response}"
+
+
+def failed_section_response(infilling_info):
+    """
+    What to write for a section that could not be filled on its first
+    attempt: the template's own content under a SECTION_ATTEMPTED status, so
+    a later run picks it up again. (A section already attempted is left as it
+    is; see ___main.apply_section().)
+    """
+    # infilling_info starts with the section heading, which stays in the document.
+    body = infilling_info.strip().split("\n", 1)[1].strip() if "\n" in infilling_info.strip() else ""
+    return f"SECTION_ATTEMPTED\n\n{body}"
+
+
+def fill_sections_concurrently(jobs, generate, max_concurrent=4):
+    """
+    Runs generate(job) for every job on a thread pool with at most
+    max_concurrent requests in flight, and yields the results in job order
+    (each one as soon as it and every job before it have finished), so the
+    caller can apply them to the document in section order.
+
+    Yields:
+        tuple: (job, response, error). error is the exception raised by
+               generate(job), or None if it succeeded.
+    """
+    pool = ThreadPoolExecutor(max_workers=max_concurrent)
+    try:
+        futures = [pool.submit(generate, job) for job in jobs]
+        for job, future in zip(jobs, futures):
+            try:
+                yield job, future.result(), None
+            except Exception as e:
+                yield job, None, e
+    finally:
+        # Don't start queued sections if the caller stops early.
+        pool.shutdown(wait=True, cancel_futures=True)
 
 
 
@@ -0,0 +1,166 @@
+import os
+import sys
+import argparse
+
+# Command-line entry point. Each subcommand imports only the modules it
+# needs, and heavy packages are loaded lazily on first use (see
+# lazy_import.py), so e.g. "status" never loads pdfplumber or the Gemini SDK.
+#
+#   python src/autopdd.py status  [project]
+#   python src/autopdd.py extract [project]
+#   python src/autopdd.py fill    [project] [-s 1.2] [--headless]
+#   python src/autopdd.py render  project section response.md [--renderer pandoc]
+#   python src/autopdd.py batch   [project ...]
+#
+# The project defaults to project_name in project_config.py. Run from the
+# repository root, like ___main.py.
+
+PROJECTS_FOLDER = "provided_documents"
+
+
+def _project_folder(project):
+    folder = os.path.join(PROJECTS_FOLDER, project)
+    if not os.path.isdir(folder):
+        raise SystemExit(f"Error: Project folder not found at '{folder}'")
+    return folder
+
+
+def _output_path(project):
+    return os.path.join("auto_pdd_output", f"AutoPDD_{project}.docx")
+
+
+def _find_section(outline, section):
+    """The outline entry given by number ("1.2") or part of its subheading."""
+    wanted = section.lower()
+    for i, entry in enumerate(outline):
+        if entry["target"][2] == wanted or wanted in entry["target"][1].lower():
+            return i, entry
+    raise SystemExit(f"Error: No section '{section}' in the template")
+
+
+def cmd_status(args):
+    from context_manifest import load_manifest, scan_folder
+    from context_store import ContextStore, shard_key
+    from context_manager import EXTRACTOR_VERSION, load_dedup_report
+
+    folder = _project_folder(args.project)
+    manifest = load_manifest(folder)
+    current_files = {f for f in os.listdir(folder) if f.lower().endswith(('.pdf', '.docx'))}
+    with ContextStore(folder) as store:
+        _, to_extract, removed = scan_folder(folder, manifest, current_files, EXTRACTOR_VERSION,
+                                             lambda entry: store.has(shard_key(entry)))
+    print(f"Project '{args.project}': {len(current_files)} document(s)")
+    if to_extract:
+        print(f"  To extract: {', '.join(to_extract)}")
+    if removed:
+        print(f"  Removed since last extraction: {', '.join(removed)}")
+    dedup = load_dedup_report(folder)
+    if dedup:
+        print(f"  all_context.txt: {dedup['deduped_bytes']:,} bytes after dedup, "
+              f"{dedup['saved_bytes']:,} bytes (~{dedup['saved_tokens']:,} tokens) saved, "
+              f"{len(dedup['blocks'])} repeated block(s)")
+
+    output_path = _output_path(args.project)
+    if not os.path.exists(output_path):
+        print("No output document yet.")
+        return 0
+    from section_outline import load_template_outline, build_outline
+    from word_editor import load_word_doc_to_string
+
+    pdd_targets, _ = load_template_outline("pdd_template")
+    counts = {}
+    print(f"\n{output_path}:")
+    for section in build_outline(load_word_doc_to_string(output_path), pdd_targets):
+        status = section["status"].split(" ")[0] if section["status"].startswith("SECTION_") else "NOT_STARTED"
+        counts[status] = counts.get(status, 0) + 1
+        print(f"  {section['target'][2]:<6}{status:<20}{section['target'][1]}")
+    print("  " + ", ".join(f"{count} {status}" for status, count in sorted(counts.items())))
+    return 0
+
+
+def cmd_extract(args):
+    from context_manager import extract_text_from_folder
+
+    changed = extract_text_from_folder(_project_folder(args.project), max_workers=args.workers)
+    print("Documents changed since the last run." if changed else "No document changes.")
+    return 0
+
+
+def cmd_fill(args):
+    import ___main
+
+    ___main.headless = args.headless or ___main.headless
+    ___main.fill_project(args.project, args.sections)
+    return 0
+
+
+def cmd_render(args):
+    from section_outline import load_template_outline
+    from word_editor import DocumentSession
+    from _section_filler import finalize_response
+
+    output_path = _output_path(args.project)
+    if not os.path.exists(output_path):
+        raise SystemExit(f"Error: No output document at '{output_path}'; run 'fill' first")
+    _, outline = load_template_outline("pdd_template")
+    _, section = _find_section(outline, args.section)
+    with open(args.markdown, 'r', encoding='utf-8') as f:
+        response = finalize_response(f.read())
+
+    with DocumentSession(output_path, renderer=args.renderer) as output_doc:
+        output_doc.replace_section(section["target"][1], section["end_marker"], response)
+    print(f"{response.split(chr(10))[0]}: {section['target'][1]} -> {output_path}")
+    return 0
+
+
+def cmd_batch(args):
+    import batch
+
+    results = batch.run_batch(args.projects or None)
+    return 1 if not results or any("error" in result for result in results) else 0
+
+
+def _default_project():
+    from project_config import project_name
+    return project_name
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="autopdd", description="AutoPDD: fill a PDD template from project documents.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    status = commands.add_parser("status", help="Show extraction state and section statuses.")
+    status.add_argument("project", nargs="?")
+    status.set_defaults(func=cmd_status)
+
+    extract = commands.add_parser("extract", help="Extract new or changed project documents.")
+    extract.add_argument("project", nargs="?")
+    extract.add_argument("--workers", type=int, default=None, help="Extraction processes (default: all cores).")
+    extract.set_defaults(func=cmd_extract)
+
+    fill = commands.add_parser("fill", help="Fill the project's output document.")
+    fill.add_argument("project", nargs="?")
+    fill.add_argument("-s", "--section", action="append", dest="sections",
+                      help="Only this section, by number or part of its subheading (repeatable).")
+    fill.add_argument("--headless", action="store_true", help="Fill sections concurrently without pausing.")
+    fill.set_defaults(func=cmd_fill)
+
+    render = commands.add_parser("render", help="Write a Markdown response into one section, without the model.")
+    render.add_argument("project")
+    render.add_argument("section", help="Section number or part of its subheading.")
+    render.add_argument("markdown", help="File with the section's Markdown content.")
+    render.add_argument("--renderer", choices=("native", "pandoc"), default="native")
+    render.set_defaults(func=cmd_render)
+
+    batch = commands.add_parser("batch", help="Fill several projects (default: all) with shared resources.")
+    batch.add_argument("projects", nargs="*")
+    batch.set_defaults(func=cmd_batch)
+
+    args = parser.parse_args(argv)
+    if getattr(args, "project", None) is None:
+        args.project = _default_project()
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,135 @@
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import ___main
+from gemini_interface import setup_gemini, RateLimitedAgent
+from gemini_registry import GeminiRegistry
+from context_manager import extract_text_from_folder, load_dedup_report
+from llm_cache import ResponseCache
+from instrumentation import start_trace, print_summary
+from section_outline import load_template_outline
+from field_schema import load_field_schemas
+from rulebook_index import RulebookIndex
+
+# Batch mode: fills every project under provided_documents/ in one process.
+# The template outline is parsed once, extraction for all projects runs on
+# one shared process pool, and the projects share one rate-limited Gemini
+# client (and so its request quota), response cache, upload registry and
+# rulebook index. Each project still gets its own
+# auto_pdd_output/AutoPDD_<project>.docx. Other settings (quotas, retrieval,
+# checkpointing, ...) are taken from ___main.py.
+#
+#   python src/batch.py                  # every project
+#   python src/batch.py prime_road other # just these
+
+# --- CONFIGURATION ---
+projects_folder = "provided_documents"
+max_concurrent_projects = 2  # Projects being filled at the same time (each runs headless).
+
+
+def discover_projects(folder=projects_folder):
+    """Names of the project folders that contain at least one .pdf or .docx."""
+    projects = []
+    for name in sorted(os.listdir(folder)):
+        path = os.path.join(folder, name)
+        if os.path.isdir(path) and any(f.lower().endswith(('.pdf', '.docx')) for f in os.listdir(path)):
+            projects.append(name)
+    return projects
+
+
+def format_batch_summary(results):
+    """Formats the per-project results of run_batch() as a plain-text table."""
+    header = f"{'project':<28}{'sections':>10}{'complete':>10}{'attempted':>11}{'seconds':>10}{'dedup saved':>22}  output"
+    lines = [header, "-" * len(header)]
+    for result in results:
+        if "error" in result:
+            lines.append(f"{result['project']:<28}{'FAILED':>10}  {result['error']}")
+            continue
+        statuses = result["statuses"]
+        dedup = result.get("dedup")
+        saved = f"{dedup['saved_bytes']:,} B / ~{dedup['saved_tokens']:,} tok" if dedup else "-"
+        lines.append(f"{result['project']:<28}{result['sections']:>10}{statuses.get('SECTION_COMPLETE', 0):>10}"
+                     f"{statuses.get('SECTION_ATTEMPTED', 0):>11}{result['seconds']:>10.1f}{saved:>22}  {result['output_path']}")
+    return "\n".join(lines)
+
+
+def run_batch(projects=None):
+    """
+    Fills the given projects (default: every project found) and prints a
+    per-project summary.
+
+    Returns:
+        list: One result dict per project, as from ___main.fill_project(),
+              or {"project", "error"} for a project that failed.
+    """
+    projects = projects or discover_projects()
+    if not projects:
+        print(f"No projects with documents found in '{projects_folder}'.")
+        return []
+    print(f"Batch of {len(projects)} project(s): {', '.join(projects)}")
+    if ___main.trace_run:
+        start_trace(os.path.join(projects_folder, "batch_trace.jsonl"))
+
+    # --- 1. SHARED SETUP ---
+    template = load_template_outline("pdd_template")
+    if ___main.use_field_schemas:
+        # Compiled (and cached) here, before the projects load them concurrently
+        load_field_schemas("pdd_template", template[1])
+    agent = setup_gemini()
+    if agent is None:
+        return []
+    shared = {
+        "gemini": RateLimitedAgent(agent, ___main.requests_per_minute, ___main.max_requests_in_flight,
+                                   ___main.tokens_per_minute, ___main.rate_limit_retries),
+        "llm_cache": ResponseCache(max_bytes=___main.llm_cache_max_mb * 1024 * 1024, bypass=___main.llm_cache_bypass) if ___main.use_llm_cache else None,
+        "gemini_registry": GeminiRegistry(cache_ttl_s=___main.context_cache_minutes * 60) if ___main.reuse_gemini_uploads else None,
+    }
+    if ___main.use_rulebooks:
+        shared["rulebook_index"] = RulebookIndex.build(___main.rulebook_folder)
+
+    # --- 2. EXTRACTION, ON ONE POOL ---
+    changed = {}
+    with ProcessPoolExecutor(max_workers=___main.extraction_workers) as pool:
+        for project in projects:
+            print(f"\n--- Extracting '{project}' ---")
+            changed[project] = extract_text_from_folder(os.path.join(projects_folder, project), pool=pool,
+                                                       dedupe=___main.dedupe_context)
+
+    # --- 3. FILLING ---
+    ___main.headless = True
+
+    def fill(project):
+        print(f"\n--- Filling '{project}' ---")
+        try:
+            # Each project gets its own warm dict (its context index is dropped
+            # when it finishes) around the shared client and cache.
+            result = ___main.fill_project(project, warm=dict(shared), template=template,
+                                          there_are_new_files=changed[project], trace=False)
+        except Exception as e:
+            print(f"Project '{project}' failed: {e}")
+            return {"project": project, "error": f"{type(e).__name__}: {e}"}
+        report = load_dedup_report(os.path.join(projects_folder, project)) if ___main.dedupe_context else None
+        if report:
+            result["dedup"] = {"saved_bytes": report["saved_bytes"], "saved_tokens": report["saved_tokens"]}
+        return result
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_concurrent_projects) as executor:
+        results = list(executor.map(fill, projects))
+
+    print(f"\n--- Batch summary ({time.perf_counter() - started:.1f}s) ---")
+    print(format_batch_summary(results))
+    if shared["llm_cache"]:
+        print(shared["llm_cache"].summary())
+    if shared["gemini_registry"]:
+        print(shared["gemini_registry"].summary())
+    print(shared["gemini"].scheduler.summary())
+    if ___main.trace_run:
+        print_summary()
+    return results
+
+
+if __name__ == "__main__":
+    results = run_batch(sys.argv[1:] or None)
+    sys.exit(1 if not results or any("error" in result for result in results) else 0)
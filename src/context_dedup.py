@@ -0,0 +1,248 @@
+import re
+import hashlib
+from collections import Counter
+from context_index import estimate_tokens
+
+# Bump whenever a change here alters the deduplicated export, so
+# all_context.txt is re-exported.
+DEDUP_VERSION = 1
+
+# A repeated run of text is only replaced by a back-reference if it spans at
+# least this many non-empty lines and characters; shorter repeats ("Source:
+# ADB.", a lone table row) cost about as much to reference as to repeat.
+MIN_BLOCK_LINES = 3
+MIN_BLOCK_CHARS = 200
+
+# A page's first or last line is a running header/footer if it recurs, page
+# numbers aside, on at least this share of a document's pages (and on 3+).
+RUNNING_LINE_SHARE = 0.5
+
+# Rolling hash over the line hashes of a window of MIN_BLOCK_LINES lines.
+_BASE = 1_000_003
+_MOD = (1 << 61) - 1
+_DIGITS_RE = re.compile(r"\d+")
+
+
+def _normalize(line):
+    return " ".join(line.split())
+
+
+def _line_hash(line):
+    return int.from_bytes(hashlib.blake2b(_normalize(line).encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def _running_pattern(line):
+    """A header/footer line with its numbers masked, so "Page 3 of 40" matches "Page 4 of 40"."""
+    return _DIGITS_RE.sub("#", _normalize(line))
+
+
+def running_lines(pages):
+    """
+    Patterns (see _running_pattern()) of the running headers and footers of
+    a document: first or last lines repeated on most of its pages.
+
+    Args:
+        pages (list): (page_number, page_text) tuples.
+    """
+    if len(pages) < 3:
+        return set()
+    counts = Counter()
+    for _, page_text in pages:
+        lines = [line for line in page_text.split("\n") if line.strip()]
+        if lines:
+            counts.update({_running_pattern(lines[0]), _running_pattern(lines[-1])})
+    threshold = max(3, RUNNING_LINE_SHARE * len(pages))
+    return {pattern for pattern, count in counts.items() if count >= threshold}
+
+
+def _strip_running(page_text, patterns, limit=2):
+    """Removes up to `limit` running lines from the top and the bottom of a page."""
+    lines = page_text.split("\n")
+    removed = []
+    for _ in range(limit):
+        while lines and not lines[0].strip():
+            lines.pop(0)
+        if lines and _running_pattern(lines[0]) in patterns:
+            removed.append(lines.pop(0))
+    for _ in range(limit):
+        while lines and not lines[-1].strip():
+            lines.pop()
+        if lines and _running_pattern(lines[-1]) in patterns:
+            removed.append(lines.pop())
+    return "\n".join(lines), removed
+
+
+class BoilerplateDeduper:
+    """
+    Removes boilerplate repeated within and across a project's documents
+    (running headers and footers, disclaimers, repeated tables) before they
+    are exported to all_context.txt.
+
+    Documents are fed in export order, one at a time. Each non-empty line is
+    hashed, and a rolling hash over every window of MIN_BLOCK_LINES lines
+    finds windows seen earlier; a match is extended line by line to the full
+    repeated run. The first occurrence of a block is kept; later ones are
+    replaced by a back-reference to it. Running headers and footers are
+    stripped from every page and stated once per document. Every block,
+    with all the places it occurs, is listed in report().
+
+    Only line hashes are kept between documents, so memory grows with the
+    number of lines, not their text.
+    """
+
+    def __init__(self):
+        self.hashes = []  # line hash of every non-empty line seen so far
+        self.locations = []  # (filename, page_number) of each of those lines
+        self.replaced = bytearray()  # 1 for lines replaced by a reference
+        self.first_window = {}  # window hash -> position of its first occurrence
+        self.blocks = {}  # (first position, lines) -> block
+        self.running = []  # running header/footer blocks
+        self.original_bytes = self.deduped_bytes = 0
+        self.original_tokens = self.deduped_tokens = 0
+
+    def _window_hashes(self, start, end):
+        """Rolling hashes of the windows starting at positions [start, end - MIN_BLOCK_LINES]."""
+        windows = []
+        if end - start < MIN_BLOCK_LINES:
+            return windows
+        top = pow(_BASE, MIN_BLOCK_LINES - 1, _MOD)
+        value = 0
+        for position in range(start, start + MIN_BLOCK_LINES):
+            value = (value * _BASE + self.hashes[position]) % _MOD
+        windows.append(value)
+        for position in range(start + 1, end - MIN_BLOCK_LINES + 1):
+            value = (value - self.hashes[position - 1] * top) % _MOD
+            value = (value * _BASE + self.hashes[position + MIN_BLOCK_LINES - 1]) % _MOD
+            windows.append(value)
+        return windows
+
+    def _find_repeats(self, start, end, line_chars):
+        """
+        Finds runs of lines in positions [start, end) that repeat earlier
+        text. Returns {position: (original position, lines)} for the runs
+        worth replacing.
+        """
+        repeats = {}
+        windows = self._window_hashes(start, end)
+        position = start
+        while position <= end - MIN_BLOCK_LINES:
+            window = windows[position - start]
+            original = self.first_window.get(window)
+            if (original is not None and original + MIN_BLOCK_LINES <= position
+                    and not any(self.replaced[original:original + MIN_BLOCK_LINES])
+                    and self.hashes[original:original + MIN_BLOCK_LINES] == self.hashes[position:position + MIN_BLOCK_LINES]):
+                length = MIN_BLOCK_LINES
+                # A reference must point at text given in full, not at another reference
+                while (position + length < end and original + length < position
+                       and not self.replaced[original + length]
+                       and self.hashes[original + length] == self.hashes[position + length]):
+                    length += 1
+                if sum(line_chars[position - start:position - start + length]) >= MIN_BLOCK_CHARS:
+                    repeats[position] = (original, length)
+                    self.replaced[position:position + length] = b"\x01" * length
+                    position += length
+                    continue
+            self.first_window.setdefault(window, position)
+            position += 1
+        return repeats
+
+    def _block(self, original, length, preview):
+        key = (original, length)
+        if key not in self.blocks:
+            filename, page_number = self.locations[original]
+            self.blocks[key] = {"id": f"B{len(self.blocks) + 1}", "lines": length, "chars": 0, "preview": preview,
+                                "locations": [{"file": filename, "page": page_number}]}
+        return self.blocks[key]
+
+    def dedupe_document(self, filename, pages):
+        """
+        Deduplicates one document against itself and every document fed
+        before it.
+
+        Args:
+            filename (str): The document's filename.
+            pages (list): (page_number, page_text) tuples in page order.
+
+        Returns:
+            str: The document's text, pages joined by newlines as in the
+                 context store, with repeated blocks replaced by references.
+        """
+        original_text = "\n".join(page_text for _, page_text in pages)
+        patterns = running_lines(pages)
+        stripped, running = [], {}
+        for page_number, page_text in pages:
+            if patterns:
+                page_text, removed = _strip_running(page_text, patterns)
+                for line in removed:
+                    pattern = _running_pattern(line)
+                    block = running.setdefault(pattern, {"text": pattern, "locations": []})
+                    block["locations"].append({"file": filename, "page": page_number})
+            stripped.append((page_number, page_text.split("\n")))
+
+        start = len(self.hashes)
+        line_chars = []
+        for page_number, lines in stripped:
+            for line in lines:
+                if line.strip():
+                    self.hashes.append(_line_hash(line))
+                    self.locations.append((filename, page_number))
+                    self.replaced.append(0)
+                    line_chars.append(len(line) + 1)
+        repeats = self._find_repeats(start, len(self.hashes), line_chars)
+
+        out_lines = []
+        for block in running.values():
+            self.running.append({"file": filename, **block})
+            out_lines.append(f"[Running header/footer, removed from {len(block['locations'])} pages: \"{block['text']}\"]"
+                             + (" (# stands for a number)" if "#" in block["text"] else ""))
+        position, skip, page_texts = start, 0, []
+        for page_number, lines in stripped:
+            for line in lines:
+                if not line.strip():
+                    if not skip:
+                        out_lines.append(line)
+                    continue
+                if skip:
+                    skip -= 1
+                elif position in repeats:
+                    original, length = repeats[position]
+                    block = self._block(original, length, _normalize(line)[:60])
+                    block["locations"].append({"file": filename, "page": page_number})
+                    block["chars"] = sum(line_chars[position - start:position - start + length])
+                    first = block["locations"][0]
+                    out_lines.append(f"[Repeated text {block['id']} ({length} lines), given in full in "
+                                     f"\"{first['file']}\", page {first['page']}: \"{block['preview']}...\"]")
+                    skip = length - 1
+                else:
+                    out_lines.append(line)
+                position += 1
+            page_texts.append("\n".join(out_lines))
+            out_lines = []
+
+        text = "\n".join(page_texts)
+        self.original_bytes += len(original_text.encode('utf-8'))
+        self.deduped_bytes += len(text.encode('utf-8'))
+        self.original_tokens += estimate_tokens(original_text) if original_text else 0
+        self.deduped_tokens += estimate_tokens(text) if text else 0
+        return text
+
+    def report(self):
+        """Bytes and tokens saved, and every repeated block with all its locations."""
+        return {
+            "version": DEDUP_VERSION,
+            "original_bytes": self.original_bytes,
+            "deduped_bytes": self.deduped_bytes,
+            "saved_bytes": self.original_bytes - self.deduped_bytes,
+            "saved_tokens": self.original_tokens - self.deduped_tokens,
+            "running_lines": self.running,
+            "blocks": sorted(self.blocks.values(), key=lambda block: int(block["id"][1:])),
+        }
+
+    def summary(self):
+        """One-line summary of report()."""
+        saved = self.original_bytes - self.deduped_bytes
+        places = sum(len(block["locations"]) - 1 for block in self.blocks.values())
+        share = saved / self.original_bytes if self.original_bytes else 0.0
+        return (f"Deduplicated context: {len(self.blocks)} repeated block(s) in {places} place(s), "
+                f"{len(self.running)} running header/footer line(s); saved {saved:,} bytes "
+                f"(~{self.original_tokens - self.deduped_tokens:,} tokens, {share:.0%}).")
@@ -0,0 +1,183 @@
+import os
+import re
+import json
+import math
+import time
+from collections import Counter
+from context_store import ContextStore, STORE_DIRNAME
+from instrumentation import span
+
+INDEX_FILENAME = "chunk_index.json"
+RETRIEVAL_LOG_FILENAME = "retrieval_log.jsonl"
+
+# Chunks never cross a page boundary, so every chunk can be cited by page.
+CHUNK_WORDS = 200
+CHUNK_OVERLAP = 40
+
+# BM25 parameters (the usual defaults).
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+_WORD_RE = re.compile(r"\S+")
+_STOPWORDS = frozenset("""
+a an and are as at be been but by can for from has have if in into is it its
+may must no not of on or such that the their there these this to was were
+which will with within would your you any all other than also should each
+""".split())
+
+
+def tokenize(text):
+    return [t for t in _TOKEN_RE.findall(text.lower()) if len(t) > 1 and t not in _STOPWORDS]
+
+
+def estimate_tokens(text):
+    """Rough token count (~4 characters per token) used for budgeting."""
+    return len(text) // 4 + 1
+
+
+def _chunk_page(page_text):
+    """Splits a page into overlapping word windows. Yields (start, end) character offsets."""
+    words = [m.span() for m in _WORD_RE.finditer(page_text)]
+    if not words:
+        return
+    stride = CHUNK_WORDS - CHUNK_OVERLAP
+    for first in range(0, len(words), stride):
+        last = min(first + CHUNK_WORDS, len(words)) - 1
+        yield words[first][0], words[last][1]
+        if last == len(words) - 1:
+            break
+
+
+class ContextIndex:
+    """
+    BM25 index over page-aware chunks of a project's extracted context.
+
+    The index stores only postings and chunk locations (filename, page and
+    character range); chunk text is read back from the ContextStore when a
+    chunk is selected. It is persisted next to the store and rebuilt only
+    when the set of stored documents changes.
+    """
+
+    def __init__(self, folder_path, chunks, postings, avg_length):
+        self.folder_path = folder_path
+        self.chunks = chunks          # [[filename, page_number, start, end, length], ...]
+        self.postings = postings      # {term: [[chunk_id, term_frequency], ...]}
+        self.avg_length = avg_length
+        self.store = ContextStore(folder_path)
+
+    @classmethod
+    def build(cls, folder_path):
+        """Loads the persisted index for a folder, rebuilding it if the store changed."""
+        store = ContextStore(folder_path)
+        signature = store.signature()
+        index_path = os.path.join(folder_path, STORE_DIRNAME, INDEX_FILENAME)
+        try:
+            with open(index_path, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+            if saved.get("signature") == signature and saved.get("chunk_words") == CHUNK_WORDS:
+                store.close()
+                return cls(folder_path, saved["chunks"], saved["postings"], saved["avg_length"])
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+
+        print("Building context index...")
+        chunks, postings = [], {}
+        for filename in store.filenames():
+            for page_number, page_text in store.iter_pages(filename):
+                for start, end in _chunk_page(page_text):
+                    terms = tokenize(page_text[start:end])
+                    chunk_id = len(chunks)
+                    chunks.append([filename, page_number, start, end, len(terms)])
+                    for term, frequency in Counter(terms).items():
+                        postings.setdefault(term, []).append([chunk_id, frequency])
+        store.close()
+        avg_length = sum(chunk[4] for chunk in chunks) / len(chunks) if chunks else 0.0
+
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        with open(index_path + ".tmp", 'w', encoding='utf-8') as f:
+            json.dump({"signature": signature, "chunk_words": CHUNK_WORDS, "chunks": chunks,
+                       "postings": postings, "avg_length": avg_length}, f)
+        os.replace(index_path + ".tmp", index_path)
+        print(f"...indexed {len(chunks)} chunks.")
+        return cls(folder_path, chunks, postings, avg_length)
+
+    def search(self, query, filenames=None):
+        """
+        Returns [(chunk_id, score), ...] sorted by descending BM25 score,
+        optionally only for chunks of the given filenames.
+        """
+        n = len(self.chunks)
+        scores = {}
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for chunk_id, frequency in postings:
+                if filenames is not None and self.chunks[chunk_id][0] not in filenames:
+                    continue
+                length_norm = 1 - BM25_B + BM25_B * self.chunks[chunk_id][4] / (self.avg_length or 1)
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * frequency * (BM25_K1 + 1) / (frequency + BM25_K1 * length_norm)
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+
+    def chunk_text(self, chunk_id):
+        filename, page_number, start, end, _ = self.chunks[chunk_id]
+        return self.store.read_page(filename, page_number)[start:end]
+
+    def select(self, query, top_k=12, token_budget=8000, filenames=None):
+        """
+        Picks the best-scoring chunks for a query, up to top_k chunks and
+        token_budget estimated tokens. If filenames is given, only chunks of
+        those documents are considered.
+
+        Returns:
+            list: dicts with filename, page, score, tokens and text, in score order.
+        """
+        selected, used = [], 0
+        for chunk_id, score in self.search(query, filenames):
+            if len(selected) >= top_k:
+                break
+            text = self.chunk_text(chunk_id)
+            tokens = estimate_tokens(text)
+            if used + tokens > token_budget:
+                continue
+            filename, page_number = self.chunks[chunk_id][:2]
+            selected.append({"filename": filename, "page": page_number, "score": round(score, 3),
+                             "tokens": tokens, "text": text})
+            used += tokens
+        return selected
+
+    def context_for_section(self, section_name, query, top_k=12, token_budget=8000, filenames=None):
+        """
+        Selects chunks for one PDD section, logs the selection, and returns
+        them formatted as a single context string for the prompt.
+        """
+        with span("retrieval", section=section_name) as s:
+            selected = self.select(query, top_k, token_budget, filenames)
+            s["chunks"] = len(selected)
+            s["context_tokens"] = sum(chunk['tokens'] for chunk in selected)
+        log_retrieval(self.folder_path, section_name, selected)
+        return format_chunks(selected)
+
+
+def format_chunks(selected):
+    """Formats selected chunks with their source so the model can cite them."""
+    return "\n\n".join(
+        f"--- {chunk['filename']}, page {chunk['page']} ---\n{chunk['text']}" for chunk in selected
+    )
+
+
+def log_retrieval(folder_path, section_name, selected):
+    """Prints which pages fed a section and appends the selection to retrieval_log.jsonl."""
+    pages = ", ".join(f"{chunk['filename']} p.{chunk['page']}" for chunk in selected)
+    total = sum(chunk['tokens'] for chunk in selected)
+    print(f"  > Retrieved {len(selected)} chunk(s), ~{total} tokens: {pages or 'none'}")
+    record = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "section": section_name,
+        "tokens": total,
+        "chunks": [{k: chunk[k] for k in ("filename", "page", "score", "tokens")} for chunk in selected],
+    }
+    with open(os.path.join(folder_path, RETRIEVAL_LOG_FILENAME), 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record) + "\n")
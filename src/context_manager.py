@@ -1,76 +1,306 @@
 import os
 import json
-import pdfplumber
-import docx
+from concurrent.futures import ProcessPoolExecutor
+from lazy_import import lazy_import
+from context_manifest import load_manifest, save_manifest, scan_folder
+from context_store import ContextStore, shard_key, STORE_DIRNAME
+from context_dedup import BoilerplateDeduper, DEDUP_VERSION
+from instrumentation import span
 
-def _extract_text_from_file(file_path):
+pdfplumber = lazy_import("pdfplumber")
+docx = lazy_import("docx")
+
+# Number of PDF pages handled by a single worker task. Small enough that a
+# few large proposals still spread across every core, large enough that the
+# cost of re-opening the PDF in each worker stays negligible.
+PAGES_PER_SHARD = 25
+
+# Bump whenever a change to the extraction code alters its output, so cached
+# results produced by older code are re-extracted.
+EXTRACTOR_VERSION = 1
+
+# Where _export_context() writes the boilerplate dedup report, in the project folder.
+DEDUP_REPORT_PATH = os.path.join(STORE_DIRNAME, "dedup_report.json")
+
+
+def _table_to_markdown(table):
+    """Converts a list-of-rows table (as returned by pdfplumber) to Markdown."""
+    header = "| " + " | ".join(str(cell) if cell is not None else '' for cell in table[0]) + " |"
+    separator = "| " + " | ".join(["---"] * len(table[0])) + " |"
+    rows = ["| " + " | ".join(str(cell) if cell is not None else '' for cell in row) + " |" for row in table[1:]]
+    return "\n".join([header, separator] + rows)
+
+
+def _has_ruling(page):
+    """
+    True if a page has at least two horizontal and two vertical ruling edges
+    (from lines, rectangles or curves). pdfplumber's default "lines" table
+    strategy builds every cell from two of each, so on any other page (prose,
+    or just a header rule) table finding is skipped. The edges are cached on
+    the page and reused by extract_tables().
+    """
+    counts = {"h": 0, "v": 0}
+    for edge in page.edges:
+        counts[edge["orientation"]] += 1
+        if counts["h"] >= 2 and counts["v"] >= 2:
+            return True
+    return False
+
+
+def _extract_pdf_pages(file_path, start_page, end_page):
+    """
+    Extracts text and tables from pages [start_page, end_page) of a PDF.
+
+    Each page's layout objects (characters, lines, rectangles) are parsed
+    once and shared by the text and table extraction, then released with
+    page.close() before the next page, so memory stays flat however long
+    the document is.
+
+    Returns:
+        list: (page_number, page_text) tuples in page order. Pages that
+              yield no text and no tables are omitted.
+    """
+    pages = []
+    with pdfplumber.open(file_path) as pdf:
+        for i in range(start_page, min(end_page, len(pdf.pages))):
+            with span("extract.page", file=os.path.basename(file_path), page=i + 1) as s:
+                page = pdf.pages[i]
+                try:
+                    content_parts = []
+                    page_text = page.extract_text()
+                    if page_text:
+                        content_parts.append(page_text)
+
+                    # Extract tables and convert to Markdown
+                    ruled = _has_ruling(page)
+                    tables = page.extract_tables() if ruled else []
+                    for table in tables:
+                        if not table: continue
+                        content_parts.append(f"\n\n--- Table on Page {i+1} ---\n{_table_to_markdown(table)}\n")
+                finally:
+                    page.close()
+
+                if content_parts:
+                    pages.append((i + 1, "\n".join(content_parts)))
+                s["chars"] = sum(len(part) for part in content_parts)
+                s["tables"] = len(tables)
+                s["ruled"] = ruled
+    return pages
+
+
+def _extract_docx(file_path):
+    """
+    Extracts paragraphs and tables from a .docx file. Word documents have no
+    fixed pagination, so the whole file is returned as page 1.
+    """
+    content_parts = []
+    with span("extract.docx", file=os.path.basename(file_path)) as s:
+        doc = docx.Document(file_path)
+        for para in doc.paragraphs:
+            content_parts.append(para.text)
+
+        # Extract tables and convert to Markdown
+        for i, table in enumerate(doc.tables):
+            if not table.rows: continue
+            header_cells = table.rows[0].cells
+            header = "| " + " | ".join(cell.text.strip() for cell in header_cells) + " |"
+            separator = "| " + " | ".join(["---"] * len(header_cells)) + " |"
+            rows = ["| " + " | ".join(cell.text.strip() for cell in row.cells) + " |" for row in table.rows[1:]]
+            markdown_table = "\n".join([header, separator] + rows)
+            content_parts.append(f"\n\n--- Table {i+1} ---\n{markdown_table}\n")
+        s["chars"] = sum(len(part) for part in content_parts)
+
+    return [(1, "\n".join(content_parts))] if content_parts else []
+
+
+def _plan_shards(file_path, pages_per_shard=PAGES_PER_SHARD):
+    """
+    Splits a file into independent extraction tasks.
+
+    Returns:
+        list: (function, args) tuples whose results, concatenated in order,
+              give the file's pages in page order.
+    """
+    if file_path.lower().endswith('.pdf'):
+        with pdfplumber.open(file_path) as pdf:
+            page_count = len(pdf.pages)
+        return [
+            (_extract_pdf_pages, (file_path, start, start + pages_per_shard))
+            for start in range(0, page_count, pages_per_shard)
+        ]
+    elif file_path.lower().endswith('.docx'):
+        return [(_extract_docx, (file_path,))]
+    return []
+
+
+def _run_shard(func, args):
+    # Top-level so it can be pickled for the process pool.
+    return func(*args)
+
+
+def _collect_pages(file_path, shard_results):
+    """
+    Concatenates shard results (lists of (page_number, page_text)) into the
+    file's pages. shard_results may be a lazy iterable, so extraction errors
+    raised by a shard are caught here.
+
+    Returns:
+        list: (page_number, page_text) tuples in page order, or None if any
+              shard failed.
+    """
+    try:
+        return [page for result in shard_results for page in result]
+    except Exception as e:
+        print(f"Could not process file '{os.path.basename(file_path)}'. Reason: {e}")
+        return None
+
+
+def _extract_text_from_file(file_path, pages_per_shard=PAGES_PER_SHARD):
     """
     A helper function to extract text and tables from a single file.
     
     Args:
         file_path (str): The full path to the .pdf or .docx file.
+        pages_per_shard (int): Number of PDF pages extracted per task.
     
     Returns:
         str: The extracted text content, with tables in Markdown format.
              Returns an empty string if the file cannot be processed.
     """
-    content_parts = []
-    filename = os.path.basename(file_path)
+    for _, pages in _extract_files([file_path], max_workers=1, pages_per_shard=pages_per_shard):
+        return "\n".join(page_text for _, page_text in pages or [])
 
-    try:
-        # --- Handle PDF files ---
-        if filename.lower().endswith('.pdf'):
-            with pdfplumber.open(file_path) as pdf:
-                for i, page in enumerate(pdf.pages):
-                    page_text = page.extract_text()
-                    if page_text:
-                        content_parts.append(page_text)
-                    
-                    # Extract tables and convert to Markdown
-                    tables = page.extract_tables()
-                    for table in tables:
-                        if not table: continue
-                        header = "| " + " | ".join(str(cell) if cell is not None else '' for cell in table[0]) + " |"
-                        separator = "| " + " | ".join(["---"] * len(table[0])) + " |"
-                        rows = ["| " + " | ".join(str(cell) if cell is not None else '' for cell in row) + " |" for row in table[1:]]
-                        markdown_table = "\n".join([header, separator] + rows)
-                        content_parts.append(f"\n\n--- Table on Page {i+1} ---\n{markdown_table}\n")
-
-        # --- Handle Word (.docx) files ---
-        elif filename.lower().endswith('.docx'):
-            doc = docx.Document(file_path)
-            for para in doc.paragraphs:
-                content_parts.append(para.text)
-            
-            # Extract tables and convert to Markdown
-            for i, table in enumerate(doc.tables):
-                if not table.rows: continue
-                header_cells = table.rows[0].cells
-                header = "| " + " | ".join(cell.text.strip() for cell in header_cells) + " |"
-                separator = "| " + " | ".join(["---"] * len(header_cells)) + " |"
-                rows = ["| " + " | ".join(cell.text.strip() for cell in row.cells) + " |" for row in table.rows[1:]]
-                markdown_table = "\n".join([header, separator] + rows)
-                content_parts.append(f"\n\n--- Table {i+1} ---\n{markdown_table}\n")
 
-    except Exception as e:
-        print(f"Could not process file '{filename}'. Reason: {e}")
-        return "" # Return empty string on failure
+def extract_pages(file_path, max_workers=None, pages_per_shard=PAGES_PER_SHARD):
+    """
+    Extracts a single .pdf/.docx file outside any project folder (e.g. a
+    rulebook), on the same sharded extractor.
+
+    Returns:
+        list: (page_number, page_text) tuples in page order, empty if the
+              file could not be processed.
+    """
+    for _, pages in _extract_files([file_path], max_workers, pages_per_shard):
+        return pages or []
+
+
+def _extract_files(file_paths, max_workers=None, pages_per_shard=PAGES_PER_SHARD, pool=None):
+    """
+    Extracts several files on one process pool, sharded by file and by page
+    range. Results are yielded per file in the order of file_paths, so the
+    output (and progress printing) is deterministic regardless of which
+    shard finishes first.
+
+    Args:
+        file_paths (list): Paths of the .pdf/.docx files to extract.
+        max_workers (int): Size of the process pool. None uses every core;
+                           1 extracts in-process without a pool.
+        pages_per_shard (int): Number of PDF pages extracted per task.
+        pool (ProcessPoolExecutor): An existing pool to run the shards on
+                                    (left open), instead of a new one.
+
+    Yields:
+        tuple: (file_path, pages). pages is a list of (page_number, page_text)
+               tuples (empty for a file with no text), or None if the file
+               could not be processed.
+    """
+    plans = {}
+    for file_path in file_paths:
+        try:
+            plans[file_path] = _plan_shards(file_path, pages_per_shard)
+        except Exception as e:
+            print(f"Could not process file '{os.path.basename(file_path)}'. Reason: {e}")
 
-    return "\n".join(content_parts)
+    if pool is None and (max_workers == 1 or sum(len(shards) for shards in plans.values()) <= 1):
+        for file_path in file_paths:
+            if file_path not in plans:
+                yield file_path, None
+                continue
+            shard_results = (func(*args) for func, args in plans[file_path])
+            yield file_path, _collect_pages(file_path, shard_results)
+        return
 
+    if pool is not None:
+        yield from _extract_on_pool(pool, file_paths, plans)
+        return
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        yield from _extract_on_pool(pool, file_paths, plans)
 
-def extract_text_from_folder(folder_path):
+
+def _extract_on_pool(pool, file_paths, plans):
+    # Submit everything up front so the pool stays saturated while we
+    # collect results file by file.
+    futures = {
+        file_path: [pool.submit(_run_shard, func, args) for func, args in shards]
+        for file_path, shards in plans.items()
+    }
+    for file_path in file_paths:
+        if file_path not in futures:
+            yield file_path, None
+            continue
+        shard_results = (future.result() for future in futures[file_path])
+        yield file_path, _collect_pages(file_path, shard_results)
+
+
+def _export_context(folder_path, txt_filepath, dedupe=True):
+    """
+    Exports the folder's context store to all_context.txt. With dedupe,
+    boilerplate repeated within and across documents is written once (see
+    context_dedup.py), and the repeated blocks, with every place they occur,
+    are saved to DEDUP_REPORT_PATH.
+    """
+    deduper = BoilerplateDeduper() if dedupe else None
+    with span("extract.export", dedupe=dedupe) as s:
+        with ContextStore(folder_path) as store:
+            s["documents"] = store.export_blob(txt_filepath, deduper)
+        if deduper is None:
+            return
+        report = deduper.report()
+        s["saved_bytes"] = report["saved_bytes"]
+        s["saved_tokens"] = report["saved_tokens"]
+
+    report_path = os.path.join(folder_path, DEDUP_REPORT_PATH)
+    os.makedirs(os.path.dirname(report_path), exist_ok=True)
+    with open(report_path + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=4)
+    os.replace(report_path + ".tmp", report_path)
+    print(deduper.summary())
+
+
+def load_dedup_report(folder_path):
+    """The folder's last boilerplate dedup report (see _export_context()), or None."""
+    try:
+        with open(os.path.join(folder_path, DEDUP_REPORT_PATH), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def extract_text_from_folder(folder_path, max_workers=None, pages_per_shard=PAGES_PER_SHARD, pool=None, dedupe=True):
     """
-    Extracts text from PDF and Word files in a folder and maintains a TXT
-    file containing the content in a structured (JSON) format, updating it 
-    with any new or deleted files.
+    Extracts text from PDF and Word files in a folder into the folder's
+    context store (one shard per document, see context_store.py), and
+    exports all_context.txt - the single JSON text file uploaded to Gemini -
+    whenever the set of documents changes.
+
+    What needs extracting is decided by a content-hash manifest (see
+    context_manifest.py), not by filename: unchanged files are never parsed
+    again, renamed files reuse their stored result, and a revised file saved
+    under the same name is re-extracted.
 
     Args:
         folder_path (str): The absolute or relative path to the folder.
+        max_workers (int): Number of extraction processes. None uses every
+                           core; 1 disables the process pool.
+        pages_per_shard (int): Number of PDF pages extracted per task.
+        pool (ProcessPoolExecutor): A pool shared with other folders (see
+                                    batch.py); max_workers is then ignored.
+        dedupe (bool): Write boilerplate repeated within and across the
+                       documents to all_context.txt only once.
 
     Returns:
-        bool: True if the TXT file was modified (files added/removed),
-              False otherwise.
+        bool: True if the folder's content changed since the last run (files
+              added, modified or removed), False otherwise.
     """
     if not os.path.isdir(folder_path):
         print(f"Error: Folder not found at '{folder_path}'")
@@ -78,67 +308,64 @@ def extract_text_from_folder(folder_path):
 
     # The only change needed is the file extension
     txt_filepath = os.path.join(folder_path, "all_context.txt")
-    changes_made = False
-
-    # 1. Load existing data from all_context.txt or create an empty list
-    try:
-        with open(txt_filepath, 'r', encoding='utf-8') as f:
-            # Read the file's text content, then parse it as JSON
-            all_context = json.loads(f.read())
-    except (FileNotFoundError, json.JSONDecodeError):
-        all_context = []
-    
-    # Get a set of filenames we already have processed
-    known_files = {entry['filename'] for entry in all_context}
 
-    # Get a set of current .pdf and .docx files in the folder
+    # 1. Compare the folder against the manifest (size/mtime first, then hash)
+    manifest = load_manifest(folder_path)
     current_files = {
         f for f in os.listdir(folder_path) 
         if f.lower().endswith(('.pdf', '.docx'))
     }
+    with ContextStore(folder_path) as store:
+        has_result = lambda entry: store.has(shard_key(entry))
+        with span("extract.scan", files=len(current_files)):
+            entries, files_to_extract, files_removed = scan_folder(folder_path, manifest, current_files, EXTRACTOR_VERSION, has_result)
 
-    # 2. Handle deletions
-    files_to_remove = known_files - current_files
-    if files_to_remove:
-        print(f"Files removed: {', '.join(files_to_remove)}")
-        all_context = [
-            entry for entry in all_context 
-            if entry['filename'] not in files_to_remove
-        ]
-        changes_made = True
-
-    # 3. Handle additions
-    files_to_add = current_files - known_files
-    if files_to_add:
-        print(f"New files found: {', '.join(files_to_add)}")
-        for filename in files_to_add:
-            file_path = os.path.join(folder_path, filename)
-            print(f"-> Processing: {filename}")
-            
-            text_content = _extract_text_from_file(file_path)
-            
-            if text_content:
-                all_context.append({
-                    'filename': filename,
-                    'text_content': text_content
-                })
-                print(f"   ...extracted {len(text_content)} characters.")
-                changes_made = True
-
-    # 4. Save the updated data back to the TXT file if any changes were made
-    if changes_made:
+        if files_removed:
+            print(f"Files removed: {', '.join(files_removed)}")
+
+        # 2. Parse only files whose bytes are not in the store yet. Each one
+        #    writes its own shard; nothing else in the store is touched.
+        if files_to_extract:
+            print(f"New or changed files found: {', '.join(files_to_extract)}")
+            file_paths = [os.path.join(folder_path, filename) for filename in files_to_extract]
+            with span("extract.files", files=len(file_paths)):
+                for file_path, pages in _extract_files(file_paths, max_workers, pages_per_shard, pool):
+                    filename = os.path.basename(file_path)
+                    print(f"-> Processing: {filename}")
+                    if pages is None:
+                        # Left out of the manifest and the store, so the next run tries again
+                        print("   ...failed; it will be retried on the next run.")
+                        del entries[filename]
+                        continue
+                    # Empty results (files with no text) are stored too, so they are not re-parsed on every run.
+                    with span("extract.store", file=filename, pages=len(pages)):
+                        store.write(shard_key(entries[filename]), pages)
+                    if pages:
+                        print(f"   ...extracted {sum(len(page_text) for _, page_text in pages)} characters from {len(pages)} page(s).")
+
+        old_hashes = {entry['sha256'] for entry in manifest['files'].values()}
+        new_hashes = {entry['sha256'] for entry in entries.values()}
+        changes_made = old_hashes != new_hashes
+        listing_changed = {f: e['sha256'] for f, e in manifest['files'].items()} != {f: e['sha256'] for f, e in entries.items()}
+
+        manifest['files'] = entries
+        save_manifest(folder_path, manifest)
+        store.prune({shard_key(entry) for entry in entries.values()})
+
+    # 3. Re-export all_context.txt if the listing (or the dedup setting) changed
+    export_settings = {"dedup_version": DEDUP_VERSION if dedupe else 0}
+    if listing_changed or manifest.get("export") != export_settings or not os.path.exists(txt_filepath):
         print(f"\nSaving changes to '{txt_filepath}'...")
         try:
-            with open(txt_filepath, 'w', encoding='utf-8') as f:
-                # Convert the Python list to a JSON-formatted string
-                json_string = json.dumps(all_context, indent=4)
-                # Write that string to the .txt file
-                f.write(json_string)
+            _export_context(folder_path, txt_filepath, dedupe)
             print("...Success!")
         except Exception as e:
             print(f"Error saving the TXT file: {e}")
             return False
-    else:
+        manifest["export"] = export_settings
+        save_manifest(folder_path, manifest)
+
+    if not changes_made:
         print("\nNo changes detected. Content is up-to-date.")
 
-    return changes_made
\ No newline at end of file
+    return changes_made
@@ -0,0 +1,98 @@
+import os
+import json
+import hashlib
+
+MANIFEST_FILENAME = "context_manifest.json"
+
+
+def file_sha256(file_path, chunk_size=1 << 20):
+    """Returns the hex SHA-256 of a file's bytes, read in chunks."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_manifest(folder_path):
+    """
+    Loads the extraction manifest of a project folder.
+
+    The manifest maps each filename to the content hash, size and mtime it had
+    when it was last extracted, plus the extractor version that produced the
+    cached result:
+
+        {"files": {"report.pdf": {"sha256": ..., "size": ..., "mtime_ns": ...,
+                                  "extractor_version": ...}}}
+
+    Returns:
+        dict: The manifest, or an empty one if none exists or it is corrupt.
+    """
+    manifest_path = os.path.join(folder_path, MANIFEST_FILENAME)
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {"files": {}}
+    manifest.setdefault("files", {})
+    return manifest
+
+
+def save_manifest(folder_path, manifest):
+    """Writes the manifest atomically so a crash never leaves it half-written."""
+    manifest_path = os.path.join(folder_path, MANIFEST_FILENAME)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(tmp_path, manifest_path)
+
+
+def scan_folder(folder_path, manifest, current_files, extractor_version, has_result):
+    """
+    Compares the files currently in a folder against the manifest.
+
+    Size and mtime are checked first; a file is only hashed when they differ
+    from the manifest entry. A file whose hash already has a stored result
+    (e.g. it was renamed, or reverted to an earlier revision) is not parsed
+    again.
+
+    Args:
+        folder_path (str): The project folder.
+        manifest (dict): As returned by load_manifest().
+        current_files (iterable): Filenames of the .pdf/.docx files present.
+        extractor_version (int): Version of the extractor in use.
+        has_result (callable): has_result(entry) -> True if the extraction
+                               result for a manifest entry is already stored.
+
+    Returns:
+        tuple: (entries, to_extract, removed)
+            entries: {filename: manifest entry} for every current file. Entries
+                     of files in to_extract do not have a stored result yet.
+            to_extract: Sorted filenames whose content must be parsed.
+            removed: Sorted filenames in the manifest that no longer exist.
+    """
+    known = manifest["files"]
+    entries, to_extract = {}, []
+
+    for filename in sorted(current_files):
+        stat = os.stat(os.path.join(folder_path, filename))
+        entry = known.get(filename)
+        if (entry and entry.get("size") == stat.st_size and entry.get("mtime_ns") == stat.st_mtime_ns
+                and entry.get("extractor_version") == extractor_version
+                and has_result(entry)):
+            entries[filename] = entry
+            continue
+
+        sha256 = file_sha256(os.path.join(folder_path, filename))
+        entries[filename] = {
+            "sha256": sha256,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "extractor_version": extractor_version,
+        }
+        if not has_result(entries[filename]):
+            to_extract.append(filename)
+
+    removed = sorted(set(known) - set(entries))
+    return entries, to_extract, removed
+
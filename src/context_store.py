@@ -0,0 +1,216 @@
+import os
+import json
+import mmap
+from context_manifest import load_manifest
+
+STORE_DIRNAME = ".context_store"
+
+
+def shard_key(entry):
+    """The store key of a manifest entry: content hash plus extractor version."""
+    return f"{entry['sha256']}-v{entry['extractor_version']}"
+
+
+class ContextStore:
+    """
+    On-disk store of extracted document text, one shard per document.
+
+    Each document lives in its own UTF-8 shard file (shards/<key>.txt) next to
+    a small offset index (shards/<key>.idx.json) giving the byte range of every
+    page. Shards are keyed by content hash, so adding or removing a document
+    only ever writes or deletes that document's two files. Reads memory-map the
+    shard and decode only the bytes asked for, so looking up one page of a
+    large proposal does not load the whole folder's context into memory.
+
+    Filenames are resolved to shards through the folder's extraction manifest
+    (see context_manifest.py).
+    """
+
+    def __init__(self, folder_path):
+        self.folder_path = folder_path
+        self.shard_dir = os.path.join(folder_path, STORE_DIRNAME, "shards")
+        self._maps = {}
+        self._indexes = {}
+        self._keys = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for mapped, f in self._maps.values():
+            if mapped is not None:
+                mapped.close()
+            f.close()
+        self._maps.clear()
+        self._indexes.clear()
+
+    # --- Writing ---
+
+    def _paths(self, key):
+        base = os.path.join(self.shard_dir, key)
+        return base + ".txt", base + ".idx.json"
+
+    def has(self, key):
+        return all(os.path.exists(path) for path in self._paths(key))
+
+    def write(self, key, pages):
+        """
+        Writes one document's shard.
+
+        Args:
+            key (str): The shard key (see shard_key()).
+            pages (list): (page_number, page_text) tuples in page order.
+        """
+        os.makedirs(self.shard_dir, exist_ok=True)
+        text_path, index_path = self._paths(key)
+        offsets = []
+        position = 0
+        with open(text_path + ".tmp", 'wb') as f:
+            for i, (page_number, page_text) in enumerate(pages):
+                # Pages are separated by a newline, so the shard's text is
+                # exactly what the single-blob extraction used to produce.
+                if i:
+                    f.write(b"\n")
+                    position += 1
+                data = page_text.encode('utf-8')
+                f.write(data)
+                offsets.append([page_number, position, position + len(data)])
+                position += len(data)
+        with open(index_path + ".tmp", 'w', encoding='utf-8') as f:
+            json.dump({"pages": offsets, "size": position}, f)
+        # The index is published last: a shard without an index is incomplete.
+        os.replace(text_path + ".tmp", text_path)
+        os.replace(index_path + ".tmp", index_path)
+
+    def remove(self, key):
+        self._release(key)
+        for path in reversed(self._paths(key)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def prune(self, keep_keys):
+        """Deletes every shard whose key is not in keep_keys."""
+        if not os.path.isdir(self.shard_dir):
+            return
+        for name in os.listdir(self.shard_dir):
+            key = name.split(".", 1)[0]
+            if key not in keep_keys:
+                self._release(key)
+                os.remove(os.path.join(self.shard_dir, name))
+
+    # --- Reading ---
+
+    def _release(self, key):
+        if key in self._maps:
+            mapped, f = self._maps.pop(key)
+            if mapped is not None:
+                mapped.close()
+            f.close()
+        self._indexes.pop(key, None)
+
+    def _index(self, key):
+        if key not in self._indexes:
+            with open(self._paths(key)[1], 'r', encoding='utf-8') as f:
+                self._indexes[key] = json.load(f)
+        return self._indexes[key]
+
+    def _map(self, key):
+        if key not in self._maps:
+            f = open(self._paths(key)[0], 'rb')
+            # mmap refuses zero-length files; an empty shard has nothing to read anyway.
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self._index(key)["size"] else None
+            self._maps[key] = (mapped, f)
+        return self._maps[key][0]
+
+    def _read_range(self, key, start, end):
+        mapped = self._map(key)
+        return mapped[start:end].decode('utf-8') if mapped is not None else ""
+
+    def _load_keys(self):
+        if self._keys is None:
+            manifest = load_manifest(self.folder_path)
+            self._keys = {name: shard_key(entry) for name, entry in manifest["files"].items()}
+        return self._keys
+
+    def _key_for(self, filename):
+        return self._load_keys()[filename]
+
+    def filenames(self):
+        """Filenames of the documents in the store, in manifest order."""
+        return [name for name, key in self._load_keys().items() if self.has(key)]
+
+    def documents(self):
+        """{filename: shard key} of the documents in the store."""
+        return {name: key for name, key in self._load_keys().items() if self.has(key)}
+
+    def signature(self):
+        """
+        Sorted [filename, key] pairs of every stored document; changes whenever
+        the content set does, and when a document is renamed (chunks are
+        located by filename).
+        """
+        return sorted([name, key] for name, key in self.documents().items())
+
+    def page_numbers(self, filename):
+        return [page_number for page_number, _, _ in self._index(self._key_for(filename))["pages"]]
+
+    def read_document(self, filename):
+        """Returns the full extracted text of a document."""
+        key = self._key_for(filename)
+        return self._read_range(key, 0, self._index(key)["size"])
+
+    def read_page(self, filename, page_number):
+        """
+        Returns the text of one page of a document, or None if the page has
+        no extracted content.
+        """
+        key = self._key_for(filename)
+        for number, start, end in self._index(key)["pages"]:
+            if number == page_number:
+                return self._read_range(key, start, end)
+        return None
+
+    def iter_pages(self, filename):
+        """Yields (page_number, page_text) for every page of a document."""
+        key = self._key_for(filename)
+        for number, start, end in self._index(key)["pages"]:
+            yield number, self._read_range(key, start, end)
+
+    # --- Export ---
+
+    def export_blob(self, out_path, deduper=None):
+        """
+        Writes every non-empty document into a single JSON text file, in the
+        same format as the old monolithic all_context.txt (a list of
+        {"filename", "text_content"} objects, indented by 4), which is what
+        upload_files_to_gemini() sends to the model.
+
+        Documents are streamed one at a time, so memory stays bounded by the
+        largest single document rather than the whole folder.
+
+        Args:
+            out_path (str): Where to write the file.
+            deduper (BoilerplateDeduper): If given, each document's text is
+                passed through it (see context_dedup.py), in export order.
+        """
+        tmp_path = out_path + ".tmp"
+        written = 0
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write("[")
+            for filename in self.filenames():
+                if deduper is not None:
+                    text_content = deduper.dedupe_document(filename, list(self.iter_pages(filename)))
+                else:
+                    text_content = self.read_document(filename)
+                if not text_content:
+                    continue
+                entry = json.dumps({'filename': filename, 'text_content': text_content}, indent=4)
+                f.write(",\n" if written else "\n")
+                f.write("\n".join("    " + line for line in entry.split("\n")))
+                written += 1
+            f.write("\n]" if written else "]")
+        os.replace(tmp_path, out_path)
+        return written
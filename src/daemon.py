@@ -0,0 +1,279 @@
+import os
+import sys
+import json
+import time
+import hmac
+import secrets
+import argparse
+import importlib
+import threading
+import urllib.request
+import urllib.error
+from contextlib import redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# A long-running AutoPDD service, so repeated runs during document review
+# don't pay for imports, model setup, uploads and index loading every time.
+#
+#   python src/daemon.py serve                      # start the service (foreground)
+#   python src/daemon.py fill prime_road            # fill a project through it
+#   python src/daemon.py fill prime_road -s "1.3"   # only sections matching "1.3"
+#   python src/daemon.py status | stop
+#
+# The service listens on localhost only. Jobs run one at a time, in headless
+# mode; a job's progress messages are streamed back to the client as they
+# are printed. The client half of this file uses only the standard library,
+# so submitting a job starts instantly.
+#
+# Any local web page can send requests to localhost, so /fill and /stop only
+# accept JSON (which a page can't send cross-origin without a preflight the
+# daemon never answers) carrying the daemon's token. The token is created
+# on every start and written to TOKEN_PATH, readable only by the user who
+# started the daemon; the client reads it from there.
+
+DEFAULT_PORT = 8765
+TOKEN_PATH = os.path.join(".llm_cache", "daemon_token")
+TOKEN_HEADER = "X-AutoPDD-Token"
+PROJECTS_FOLDER = "provided_documents"
+JOB_DONE = "JOB_DONE"
+JOB_FAILED = "JOB_FAILED"
+
+
+class _StreamWriter:
+    """File-like object that forwards printed text to an HTTP response."""
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.connected = True
+        self._lock = threading.Lock()
+
+    def write(self, text):
+        if not text or not self.connected:
+            return len(text)
+        with self._lock:
+            try:
+                self.wfile.write(text.encode('utf-8'))
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                # The client went away; the job carries on without it.
+                self.connected = False
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # HTTP/1.0: the streamed body ends when the connection closes.
+    protocol_version = "HTTP/1.0"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != "/status":
+            return self._send_json(404, {"error": "not found"})
+        self._send_json(200, self.server.status())
+
+    def do_POST(self):
+        if self.path not in ("/stop", "/fill"):
+            return self._send_json(404, {"error": "not found"})
+        if self.headers.get("Content-Type", "").split(";")[0].strip() != "application/json":
+            return self._send_json(415, {"error": "expected Content-Type: application/json"})
+        if not hmac.compare_digest(self.headers.get(TOKEN_HEADER, ""), self.server.token):
+            return self._send_json(403, {"error": f"missing or wrong {TOKEN_HEADER}"})
+        if self.path == "/stop":
+            self._send_json(200, {"stopping": True})
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            project = request["project"]
+        except (ValueError, KeyError):
+            return self._send_json(400, {"error": "expected JSON with a 'project'"})
+        if project not in list_projects():
+            return self._send_json(400, {"error": f"no project folder '{project}' in {PROJECTS_FOLDER}/"})
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.end_headers()
+        self.server.run_job(project, request.get("sections"), _StreamWriter(self.wfile))
+
+
+def list_projects(folder=PROJECTS_FOLDER):
+    """Names of the project folders under provided_documents/: the only projects a job may name."""
+    try:
+        return [name for name in os.listdir(folder) if os.path.isdir(os.path.join(folder, name))]
+    except FileNotFoundError:
+        return []
+
+
+def _write_token(path=TOKEN_PATH):
+    """Creates a new daemon token, readable only by this user, and returns it."""
+    token = secrets.token_urlsafe(32)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    if os.path.exists(path):
+        os.remove(path)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(token)
+    return token
+
+
+class AutoPDDServer(ThreadingHTTPServer):
+    """
+    Holds the warm state between jobs: the imported pipeline modules, the
+    model client and response cache, and each project's context index and
+    uploads (see fill_project() in ___main.py).
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address):
+        super().__init__(address, _Handler)
+        print("Loading AutoPDD...")
+        # Imported here, not at the top, so the client stays light. (import_module
+        # also sidesteps name mangling of "___main" inside a class.)
+        self.pipeline = importlib.import_module("___main")
+        self.pipeline.headless = True
+        self.warm = {}
+        self.token = _write_token()
+        self.started = time.time()
+        self.jobs_run = 0
+        self.current_job = None
+        # One job at a time: jobs share the model, caches and stdout.
+        self._job_lock = threading.Lock()
+
+    def status(self):
+        return {
+            "pid": os.getpid(),
+            "uptime_s": round(time.time() - self.started, 1),
+            "jobs_run": self.jobs_run,
+            "current_job": self.current_job,
+            "projects": sorted(os.path.basename(folder) for folder in self.warm.get("indexes", {})),
+        }
+
+    def run_job(self, project, sections, stream):
+        if not self._job_lock.acquire(blocking=False):
+            stream.write(f"Waiting for job '{self.current_job}' to finish...\n")
+            self._job_lock.acquire()
+        try:
+            self.current_job = project
+            print(f"Job: {project} {sections or ''}")
+            start = time.perf_counter()
+            with redirect_stdout(stream):
+                try:
+                    self.pipeline.fill_project(project, sections, warm=self.warm)
+                except Exception as e:
+                    print(f"{JOB_FAILED}: {type(e).__name__}: {e}")
+                else:
+                    print(f"{JOB_DONE} in {time.perf_counter() - start:.1f}s")
+            self.jobs_run += 1
+        finally:
+            self.current_job = None
+            self._job_lock.release()
+
+
+def serve(port=DEFAULT_PORT):
+    server = AutoPDDServer(("127.0.0.1", port))
+    print(f"AutoPDD daemon listening on http://127.0.0.1:{port} (pid {os.getpid()})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(TOKEN_PATH):
+            os.remove(TOKEN_PATH)
+    print("AutoPDD daemon stopped.")
+
+
+# --- Client ---
+
+def _url(port, path):
+    return f"http://127.0.0.1:{port}{path}"
+
+
+def _post(port, path, payload, timeout=None):
+    """A JSON POST to the daemon, with its token."""
+    try:
+        with open(TOKEN_PATH, 'r', encoding='utf-8') as f:
+            token = f.read().strip()
+    except FileNotFoundError:
+        token = ""
+    request = urllib.request.Request(_url(port, path), data=json.dumps(payload).encode('utf-8'),
+                                     headers={"Content-Type": "application/json", TOKEN_HEADER: token})
+    return urllib.request.urlopen(request, timeout=timeout)
+
+
+def submit(project, sections=None, port=DEFAULT_PORT, out=sys.stdout):
+    """
+    Submits a fill job and streams its progress to out.
+
+    Returns:
+        bool: True if the job finished without an error.
+    """
+    succeeded = False
+    with _post(port, "/fill", {"project": project, "sections": sections}) as response:
+        for line in response:
+            text = line.decode('utf-8', errors='replace')
+            out.write(text)
+            out.flush()
+            succeeded = text.startswith(JOB_DONE) or (succeeded and not text.startswith(JOB_FAILED))
+    return succeeded
+
+
+def status(port=DEFAULT_PORT):
+    with urllib.request.urlopen(_url(port, "/status"), timeout=5) as response:
+        return json.load(response)
+
+
+def stop(port=DEFAULT_PORT):
+    with _post(port, "/stop", {}, timeout=5) as response:
+        return json.load(response)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="AutoPDD warm daemon and its client.")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("serve", help="Run the daemon in the foreground.")
+    fill = commands.add_parser("fill", help="Fill a project through the running daemon.")
+    fill.add_argument("project", help="Project folder name under provided_documents/.")
+    fill.add_argument("-s", "--section", action="append", dest="sections",
+                      help="Only this section, by number or part of its subheading (repeatable).")
+    commands.add_parser("status", help="Show what the daemon holds.")
+    commands.add_parser("stop", help="Stop the daemon.")
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        serve(args.port)
+        return 0
+    try:
+        if args.command == "fill":
+            return 0 if submit(args.project, args.sections, args.port) else 1
+        if args.command == "status":
+            print(json.dumps(status(args.port), indent=4))
+        elif args.command == "stop":
+            stop(args.port)
+            print("Daemon stopping.")
+        return 0
+    except urllib.error.HTTPError as e:
+        print(f"The AutoPDD daemon refused the request: {json.load(e).get('error', e)}")
+        return 1
+    except (urllib.error.URLError, ConnectionError) as e:
+        print(f"Could not reach the AutoPDD daemon on port {args.port} ({e}). Start it with: python src/daemon.py serve")
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,265 @@
+import os
+import re
+import json
+from context_manifest import file_sha256
+from response_parser import split_table_row, is_table_separator
+from section_outline import _find_template, OUTLINE_VERSION
+from instrumentation import span
+
+# Field schemas: each template section compiled, once, into the fields the
+# model actually has to supply, so it can be asked for just their values
+# ("<number>: <value>") and the section rendered locally, instead of having
+# it write out the headings, instructions and table scaffolding around them.
+#
+#   {"body":   [template lines after the heading],
+#    "fields": [{"kind": "placeholder", "label", "line", "start", "end"},  # [x] in a line
+#               {"kind": "cell", "label", "line", "cell"},                # empty or [x] table cell
+#               {"kind": "text", "label", "line", "end"}]}                # instruction paragraphs (lines line..end)
+#
+# A section whose template has nothing to fill, or that can't be filled by
+# fields without leaving template instructions in the output (code blocks,
+# guidance with no instruction to answer it, an instruction mixed with
+# placeholders in front of a table), compiles to None and is filled whole.
+
+SCHEMA_CACHE_FILENAME = ".field_schemas.json"
+# Bump whenever a change here alters compiled schemas.
+SCHEMA_VERSION = 2
+
+_PLACEHOLDER_RE = re.compile(r"\[([^\[\]\n]+)\](?!\()")
+_BULLET_RE = re.compile(r"^\s*(?:[-*+]|\d{1,9}[.)])\s+")
+# A sentence asking the writer for something: "Describe the ...", "... (if any). Justify how ...",
+# "Where applicable, provide ..."
+_INSTRUCTION_VERBS = ("Provide", "Describe", "Summarize", "Summarise", "Explain", "Justify", "Include", "List",
+                      "Indicate", "Identify", "Demonstrate", "Specify", "State", "Outline", "Give", "Insert",
+                      "Discuss", "Present", "Calculate", "Quantify", "Define", "Determine", "Confirm", "Estimate")
+_INSTRUCTION_RE = re.compile(r"(?:^|[.!?:;]\s+)(?:%s)\b|^(?:Where|If|When|For)\b[^.]*?,\s+(?:%s)\b" % (
+    "|".join(_INSTRUCTION_VERBS), "|".join(verb.lower() for verb in _INSTRUCTION_VERBS)))
+# Advice to the writer that asks for nothing by itself ("This section should be no more than one page.")
+_GUIDANCE_RE = re.compile(r"\b(?:should|must|shall|no more than|at least|note)\b", re.I)
+
+
+def _slot_label(cell):
+    """The label of a table cell to fill ("" for an empty one), or None if the cell is template text."""
+    if not cell:
+        return ""
+    match = _PLACEHOLDER_RE.fullmatch(cell)
+    return match.group(1).strip() if match else None
+
+
+def _compile_table(body, i, fields):
+    """Adds the fields of the table starting at body[i]; returns the index after it."""
+    header = split_table_row(body[i])
+    width = len(split_table_row(body[i + 1]))
+    rows = [(i, header)]
+    end = i + 2
+    while end < len(body) and body[end].strip() and "|" in body[end]:
+        rows.append((end, split_table_row(body[end])))
+        end += 1
+    # A header with cells to fill is a key/value table: its header row is data too
+    key_value = any(_slot_label(cell) is not None for cell in header[:width])
+    columns = [cell if _slot_label(cell) is None else f"column {c + 1}" for c, cell in enumerate((header + [""] * width)[:width])]
+    for r, (line, cells) in enumerate(rows):
+        if r == 0 and not key_value:
+            continue
+        cells = (cells + [""] * width)[:width]
+        key = next((cell for cell in cells if _slot_label(cell) is None), None)
+        for c, cell in enumerate(cells):
+            label = _slot_label(cell)
+            if label is None:
+                continue
+            if not label:
+                label = key if key_value and key else f"{columns[c]}, {key or f'row {r}'}"
+            fields.append({"kind": "cell", "label": label, "line": line, "cell": c})
+    return end
+
+
+def _paragraphs(body):
+    """
+    Splits a section body into blocks: ("table", first line), ("heading",
+    line) and ("text", first line, last line) for each run of other
+    non-blank lines. Returns None if the body has a code block.
+    """
+    blocks = []
+    i = 0
+    while i < len(body):
+        line = body[i]
+        if line.lstrip().startswith(("```", "~~~")):
+            return None
+        if "|" in line and i + 1 < len(body) and is_table_separator(body[i + 1]):
+            blocks.append(("table", i))
+            i += 2
+            while i < len(body) and body[i].strip() and "|" in body[i]:
+                i += 1
+            continue
+        if not line.strip():
+            i += 1
+            continue
+        if line.lstrip().startswith("#"):
+            blocks.append(("heading", i))
+            i += 1
+            continue
+        start = i
+        while (i + 1 < len(body) and body[i + 1].strip() and not body[i + 1].lstrip().startswith(("#", "```", "~~~"))
+               and not ("|" in body[i + 1] and i + 2 < len(body) and is_table_separator(body[i + 2]))):
+            i += 1
+        blocks.append(("text", start, i))
+        i += 1
+    return blocks
+
+
+def _is_instruction(lines):
+    return any(_INSTRUCTION_RE.search(_BULLET_RE.sub("", line.strip())) for line in lines)
+
+
+def compile_section(infilling_info):
+    """
+    Compiles a template section (heading line, then its body) into a field
+    schema (see the module comment), or None if it can't be filled by fields.
+
+    Fields are, in order of appearance:
+      - every table cell that is empty or only a [placeholder]; in a table
+        whose header row has such cells (a label | value table), the
+        header row is filled too;
+      - every run of instruction paragraphs ("Describe the process ..."),
+        with the guidance and bullet lists that go with them and any
+        [placeholders] in them, as one free-text slot: the model's text
+        replaces the whole run. A paragraph introducing a table is answered
+        by the table and kept;
+      - every [placeholder] in the remaining text.
+    """
+    lines = infilling_info.strip("\n").split("\n")
+    body = lines[1:]
+    blocks = _paragraphs(body)
+    if blocks is None:
+        return None
+
+    def kind(k):
+        """instruction / guidance / bullets / table intro / plain, for a text block."""
+        block_lines = body[blocks[k][1]:blocks[k][2] + 1]
+        if k + 1 < len(blocks) and blocks[k + 1][0] == "table":
+            return "intro"
+        if _is_instruction(block_lines):
+            return "instruction"
+        if any(_PLACEHOLDER_RE.search(line) for line in block_lines):
+            return "plain"
+        if all(_BULLET_RE.match(line) for line in block_lines):
+            return "bullets"
+        return "guidance" if _GUIDANCE_RE.search(" ".join(block_lines)) else "plain"
+
+    fields = []
+    k = 0
+    while k < len(blocks):
+        block = blocks[k]
+        if block[0] == "table":
+            _compile_table(body, block[1], fields)
+            k += 1
+            continue
+        if block[0] == "heading":
+            k += 1
+            continue
+        block_kind = kind(k)
+        if block_kind in ("instruction", "guidance"):
+            # The run of instructions, guidance and bullet lists is answered as a whole
+            run = [k]
+            while k + len(run) < len(blocks) and blocks[k + len(run)][0] == "text" and kind(k + len(run)) in ("instruction", "guidance", "bullets"):
+                run.append(k + len(run))
+            if not any(kind(j) == "instruction" for j in run):
+                return None  # Guidance only: nothing to answer it with
+            first, last = blocks[run[0]][1], blocks[run[-1]][2]
+            label = " ".join(" ".join(line.split()) for line in body[first:last + 1] if line.strip())
+            fields.append({"kind": "text", "label": label, "line": first, "end": last})
+            k += len(run)
+            continue
+        block_lines = range(block[1], block[2] + 1)
+        if block_kind == "intro" and _is_instruction(body[i] for i in block_lines) and any(_PLACEHOLDER_RE.search(body[i]) for i in block_lines):
+            return None  # The table answers the instruction, but its placeholders would leave the rest unanswered
+        for i in block_lines:
+            for match in _PLACEHOLDER_RE.finditer(body[i]):
+                fields.append({"kind": "placeholder", "label": match.group(1).strip(), "line": i,
+                               "start": match.start(), "end": match.end()})
+        k += 1
+    if not fields:
+        return None
+    return {"body": body, "fields": fields}
+
+
+def _table_value(value):
+    """A value as one table cell: on one line, with pipes escaped."""
+    return " ".join(value.split()).replace("|", "\\|")
+
+
+def render_section(schema, values):
+    """
+    Renders a compiled section with its field values filled in, as the
+    model would have written it (without the heading line).
+
+    Args:
+        values (dict): {field index: value}. Fields without a value are
+                       written "INFO_NOT_FOUND: <label>".
+    """
+    body = list(schema["body"])
+    removed = set()
+    by_line = {}
+    for index, field in enumerate(schema["fields"]):
+        value = values.get(index)
+        if value is None:
+            value = f"INFO_NOT_FOUND: {field['label']}"
+        by_line.setdefault(field["line"], []).append((field, value))
+    for line_number, line_fields in by_line.items():
+        line = body[line_number]
+        if line_fields[0][0]["kind"] == "cell":
+            cells = split_table_row(line)
+            for field, value in line_fields:
+                cells += [""] * (field["cell"] + 1 - len(cells))
+                cells[field["cell"]] = _table_value(value)
+            line = "| " + " | ".join(cells) + " |"
+        elif line_fields[0][0]["kind"] == "text":
+            # The answer replaces the whole run of instruction lines
+            field, value = line_fields[0]
+            line = value.strip()
+            removed.update(range(line_number + 1, field["end"] + 1))
+        else:
+            # Right to left, so earlier offsets stay valid
+            for field, value in sorted(line_fields, key=lambda item: -item[0]["start"]):
+                line = line[:field["start"]] + " ".join(value.split()) + line[field["end"]:]
+        body[line_number] = line
+    return "\n".join(line for i, line in enumerate(body) if i not in removed).strip()
+
+
+def load_field_schemas(template_folder, outline):
+    """
+    The compiled schema of every template section, by section number
+    ("1.2"); None for sections filled whole.
+
+    Schemas are cached next to the template, keyed by the SHA-256 of the
+    template .docx like its outline (see section_outline.py), and by the
+    outline's version, since each section is compiled from its outline body.
+
+    Args:
+        outline (list): The template outline from load_template_outline().
+                        Each body must end at the section's end marker, as
+                        build_outline() cuts them, so nothing after it (the
+                        Appendix, for the last section) is rendered into the
+                        section.
+    """
+    template_hash = file_sha256(_find_template(template_folder))
+    cache_path = os.path.join(template_folder, SCHEMA_CACHE_FILENAME)
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+        if (cached.get("sha256") == template_hash and cached.get("version") == SCHEMA_VERSION
+                and cached.get("outline_version") == OUTLINE_VERSION):
+            return cached["schemas"]
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        pass
+
+    with span("template.schemas", sections=len(outline)) as s:
+        schemas = {section["target"][2]: compile_section(section["body"]) for section in outline}
+        s["compiled"] = sum(schema is not None for schema in schemas.values())
+    print(f"Compiled field schemas for {s['compiled']} of {len(outline)} template section(s).")
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({"sha256": template_hash, "version": SCHEMA_VERSION, "outline_version": OUTLINE_VERSION,
+                   "schemas": schemas}, f)
+    os.replace(tmp_path, cache_path)
+    return schemas
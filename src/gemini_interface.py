@@ -1,8 +1,15 @@
 import os
 import time
-import google.generativeai as genai
 from dotenv import load_dotenv
 from typing import List, Optional
+from lazy_import import lazy_import
+from llm_cache import ResponseCache, context_digest
+from gemini_registry import GeminiRegistry, GeminiContext
+from response_parser import StreamingResponseParser, StreamDiverged
+from request_scheduler import RequestScheduler, estimate_request_tokens, backoff_delay
+from instrumentation import span
+
+genai = lazy_import("google.generativeai")
 
 # Note: The 'UploadedFile' type can be imported for more specific type hinting
 # from google.generativeai.types import UploadedFile
@@ -27,7 +34,54 @@ def setup_gemini():
         print(f"An error occurred during setup: {e}")
         return None
 
-def upload_files_to_gemini(file_paths: List[str], max_upload_retries: int = 3) -> Optional[List]:
+class RateLimitedAgent:
+    """
+    Wraps a Gemini agent so that every request goes through a RequestScheduler
+    (see request_scheduler.py): under the request and token quotas, a cap on
+    requests in flight, and retried with backoff when the API refuses it.
+    Share one between callers (e.g. the projects of a batch run) to share
+    the quota. Anything else is passed through to the agent.
+
+    Args:
+        agent: The model from setup_gemini().
+        requests_per_minute (int): Request quota.
+        max_in_flight (int): Requests running at the same time.
+        tokens_per_minute (int): Input token quota. 0 = not limited.
+        max_retries (int): Retries of a request refused for rate limiting.
+    """
+
+    def __init__(self, agent, requests_per_minute=60, max_in_flight=8, tokens_per_minute=0, max_retries=5):
+        self.agent = agent
+        self.scheduler = RequestScheduler(requests_per_minute, tokens_per_minute, max_in_flight, max_retries)
+
+    def __getattr__(self, name):
+        return getattr(self.agent, name)
+
+    def generate_content(self, *args, **kwargs):
+        return self.call(self.agent.generate_content, *args, **kwargs)
+
+    def call(self, func, content, **kwargs):
+        """Runs func(content) (e.g. the generate_content of a model bound to cached content) through the scheduler."""
+        return self.scheduler.submit(func, content, estimated_tokens=estimate_request_tokens(content), **kwargs)
+
+def _generate_with(agent, model, content, **kwargs):
+    """model.generate_content(content), within agent's limits if it is a RateLimitedAgent."""
+    if isinstance(agent, RateLimitedAgent):
+        return agent.call(model.generate_content, content, **kwargs)
+    return model.generate_content(content, **kwargs)
+
+def _read_stream(response, stream):
+    """Feeds a streamed response to a StreamingResponseParser chunk by chunk and returns the full text."""
+    for chunk in response:
+        try:
+            text = chunk.text
+        except ValueError:
+            # A chunk with no text part (e.g. only the finish reason)
+            continue
+        stream.feed(text)
+    return stream.finish()
+
+def upload_files_to_gemini(file_paths: List[str], max_upload_retries: int = 3, registry: Optional[GeminiRegistry] = None) -> Optional[List]:
     """
     Uploads a list of files to the Gemini API and returns their references.
 
@@ -37,6 +91,10 @@ def upload_files_to_gemini(file_paths: List[str], max_upload_retries: int = 3) -
     Args:
         file_paths: A list of local file paths to upload.
         max_upload_retries: The maximum number of times to retry uploading a file.
+        registry: Optional GeminiRegistry. Files it holds a live upload of
+                  (same content hash) are not uploaded again, and the result
+                  is a GeminiContext, which ask_gemini() can also bind into
+                  cached content.
 
     Returns:
         A list of 'UploadedFile' objects if successful, otherwise None.
@@ -45,28 +103,49 @@ def upload_files_to_gemini(file_paths: List[str], max_upload_retries: int = 3) -
     uploaded_files = []
     
     for file_path in file_paths:
-        success = False
-        for attempt in range(max_upload_retries):
-            try:
-                # The API performs a check for the file's MIME type.
-                uploaded_file = genai.upload_file(path=file_path)
+        if registry is not None:
+            uploaded_file = registry.lookup(file_path)
+            if uploaded_file is not None:
                 uploaded_files.append(uploaded_file)
-                print(f"  Successfully uploaded '{file_path}'")
-                success = True
-                break
-            except Exception as e:
-                print(f"  Upload attempt {attempt + 1} failed for {file_path}: {e}")
-                if attempt < max_upload_retries - 1:
-                    time.sleep(2)  # Wait before retry
+                print(f"  Reusing earlier upload of '{file_path}' (unchanged)")
+                continue
+        success = False
+        with span("upload", file=os.path.basename(file_path), bytes=os.path.getsize(file_path)) as s:
+            for attempt in range(max_upload_retries):
+                s["retries"] = attempt
+                try:
+                    # The API performs a check for the file's MIME type.
+                    uploaded_file = registry.upload(file_path) if registry is not None else genai.upload_file(path=file_path)
+                    uploaded_files.append(uploaded_file)
+                    print(f"  Successfully uploaded '{file_path}'")
+                    success = True
+                    break
+                except Exception as e:
+                    print(f"  Upload attempt {attempt + 1} failed for {file_path}: {e}")
+                    if attempt < max_upload_retries - 1:
+                        time.sleep(backoff_delay(attempt))
         
         if not success:
             print(f"FAILED to upload '{file_path}' after {max_upload_retries} attempts.")
             exit()
             
     print("File cache created successfully.")
-    return uploaded_files
+    return registry.context(uploaded_files) if registry is not None else uploaded_files
+
+def _response_cache_key(agent, prompt, system_prompt, cached_files):
+    return ResponseCache.make_key(agent.model_name, system_prompt, prompt, context_digest(cached_files))
 
-def ask_gemini(agent: genai.GenerativeModel, prompt: str, system_prompt: Optional[str] = None, cached_files: Optional[List] = None) -> str:
+def discard_cached_response(agent, prompt, system_prompt=None, cached_files=None, cache=None):
+    """
+    Removes the cached response to an ask_gemini() call with these arguments,
+    once the caller has found it invalid, so later runs ask the model again
+    instead of spending an attempt on the known-bad response.
+    """
+    if agent and cache:
+        cache.discard(_response_cache_key(agent, prompt, system_prompt, cached_files))
+
+def ask_gemini(agent: "genai.GenerativeModel", prompt: str, system_prompt: Optional[str] = None, cached_files: Optional[List] = None,
+               cache: Optional[ResponseCache] = None, bypass_cache: bool = False, stream: Optional[StreamingResponseParser] = None) -> str:
     """
     Sends a prompt and an optional list of pre-uploaded file references to Gemini.
 
@@ -76,28 +155,89 @@ def ask_gemini(agent: genai.GenerativeModel, prompt: str, system_prompt: Optiona
         system_prompt: Optional system-level instructions for the model.
 
         cached_files: A list of 'UploadedFile' objects returned by upload_files_to_gemini(). 23
+                      A GeminiContext (see gemini_registry.py) also lets the
+                      system prompt and files be sent once, as cached content.
+        cache: Optional ResponseCache. Identical requests (same model, prompts
+               and attached files) are answered from it without an API call.
+               Every response is stored; callers that reject one remove it
+               with discard_cached_response().
+        bypass_cache: Skip the cache lookup for this call (the fresh response
+                      still replaces the cached one), e.g. when retrying
+                      after an invalid response.
+        stream: Optional StreamingResponseParser. The response is streamed
+                into it as it is generated, and the StreamDiverged it raises
+                as soon as the response goes wrong is passed on to the
+                caller, without generating the rest.
     Returns:
         The generated text response from the model.
     """
     if not agent:
         return "Error: Gemini agent is not initialized."
 
-    # Construct the full prompt with system instructions if provided
-    complete_prompt = f"SYSTEM INSTRUCTIONS:\n{system_prompt}\n\nUSER QUERY:\n{prompt}" if system_prompt else prompt
-    
-    # The content list starts with the text prompt
-    content = [complete_prompt]
-    
-    # If a file cache is provided, add the file references to the content
-    if cached_files:
-        content.extend(cached_files)
-        #print(f"Asking Gemini with prompt and {len(cached_files)} cached file(s)...")
-    else:
-        #print("Asking Gemini with prompt (no files)...")
-        pass
+    with span("llm.call", model=agent.model_name, prompt_chars=len(prompt) + len(system_prompt or ""),
+              files=len(cached_files or [])) as s:
+        cache_key = None
+        s["cache"] = "off"
+        if cache:
+            cache_key = _response_cache_key(agent, prompt, system_prompt, cached_files)
+            s["cache"] = "bypass" if bypass_cache else "miss"
+            cached_response = cache.get(cache_key, bypass=bypass_cache)
+            if cached_response is not None:
+                s["cache"] = "hit"
+                if stream is not None:
+                    stream.feed(cached_response)
+                    stream.finish()
+                return cached_response
 
-    try:
-        response = agent.generate_content(content)
-        return response.text
-    except Exception as e:
-        return f"An error occurred while asking Gemini: {e}"
\ No newline at end of file
+        # With a GeminiContext, the system prompt and files can live in
+        # server-side cached content, and only the user prompt is sent
+        response = text = None
+        stream_kwargs = {"stream": True} if stream is not None else {}
+        cached_model = cached_files.cached_model(agent, system_prompt) if isinstance(cached_files, GeminiContext) else None
+        if cached_model is not None:
+            try:
+                response = _generate_with(agent, cached_model, [prompt], **stream_kwargs)
+                text = _read_stream(response, stream) if stream is not None else response.text
+                s["context_cache"] = "used"
+            except StreamDiverged as e:
+                s["aborted"] = e.reason
+                s["output_chars"] = len(e.partial_text)
+                raise
+            except Exception as e:
+                if type(e).__name__ not in ("NotFound", "PermissionDenied"):
+                    s["error"] = str(e)[:200]
+                    return f"An error occurred while asking Gemini: {e}"
+                # The cached content (or a file in it) is gone: forget it and send everything
+                s["context_cache"] = "expired"
+                cached_files.invalidate(agent, system_prompt)
+
+        try:
+            if response is None:
+                # Construct the full prompt with system instructions if provided
+                complete_prompt = f"SYSTEM INSTRUCTIONS:\n{system_prompt}\n\nUSER QUERY:\n{prompt}" if system_prompt else prompt
+
+                # The content list starts with the text prompt
+                content = [complete_prompt]
+
+                # If a file cache is provided, add the file references to the content
+                if cached_files:
+                    content.extend(cached_files)
+                response = agent.generate_content(content, **stream_kwargs)
+                text = _read_stream(response, stream) if stream is not None else response.text
+            usage = getattr(response, "usage_metadata", None)
+            s["input_tokens"] = getattr(usage, "prompt_token_count", None)
+            s["output_tokens"] = getattr(usage, "candidates_token_count", None)
+            if cached_model is not None:
+                s["cached_tokens"] = getattr(usage, "cached_content_token_count", None)
+            if stream is not None and stream.first_content_s is not None:
+                s["first_content_ms"] = round(stream.first_content_s * 1000, 1)
+            if cache_key:
+                cache.put(cache_key, text, agent.model_name)
+            return text
+        except StreamDiverged as e:
+            s["aborted"] = e.reason
+            s["output_chars"] = len(e.partial_text)
+            raise
+        except Exception as e:
+            s["error"] = str(e)[:200]
+            return f"An error occurred while asking Gemini: {e}"
\ No newline at end of file
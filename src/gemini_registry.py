@@ -0,0 +1,224 @@
+import os
+import json
+import time
+import hashlib
+import datetime
+import threading
+from lazy_import import lazy_import
+from context_manifest import file_sha256
+from instrumentation import span
+
+genai = lazy_import("google.generativeai")
+
+# Remembers what has been sent to the Gemini API, across runs:
+#  - uploaded files, by content hash, until the Files API deletes them
+#    (48 hours after upload), so an unchanged all_context.txt is never
+#    uploaded twice;
+#  - cached content (system prompt + uploaded context, stored server-side),
+#    so the long system prompt and the context are sent once per TTL instead
+#    of with every section request.
+# The API calls go through a backend object; GenaiBackend is the real one,
+# and benchmarks/fake_llm.py has a local fake for runs without an API key.
+
+REGISTRY_PATH = os.path.join(".llm_cache", "gemini_registry.json")
+FILE_TTL_S = 48 * 3600  # Used if the API does not report an expiry.
+# Entries this close to expiry are not reused: a request may still be in flight when they go.
+EXPIRY_MARGIN_S = 600
+
+
+def _timestamp(value, default_ttl_s):
+    """Epoch seconds of an API expiry time (a datetime), or now + default_ttl_s if there is none."""
+    if hasattr(value, "timestamp"):
+        return value.timestamp()
+    return time.time() + default_ttl_s
+
+
+class GenaiBackend:
+    """The Gemini Files and cachedContents endpoints, via google.generativeai."""
+
+    def upload(self, file_path):
+        """Returns (file handle, expiry in epoch seconds)."""
+        uploaded_file = genai.upload_file(path=file_path)
+        return uploaded_file, _timestamp(getattr(uploaded_file, "expiration_time", None), FILE_TTL_S)
+
+    def get_file(self, name):
+        """The handle of an uploaded file; raises if the API no longer has it."""
+        return genai.get_file(name)
+
+    def create_cache(self, model_name, system_instruction, files, ttl_s):
+        """Returns (cache name, expiry in epoch seconds)."""
+        cached_content = genai.caching.CachedContent.create(
+            model=model_name, system_instruction=system_instruction, contents=list(files) or None,
+            ttl=datetime.timedelta(seconds=ttl_s))
+        return cached_content.name, _timestamp(getattr(cached_content, "expire_time", None), ttl_s)
+
+    def cached_model(self, name):
+        """A model bound to cached content; raises if the cache is gone."""
+        return genai.GenerativeModel.from_cached_content(genai.caching.CachedContent.get(name))
+
+
+class GeminiContext(list):
+    """
+    The uploaded file handles of a project (a plain list to everything that
+    attaches them to requests), remembering the registry they came from so
+    ask_gemini() can bind them, with a system prompt, into cached content.
+    """
+
+    def __init__(self, files=(), registry=None):
+        super().__init__(files)
+        self.registry = registry
+
+    def cached_model(self, agent, system_prompt):
+        """A model with system_prompt and these files cached server-side, or None."""
+        if self.registry is None or not system_prompt:
+            return None
+        return self.registry.cached_model(agent.model_name, system_prompt, self)
+
+    def invalidate(self, agent, system_prompt):
+        """Forgets the cached content for system_prompt, e.g. after a request using it failed."""
+        if self.registry is not None:
+            self.registry.invalidate(agent.model_name, system_prompt, self)
+
+
+class GeminiRegistry:
+    """
+    Persistent registry of uploaded files and cached content, saved as JSON
+    (by default in .llm_cache/). Safe to share between threads.
+
+        {"files":  {sha256: {"name", "display_name", "expires_at"}},
+         "caches": {key: {"name", "expires_at"}}}
+
+    Args:
+        path (str): Registry file.
+        cache_ttl_s (int): Lifetime of newly created cached content. 0 turns
+                           context caching off (uploads are still reused).
+        backend: The API to call; GenaiBackend() by default.
+    """
+
+    def __init__(self, path=REGISTRY_PATH, cache_ttl_s=3600, backend=None):
+        self.path = path
+        self.cache_ttl_s = cache_ttl_s
+        self.backend = backend or GenaiBackend()
+        self.uploads_reused = self.uploads_made = 0
+        self.caches_reused = self.caches_created = 0
+        self._models = {}  # cache key -> (model, expires_at), for this process
+        self._lock = threading.RLock()
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                self.data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.data = {}
+        self.data.setdefault("files", {})
+        self.data.setdefault("caches", {})
+
+    def _save(self):
+        now = time.time()
+        for kind in ("files", "caches"):
+            self.data[kind] = {key: entry for key, entry in self.data[kind].items() if entry["expires_at"] > now}
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.data, f, indent=4)
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def _usable(entry):
+        return entry is not None and entry["expires_at"] - EXPIRY_MARGIN_S > time.time()
+
+    # --- Uploads ---
+
+    def lookup(self, file_path):
+        """The handle of an earlier, still live upload of the file's exact bytes, or None."""
+        sha256 = file_sha256(file_path)
+        with self._lock:
+            entry = self.data["files"].get(sha256)
+            if not self._usable(entry):
+                return None
+            try:
+                handle = self.backend.get_file(entry["name"])
+            except Exception:
+                # Deleted on the server ahead of time
+                del self.data["files"][sha256]
+                self._save()
+                return None
+            self.uploads_reused += 1
+            return handle
+
+    def upload(self, file_path):
+        """Uploads a file and records it by content hash. Raises on failure."""
+        handle, expires_at = self.backend.upload(file_path)
+        with self._lock:
+            self.data["files"][file_sha256(file_path)] = {
+                "name": handle.name, "display_name": os.path.basename(file_path), "expires_at": expires_at}
+            self.uploads_made += 1
+            self._save()
+        return handle
+
+    def context(self, files=()):
+        """Wraps file handles (possibly none) as a GeminiContext bound to this registry."""
+        return GeminiContext(files, self)
+
+    # --- Cached content ---
+
+    @staticmethod
+    def cache_key(model_name, system_prompt, files):
+        payload = json.dumps([model_name, system_prompt, [getattr(f, "name", str(f)) for f in files]])
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def cached_model(self, model_name, system_prompt, files):
+        """
+        A model bound to server-side cached content holding system_prompt and
+        files: reused from this process or an earlier run while its TTL
+        lasts, created otherwise.
+
+        Returns None if context caching is off or the API refuses it (e.g.
+        the content is below the model's minimum cacheable size); that is
+        remembered for cache_ttl_s, and requests carry everything as before.
+        """
+        if not self.cache_ttl_s:
+            return None
+        key = self.cache_key(model_name, system_prompt, files)
+        with self._lock:
+            model, expires_at = self._models.get(key, (None, 0))
+            if model is not None and expires_at - EXPIRY_MARGIN_S > time.time():
+                return model
+            entry = self.data["caches"].get(key)
+            with span("gemini.context_cache", files=len(files)) as s:
+                if self._usable(entry) and entry.get("name"):
+                    try:
+                        model = self.backend.cached_model(entry["name"])
+                        self.caches_reused += 1
+                        s["source"] = "reused"
+                    except Exception:
+                        entry = None
+                elif self._usable(entry):
+                    s["source"] = "unavailable"
+                    return None
+                if model is None:
+                    try:
+                        name, expires_at = self.backend.create_cache(model_name, system_prompt, files, self.cache_ttl_s)
+                        model = self.backend.cached_model(name)
+                    except Exception as e:
+                        print(f"Context caching unavailable ({str(e)[:200]}); sending the full prompt with each request.")
+                        self.data["caches"][key] = {"name": None, "expires_at": time.time() + self.cache_ttl_s}
+                        self._save()
+                        s["source"] = "unavailable"
+                        return None
+                    entry = {"name": name, "expires_at": expires_at}
+                    self.data["caches"][key] = entry
+                    self._save()
+                    self.caches_created += 1
+                    s["source"] = "created"
+            self._models[key] = (model, entry["expires_at"])
+            return model
+
+    def invalidate(self, model_name, system_prompt, files):
+        key = self.cache_key(model_name, system_prompt, files)
+        with self._lock:
+            self._models.pop(key, None)
+            if self.data["caches"].pop(key, None) is not None:
+                self._save()
+
+    def summary(self):
+        return (f"Gemini registry: {self.uploads_reused} upload(s) reused, {self.uploads_made} made; "
+                f"context cache {self.caches_reused} reused, {self.caches_created} created")
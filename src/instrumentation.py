@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# Lightweight tracing of where a run's time goes.
+#
+# Every stage wraps its work in span(name, **attrs); when a trace has been
+# started, each finished span is appended to the trace file as one JSON line:
+#
+#   {"run": ..., "name": "llm.call", "start": <epoch s>, "ms": 812.4,
+#    "pid": ..., "thread": ..., "parent": "section.fill", <attrs>...}
+#
+# The trace file and run id travel in environment variables, so spans
+# recorded in extraction worker processes land in the same file. Without a
+# trace, span() only times the block and records nothing.
+#
+# Runs append to the same file until it passes TRACE_MAX_BYTES; the next run
+# then moves it to <trace>.1 (replacing the one before) and starts afresh.
+
+TRACE_ENV = "AUTOPDD_TRACE"
+RUN_ENV = "AUTOPDD_RUN_ID"
+OFFSET_ENV = "AUTOPDD_TRACE_OFFSET"  # Where the current run's spans start in the file
+TRACE_MAX_BYTES = 10 * 1024 * 1024
+
+_write_lock = threading.Lock()
+_local = threading.local()
+
+
+def start_trace(trace_path):
+    """Starts recording spans of this run (and its worker processes) to trace_path, rotating it if it has grown too large."""
+    run_id = f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+    trace_path = os.path.abspath(trace_path)
+    os.makedirs(os.path.dirname(trace_path), exist_ok=True)
+    size = os.path.getsize(trace_path) if os.path.exists(trace_path) else 0
+    if size > TRACE_MAX_BYTES:
+        os.replace(trace_path, trace_path + ".1")
+        size = 0
+    os.environ[TRACE_ENV] = trace_path
+    os.environ[RUN_ENV] = run_id
+    os.environ[OFFSET_ENV] = str(size)
+    return run_id
+
+
+def _emit(record):
+    trace_path = os.environ.get(TRACE_ENV)
+    if not trace_path:
+        return
+    line = json.dumps(record, default=str) + "\n"
+    with _write_lock:
+        # One short append per span; appends from several processes don't interleave.
+        with open(trace_path, 'a', encoding='utf-8') as f:
+            f.write(line)
+
+
+@contextmanager
+def span(name, **attrs):
+    """
+    Times the enclosed block as one span. Yields the span's attribute dict,
+    so the block can add what it learns (token counts, retries, ...):
+
+        with span("llm.call", model=model) as s:
+            ...
+            s["output_tokens"] = n
+    """
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    parent = stack[-1] if stack else None
+    stack.append(name)
+    start_wall, start = time.time(), time.perf_counter()
+    try:
+        yield attrs
+    except BaseException as e:
+        attrs["error"] = f"{type(e).__name__}: {e}"[:200]
+        raise
+    finally:
+        duration_ms = (time.perf_counter() - start) * 1000
+        stack.pop()
+        _emit({"run": os.environ.get(RUN_ENV), "name": name, "start": round(start_wall, 3),
+               "ms": round(duration_ms, 2), "pid": os.getpid(), "thread": threading.current_thread().name,
+               "parent": parent, **attrs})
+
+
+def load_spans(trace_path=None, run_id=None):
+    """
+    Reads the spans of one run (the current one by default) back from the
+    trace file. For the current run, only the part of the file it wrote is
+    read.
+    """
+    current = (trace_path is None or os.path.abspath(trace_path) == os.environ.get(TRACE_ENV)) and \
+              run_id in (None, os.environ.get(RUN_ENV))
+    trace_path = trace_path or os.environ.get(TRACE_ENV)
+    run_id = run_id or os.environ.get(RUN_ENV)
+    spans = []
+    if not trace_path or not os.path.exists(trace_path):
+        return spans
+    with open(trace_path, 'rb') as f:
+        if current:
+            f.seek(int(os.environ.get(OFFSET_ENV, 0)))
+        for line in f:
+            try:
+                record = json.loads(line.decode('utf-8'))
+            except (UnicodeDecodeError, json.JSONDecodeError):
+                continue  # A line cut short by a crash
+            if run_id is None or record.get("run") == run_id:
+                spans.append(record)
+    return spans
+
+
+# Numeric attributes that are added up in the summary.
+SUMMED_ATTRS = ("input_tokens", "output_tokens", "retries", "chars")
+
+
+def summarize(spans):
+    """
+    Aggregates spans by name.
+
+    Returns:
+        list: One dict per span name (count, total_ms, mean_ms, max_ms,
+              errors, cache_hits and the SUMMED_ATTRS totals), slowest first.
+    """
+    rows = {}
+    for record in spans:
+        row = rows.setdefault(record["name"], {"name": record["name"], "count": 0, "total_ms": 0.0, "max_ms": 0.0,
+                                              "errors": 0, "cache_hits": 0, **{attr: 0 for attr in SUMMED_ATTRS}})
+        row["count"] += 1
+        row["total_ms"] += record["ms"]
+        row["max_ms"] = max(row["max_ms"], record["ms"])
+        row["errors"] += "error" in record
+        row["cache_hits"] += record.get("cache") == "hit"
+        for attr in SUMMED_ATTRS:
+            if isinstance(record.get(attr), (int, float)):
+                row[attr] += record[attr]
+    for row in rows.values():
+        row["mean_ms"] = row["total_ms"] / row["count"]
+    return sorted(rows.values(), key=lambda row: -row["total_ms"])
+
+
+def format_summary(rows):
+    """Formats summarize() output as a plain-text table."""
+    header = f"{'stage':<24}{'count':>7}{'total s':>10}{'mean ms':>10}{'max ms':>10}{'in tok':>10}{'out tok':>10}{'retries':>9}{'hits':>6}{'errors':>8}"
+    lines = [header, "-" * len(header)]
+    for row in rows:
+        lines.append(f"{row['name']:<24}{row['count']:>7}{row['total_ms'] / 1000:>10.2f}{row['mean_ms']:>10.1f}{row['max_ms']:>10.1f}"
+                     f"{row['input_tokens']:>10}{row['output_tokens']:>10}{row['retries']:>9}{row['cache_hits']:>6}{row['errors']:>8}")
+    return "\n".join(lines)
+
+
+def print_summary(trace_path=None, run_id=None):
+    """Prints the summary table of a run's trace (the current run by default)."""
+    spans = load_spans(trace_path, run_id)
+    if not spans:
+        return
+    print("\n--- Run summary ---")
+    print(format_summary(summarize(spans)))
+    print(f"(spans in {trace_path or os.environ.get(TRACE_ENV)})")
@@ -0,0 +1,28 @@
+import sys
+import importlib.util
+
+# Heavy third-party packages (python-docx, pdfplumber, the Gemini SDK,
+# llama.cpp) are bound with lazy_import() at the top of the modules that use
+# them, so importing those modules stays cheap and a command that never
+# touches a package never pays for loading it.
+
+
+def lazy_import(name):
+    """
+    Returns module `name`, loaded on its first attribute access.
+
+    A missing package still raises ModuleNotFoundError here, at import time,
+    as a plain import would. Annotations and default arguments evaluated at
+    definition time must not touch the module, or it loads immediately.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
@@ -1,13 +1,40 @@
-from llama_cpp import Llama
+import json
 import random
 import time
-from pynvml import nvmlInit, nvmlDeviceGetHandleByIndex, nvmlDeviceGetMemoryInfo
+from lazy_import import lazy_import
+from llm_cache import ResponseCache
+from instrumentation import span
+from response_parser import StreamDiverged
 
-def setup_llama(model_path, n_gpu_layers=-1, n_ctx=10000, chat_format="chatml-function-calling"):
+llama_cpp = lazy_import("llama_cpp")
+
+def gpu_available():
+    """True if pynvml is installed and reports at least one NVIDIA GPU."""
+    # pynvml is only needed to find a GPU; without it the model runs on the CPU.
+    try:
+        from pynvml import nvmlInit, nvmlDeviceGetCount, NVMLError
+    except ImportError:
+        return False
+    try:
+        nvmlInit()
+        return nvmlDeviceGetCount() > 0
+    except NVMLError:
+        return False
+
+def setup_llama(model_path, n_gpu_layers=None, n_ctx=10000, chat_format="chatml-function-calling"):
+    """
+    Loads a GGUF model with llama.cpp.
+
+    Args:
+        n_gpu_layers (int): Layers to offload to the GPU. None offloads all of
+                            them when a GPU is found, and none otherwise.
+    """
+    if n_gpu_layers is None:
+        n_gpu_layers = -1 if gpu_available() else 0
 
     seed = int(time.time())
         
-    return Llama(
+    return llama_cpp.Llama(
         model_path=model_path,
         n_gpu_layers=n_gpu_layers,
         seed=seed,
@@ -16,47 +43,113 @@ def setup_llama(model_path, n_gpu_layers=-1, n_ctx=10000, chat_format="chatml-fu
         verbose=False
     )
 
-def ask_llama(llm, prompt=None, system=None, conversation_history=None, agent_name = None, max_tokens=None):
-    
-    # Create messages list
-    messages = []
+def ask_llama(llm, prompt=None, system=None, conversation_history=None, agent_name = None, max_tokens=None, cache=None, bypass_cache=False,
+              context=None, prefix_cache=None, stream=None):
+    """
+    Args:
+        context (str): Shared context (e.g. the project documents) sent after
+                       the system prompt, identical across sections.
+        prefix_cache (PrefixStateCache): If given, the system prompt and context
+                       are evaluated once and their KV state reused by every
+                       call that shares them (see llama_state_cache.py).
+        stream (StreamingResponseParser): If given, the response is streamed
+                       into it, and generation stops at the StreamDiverged it
+                       raises (passed on to the caller).
+    """
+    with span("llm.call", model=llm.model_path, prompt_chars=len(prompt or "") + len(system or "") + len(context or "")) as s:
+        # Serve identical requests from the response cache, if one is given
+        cache_key = None
+        s["cache"] = "off"
+        if cache:
+            user_part = json.dumps([prompt, conversation_history, agent_name, max_tokens])
+            cache_key = ResponseCache.make_key(llm.model_path, system, user_part, context)
+            s["cache"] = "bypass" if bypass_cache else "miss"
+            cached_response = cache.get(cache_key, bypass=bypass_cache)
+            if cached_response is not None:
+                s["cache"] = "hit"
+                if stream is not None:
+                    stream.feed(cached_response)
+                    stream.finish()
+                return cached_response
+
+        # Create messages list
+        messages = []
     
-    if prompt:
-        messages.append({
-                "role": "user",
-                "content": prompt
-            })
-        
-    if system:
-        messages.append({
-            "role": "system",
-            "content": system
-        })
-
-    if conversation_history and agent_name:
-        for message in conversation_history:
-            user_or_agent = message.split(": ")[0]
-            if user_or_agent == agent_name: # agent message
-                messages.append({
-                    "role": "assistant",
-                    "content": message[len(user_or_agent)+2:]
-                })
-            else: # user message
-                messages.append({
+        if prompt:
+            messages.append({
                     "role": "user",
-                    "content": message[len(user_or_agent)+2:]
+                    "content": prompt
                 })
         
-    
+        if system or context:
+            messages.append({
+                "role": "system",
+                "content": f"{system}\n\nCONTEXT:\n{context}" if system and context else system or f"CONTEXT:\n{context}"
+            })
 
-    # Generate completion with max_tokens parameter if provided
-    response = llm.create_chat_completion(
-        messages=messages,
-        max_tokens=max_tokens
-    )
+        if conversation_history and agent_name:
+            for message in conversation_history:
+                user_or_agent = message.split(": ")[0]
+                if user_or_agent == agent_name: # agent message
+                    messages.append({
+                        "role": "assistant",
+                        "content": message[len(user_or_agent)+2:]
+                    })
+                else: # user message
+                    messages.append({
+                        "role": "user",
+                        "content": message[len(user_or_agent)+2:]
+                    })
+        
     
+
+        try:
+            if prefix_cache is not None:
+                # The shared prefix has to come first for its state to be reusable
+                turns = [message for message in messages if message["role"] != "system"]
+                response, s["prefix"] = prefix_cache.create_completion(system, context, turns, max_tokens,
+                                                                       on_text=stream.feed if stream is not None else None)
+            elif stream is not None:
+                chunks = llm.create_chat_completion(messages=messages, max_tokens=max_tokens, stream=True)
+                try:
+                    for chunk in chunks:
+                        stream.feed(chunk["choices"][0].get("delta", {}).get("content") or "")
+                finally:
+                    chunks.close()
+                response = {}
+            else:
+                # Generate completion with max_tokens parameter if provided
+                response = llm.create_chat_completion(
+                    messages=messages,
+                    max_tokens=max_tokens
+                )
+            if stream is not None:
+                stream.finish()
+        except StreamDiverged as e:
+            s["aborted"] = e.reason
+            s["output_chars"] = len(e.partial_text)
+            raise
+
+        usage = response.get("usage") or {}
+        s["input_tokens"] = usage.get("prompt_tokens")
+        s["output_tokens"] = usage.get("completion_tokens")
+        if stream is not None:
+            text = stream.text
+            if stream.first_content_s is not None:
+                s["first_content_ms"] = round(stream.first_content_s * 1000, 1)
+        else:
+            text = _response_text(response)
+        if cache_key:
+            cache.put(cache_key, text, llm.model_path)
+        return text
+
+
+def _response_text(response):
     # Extract and return only the text content
     if "choices" in response and len(response["choices"]) > 0:
+        # Plain completions (prefix-cached calls)
+        if "text" in response["choices"][0]:
+            return response["choices"][0]["text"]
         # Extract the assistant's message content
         if "message" in response["choices"][0]:
             if "content" in response["choices"][0]["message"] and response["choices"][0]["message"]["content"]:
@@ -0,0 +1,165 @@
+import os
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+from instrumentation import span
+
+DEFAULT_STATE_DIR = os.path.join(".llm_cache", "llama_states")
+
+# ChatML, the format of the models setup_llama() is used with. The shared
+# prefix (system prompt and attached context) is rendered on its own so its
+# tokens are an exact prefix of every section's prompt.
+CHATML_SYSTEM = "<|im_start|>system\n{content}<|im_end|>\n"
+CHATML_TURN = "<|im_start|>{role}\n{content}<|im_end|>\n"
+CHATML_ASSISTANT = "<|im_start|>assistant\n"
+CHATML_STOP = ["<|im_end|>"]
+
+
+class PrefixStateCache:
+    """
+    Reuses the evaluated KV state of a shared prompt prefix across llama.cpp calls.
+
+    Every section prompt starts with the same system prompt and context. The
+    first time a prefix is seen it is evaluated once and the model state
+    (KV cache and token ids) is snapshotted with Llama.save_state(); each
+    later prompt with that prefix restores the snapshot with load_state(), so
+    llama.cpp only evaluates the prompt's own tokens. Snapshots are also
+    pickled to state_dir, keyed by a hash of the model and prefix, so later
+    runs skip the prefill entirely.
+
+    A KV snapshot is large (it grows with the prefix length), so only the
+    max_states most recently used ones are kept, in memory and on disk.
+
+    Args:
+        llm (Llama): The model from setup_llama().
+        state_dir (str): Directory holding the persisted snapshots.
+        max_states (int): Snapshots kept in memory and on disk.
+    """
+
+    def __init__(self, llm, state_dir=DEFAULT_STATE_DIR, max_states=4):
+        self.llm = llm
+        self.state_dir = state_dir
+        self.max_states = max_states
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.prefills = 0
+        self._states = OrderedDict()
+        # One model, one KV cache: restore and generate must not interleave.
+        self._lock = threading.Lock()
+
+    def make_key(self, prefix_text):
+        payload = "\0".join([os.path.basename(self.llm.model_path), str(self.llm.n_ctx()), prefix_text])
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.state_dir, key + ".state")
+
+    def _remember(self, key, state):
+        self._states[key] = state
+        self._states.move_to_end(key)
+        while len(self._states) > self.max_states:
+            self._states.popitem(last=False)
+
+    def _load(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                state = pickle.load(f)
+            os.utime(path)  # Mark as recently used
+            return state
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError, AttributeError):
+            return None
+
+    def _store(self, key, state):
+        os.makedirs(self.state_dir, exist_ok=True)
+        tmp_path = self._path(key) + f".{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self._path(key))
+
+        snapshots = [os.path.join(self.state_dir, f) for f in os.listdir(self.state_dir) if f.endswith(".state")]
+        snapshots.sort(key=os.path.getmtime)
+        for path in snapshots[:-self.max_states]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _restore(self, prefix_text, prefix_tokens):
+        """Leaves the model holding the evaluated prefix. Returns where the state came from."""
+        key = self.make_key(prefix_text)
+        state = self._states.get(key)
+        source = "memory"
+        if state is None:
+            state = self._load(key)
+            source = "disk"
+        if state is not None:
+            self.llm.load_state(state)
+            self._remember(key, state)
+            if source == "memory":
+                self.memory_hits += 1
+            else:
+                self.disk_hits += 1
+            return source
+
+        with span("llm.prefill", model=self.llm.model_path, input_tokens=len(prefix_tokens)):
+            self.llm.reset()
+            self.llm.eval(prefix_tokens)
+            state = self.llm.save_state()
+        self._remember(key, state)
+        self._store(key, state)
+        self.prefills += 1
+        return "prefill"
+
+    def create_completion(self, system, context, messages, max_tokens=None, on_text=None):
+        """
+        Runs one ChatML completion whose prefix (system and context) is served from a snapshot.
+
+        Args:
+            system (str): System prompt.
+            context (str): Shared context appended to the system prompt, or None.
+            messages (list): The turn's {"role", "content"} messages after the system prompt.
+            max_tokens (int): As for Llama.create_completion().
+            on_text (callable): If given, the completion is streamed and
+                                on_text called with each piece of text. An
+                                exception it raises stops the generation.
+
+        Returns:
+            tuple: (response, source), the Llama.create_completion() response and
+                   "memory", "disk", "prefill" or "none" (prefix not reusable).
+        """
+        system_text = system or ""
+        if context:
+            system_text = f"{system_text}\n\nCONTEXT:\n{context}" if system_text else f"CONTEXT:\n{context}"
+        prefix_text = CHATML_SYSTEM.format(content=system_text)
+        prompt_text = prefix_text + "".join(CHATML_TURN.format(**message) for message in messages) + CHATML_ASSISTANT
+
+        prefix_tokens = self.llm.tokenize(prefix_text.encode('utf-8'), add_bos=True, special=True)
+        prompt_tokens = self.llm.tokenize(prompt_text.encode('utf-8'), add_bos=True, special=True)
+
+        with self._lock:
+            # Tokenizers can merge across the boundary; only reuse an exact token prefix.
+            if prompt_tokens[:len(prefix_tokens)] == prefix_tokens and len(prompt_tokens) > len(prefix_tokens):
+                source = self._restore(prefix_text, prefix_tokens)
+            else:
+                source = "none"
+            # create_completion() keeps the longest common prefix of the loaded
+            # state and evaluates only the remaining tokens.
+            if on_text is None:
+                response = self.llm.create_completion(prompt_tokens, max_tokens=max_tokens, stop=CHATML_STOP)
+            else:
+                # Read the stream under the lock too: the model state is in use until it ends
+                chunks = self.llm.create_completion(prompt_tokens, max_tokens=max_tokens, stop=CHATML_STOP, stream=True)
+                parts = []
+                try:
+                    for chunk in chunks:
+                        parts.append(chunk["choices"][0]["text"])
+                        on_text(parts[-1])
+                finally:
+                    chunks.close()
+                response = {"choices": [{"text": "".join(parts)}], "usage": {}}
+        return response, source
+
+    def summary(self):
+        return f"Llama prefix states: {self.memory_hits} reused, {self.disk_hits} loaded from disk, {self.prefills} evaluated"
@@ -0,0 +1,138 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+DEFAULT_CACHE_DIR = ".llm_cache"
+
+
+class ResponseCache:
+    """
+    Persistent on-disk cache of LLM responses.
+
+    Entries are keyed by a hash of the model name, system prompt, user prompt
+    and a digest of any attached context (see make_key()), so re-running an
+    unchanged project returns the previous answers without calling the model.
+    Each entry is one small JSON file; when the cache grows past max_bytes the
+    least recently used entries (by file mtime, refreshed on every hit) are
+    deleted.
+
+    Args:
+        cache_dir (str): Directory holding the cache entries.
+        max_bytes (int): Size limit of the cache directory.
+        bypass (bool): If True, lookups always miss but fresh responses are
+                       still stored, which refreshes the cache.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=256 * 1024 * 1024, bypass=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self._size = None  # Computed on the first write
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model, system_prompt, prompt, context_digest=None):
+        payload = json.dumps([model, system_prompt, prompt, context_digest])
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".json")
+
+    def get(self, key, bypass=False):
+        """
+        Returns the cached response for key, or None on a miss. With bypass
+        (e.g. a retry after an invalid response), the lookup is skipped but
+        still counted as a miss.
+        """
+        if self.bypass or bypass:
+            with self._lock:
+                self.misses += 1
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                response = json.load(f)["response"]
+            os.utime(path)  # Mark as recently used
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return response
+
+    def put(self, key, response, model=None):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = json.dumps({"model": model, "created": time.time(), "response": response})
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        with self._lock:
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp_path, path)
+            if self._size is None:
+                self._size = self._scan_size()
+            else:
+                self._size += os.path.getsize(path) - old_size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def discard(self, key):
+        """Removes the entry for key, e.g. a response the caller found invalid, so it is not served again."""
+        path = self._path(key)
+        with self._lock:
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+            except FileNotFoundError:
+                return
+            if self._size is not None:
+                self._size -= size
+
+    def _entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(".json"):
+                    path = os.path.join(root, name)
+                    stat = os.stat(path)
+                    yield stat.st_mtime, stat.st_size, path
+
+    def _scan_size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        # Drop the least recently used entries until comfortably under the limit.
+        target = self.max_bytes * 0.9
+        for _, size, path in sorted(self._entries()):
+            if self._size <= target:
+                break
+            try:
+                os.remove(path)
+                self._size -= size
+            except FileNotFoundError:
+                pass
+
+    def summary(self):
+        total = self.hits + self.misses
+        rate = f"{100 * self.hits / total:.0f}%" if total else "n/a"
+        return f"LLM cache: {self.hits} hit(s), {self.misses} miss(es) (hit rate {rate})"
+
+
+def context_digest(cached_files=None):
+    """
+    A stable digest of the files attached to a request. Uses the server-side
+    SHA-256 of each uploaded file, falling back to its name, so re-uploading
+    identical content keeps the same cache keys.
+    """
+    if not cached_files:
+        return None
+    digest = hashlib.sha256()
+    for f in cached_files:
+        file_hash = getattr(f, "sha256_hash", None) or getattr(f, "name", None) or str(f)
+        digest.update(file_hash if isinstance(file_hash, bytes) else str(file_hash).encode('utf-8'))
+    return digest.hexdigest()
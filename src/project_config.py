@@ -0,0 +1,5 @@
+# The project filled when none is named: by ___main.py when run directly,
+# and by the autopdd.py subcommands given no project. It is the name of a
+# folder under provided_documents/. Kept in its own module so autopdd.py can
+# read it without importing the whole pipeline through ___main.py.
+project_name = "prime_road"
@@ -0,0 +1,230 @@
+import time
+import random
+import threading
+from context_index import estimate_tokens
+from instrumentation import span
+
+# Central scheduling of model requests under the API's quotas. Every request
+# reserves one request and its estimated input tokens from two token buckets
+# (requests and tokens per minute) before it is sent, so concurrent callers
+# queue for the quota instead of running into it. A request refused anyway
+# (HTTP 429, or 503 when the API is overloaded) is retried with jittered
+# exponential backoff, and the whole scheduler holds back for the backoff:
+# the quota is shared, so one refusal means every queued request would be
+# refused too.
+
+# Refusals worth retrying, by google.api_core exception name or HTTP code.
+RETRYABLE_ERRORS = ("ResourceExhausted", "TooManyRequests", "ServiceUnavailable")
+RETRYABLE_CODES = (429, 503)
+BACKOFF_BASE_S = 2.0
+BACKOFF_MAX_S = 60.0
+# Seconds' worth of quota that can be spent at once. Any rolling minute can
+# see up to (60 + BURST_S) / 60 of the quota, so leave a little headroom in
+# the configured rates.
+BURST_S = 10
+
+
+def is_retryable(error):
+    """True if error is a rate-limit or overload refusal."""
+    return type(error).__name__ in RETRYABLE_ERRORS or getattr(error, "code", None) in RETRYABLE_CODES
+
+
+def backoff_delay(attempt, base_s=BACKOFF_BASE_S, max_s=BACKOFF_MAX_S):
+    """Seconds to wait before retry number attempt + 1: base_s * 2**attempt (at most max_s), jittered down by up to half."""
+    delay = min(max_s, base_s * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+
+def estimate_request_tokens(content):
+    """Estimated input tokens of a generate_content() request: its text parts, and uploaded files by size."""
+    if isinstance(content, str):
+        return estimate_tokens(content)
+    tokens = 0
+    for part in content or ():
+        if isinstance(part, str):
+            tokens += estimate_tokens(part)
+        else:
+            tokens += int(getattr(part, "size_bytes", 0) or 0) // 4
+    return tokens
+
+
+class TokenBucket:
+    """
+    A quota refilled continuously at rate_per_minute, holding at most
+    capacity. Not thread-safe; RequestScheduler serializes access.
+
+    reserve() takes from the bucket at once, going into debt if needed, and
+    returns how long the caller must wait until the debt is repaid, so
+    callers are served in the order they reserved.
+    """
+
+    def __init__(self, rate_per_minute, capacity):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(1.0, capacity)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount, now):
+        """Takes amount (a request larger than the whole bucket takes the whole bucket); returns the seconds to wait."""
+        self._refill(now)
+        self.level -= min(amount, self.capacity)
+        return max(0.0, -self.level / self.rate)
+
+    def refund(self, amount, now):
+        """Gives back amount (negative: takes more), once a request's actual usage is known."""
+        self._refill(now)
+        self.level = min(self.capacity, self.level + amount)
+
+
+class _HeldStream:
+    """
+    A streamed response that keeps its in-flight slot until it has been read
+    to the end (or dropped), since the model is still generating until then.
+    """
+
+    def __init__(self, response, release):
+        self._response = response
+        self._release = release
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def __iter__(self):
+        try:
+            yield from self._response
+        finally:
+            self.release()
+
+    def release(self):
+        if self._release is not None:
+            release, self._release = self._release, None
+            release()
+
+    def __del__(self):
+        self.release()
+
+
+class RequestScheduler:
+    """
+    Runs model requests under requests-per-minute and tokens-per-minute
+    quotas and a cap on requests in flight, retrying refused requests. Safe
+    to share between threads (and projects, in batch runs).
+
+    Args:
+        requests_per_minute (int): Request quota.
+        tokens_per_minute (int): Input token quota. 0 = not limited.
+        max_in_flight (int): Requests running at the same time.
+        max_retries (int): Retries of a refused request before its error is raised.
+    """
+
+    def __init__(self, requests_per_minute=60, tokens_per_minute=0, max_in_flight=8, max_retries=5):
+        self.requests = TokenBucket(requests_per_minute, requests_per_minute * BURST_S / 60)
+        self.tokens = TokenBucket(tokens_per_minute, tokens_per_minute * BURST_S / 60) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._lock = threading.Lock()
+        self._paused_until = 0.0
+        # Metrics
+        self.queued = self.max_queued = self.in_flight = 0
+        self.completed = self.retried = self.failed = 0
+        self.waited_s = 0.0
+
+    def _start_time(self, estimated_tokens):
+        """Reserves quota for one request; returns the monotonic time it may be sent."""
+        with self._lock:
+            now = time.monotonic()
+            wait = self.requests.reserve(1, now)
+            if self.tokens:
+                wait = max(wait, self.tokens.reserve(estimated_tokens, now))
+            return max(now + wait, self._paused_until)
+
+    def _acquire(self):
+        self._slots.acquire()
+        with self._lock:
+            self.queued -= 1
+            self.in_flight += 1
+
+    def _release(self):
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+    def submit(self, func, *args, estimated_tokens=0, **kwargs):
+        """
+        Calls func(*args, **kwargs) once the quota and an in-flight slot allow,
+        retrying it after rate-limit and overload errors. A streamed response
+        (stream=True) keeps its slot until it has been read.
+
+        Args:
+            estimated_tokens (int): The request's input tokens, as reserved
+                                    from the token quota.
+        """
+        with span("llm.schedule", est_tokens=estimated_tokens) as s:
+            with self._lock:
+                self.queued += 1
+                self.max_queued = max(self.max_queued, self.queued)
+                s["queue_depth"] = self.queued
+            waited = 0.0
+            for attempt in range(self.max_retries + 1):
+                start_at = self._start_time(estimated_tokens)
+                queued_at = time.monotonic()
+                if start_at > queued_at:
+                    time.sleep(start_at - queued_at)
+                self._acquire()
+                waited += time.monotonic() - queued_at
+                streamed = False
+                try:
+                    result = func(*args, **kwargs)
+                    if kwargs.get("stream"):
+                        streamed = True
+                        result = _HeldStream(result, self._release)
+                except Exception as e:
+                    if not is_retryable(e) or attempt == self.max_retries:
+                        with self._lock:
+                            self.failed += 1
+                            self.waited_s += waited
+                        s["waited_ms"] = round(waited * 1000, 1)
+                        raise
+                    delay = backoff_delay(attempt)
+                    with self._lock:
+                        # Every queued request would be refused too: hold them all back
+                        self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                        self.retried += 1
+                        self.queued += 1
+                    s["retries"] = attempt + 1
+                    print(f"  > Rate limited ({type(e).__name__}); retrying in {delay:.1f}s...")
+                    continue
+                finally:
+                    if not streamed:
+                        self._release()
+                self._record_usage(result, estimated_tokens, streamed)
+                with self._lock:
+                    self.completed += 1
+                    self.waited_s += waited
+                s["waited_ms"] = round(waited * 1000, 1)
+                return result
+
+    def _record_usage(self, result, estimated_tokens, streamed):
+        """Corrects the token quota by the difference between the estimated and the reported input tokens."""
+        if self.tokens is None or streamed:
+            return
+        actual = getattr(getattr(result, "usage_metadata", None), "prompt_token_count", None)
+        if isinstance(actual, int):
+            with self._lock:
+                self.tokens.refund(estimated_tokens - actual, time.monotonic())
+
+    def metrics(self):
+        """Current queue depth and in-flight requests, and totals so far."""
+        with self._lock:
+            return {"queued": self.queued, "max_queued": self.max_queued, "in_flight": self.in_flight,
+                    "completed": self.completed, "retried": self.retried, "failed": self.failed,
+                    "waited_s": round(self.waited_s, 1)}
+
+    def summary(self):
+        m = self.metrics()
+        return (f"Request scheduler: {m['completed']} request(s) sent, {m['retried']} retried after rate limiting, "
+                f"{m['failed']} failed; up to {m['max_queued']} queued, {m['waited_s']}s spent waiting for quota or a slot")
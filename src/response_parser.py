@@ -0,0 +1,622 @@
+import re
+import html
+import time
+
+# Parsing of model responses (Pandoc-flavoured Markdown) into blocks.
+#
+# parse_markdown_blocks() turns a response into a flat list of block dicts in
+# a single pass over its lines:
+#   {"type": "heading",   "line": i, "level": 1-6, "text": str}
+#   {"type": "paragraph", "line": i, "text": str}
+#   {"type": "list_item", "line": i, "text": str, "loose": bool, "ordered": bool,
+#                         "marker": str, "indent": int}
+#   {"type": "table",     "line": i, "rows": [[str, ...], ...], "has_header": bool,
+#                         "raw_rows": [[str, ...], ...], "width": int}
+#   {"type": "quote",     "line": i, "text": str}
+#   {"type": "code",      "line": i, "text": str}
+#   {"type": "rule",      "line": i}
+#
+# The rules deliberately follow what `pandoc -f markdown` does with the same
+# input (smart punctuation, paragraphs not interrupted by lists or headings,
+# tables padded/truncated to the separator's width, all-empty header rows
+# dropped), so rendering these blocks gives the same document as the Pandoc
+# path in word_editor.
+#
+# validate_response() uses the same blocks to check a response against the
+# template section it fills (tables, headers, row widths), so malformed rows
+# can be found, and re-requested, individually; find_missing_fields() lists
+# the INFO_NOT_FOUND fields a later refill can target.
+
+_ATX_HEADING_RE = re.compile(r"^ {0,3}(#{1,6})[ \t]+(.*?)(?:[ \t]+#+)?[ \t]*$")
+_SETEXT_RE = re.compile(r"^ {0,3}(=+|-+)[ \t]*$")
+_RULE_RE = re.compile(r"^ {0,3}(?:(?:\*[ \t]*){3,}|(?:-[ \t]*){3,}|(?:_[ \t]*){3,})$")
+_FENCE_RE = re.compile(r"^ {0,3}(`{3,}|~{3,})")
+_LIST_RE = re.compile(r"^([ \t]*)([-*+]|\d{1,9}[.)])[ \t]+(.*)$")
+_TABLE_SEPARATOR_RE = re.compile(r"^[ \t]*\|?[ \t]*:?-+:?[ \t]*(?:\|[ \t]*:?-+:?[ \t]*)*\|?[ \t]*$")
+_QUOTE_RE = re.compile(r"^ {0,3}>[ ]?(.*)$")
+_HARD_BREAK_RE = re.compile(r"(?:  +|\\)$")
+
+# Inline markup
+_CODE_SPAN_RE = re.compile(r"(`+)(.+?)\1")
+_ESCAPE_RE = re.compile(r"\\([\\`*_{}\[\]()#+\-.!|<>~\"'])")
+_IMAGE_OR_LINK_RE = re.compile(r"!?\[([^\]]*)\]\([^)]*\)")
+_AUTOLINK_RE = re.compile(r"<((?:https?|ftp|mailto):[^>\s]+)>")
+_HTML_TAG_RE = re.compile(r"</?[A-Za-z][^>]*>")
+_STRONG_EMPH_RE = re.compile(r"(\*{1,3})(?=\S)(.+?)(?<=\S)\1")
+_UNDERSCORE_EMPH_RE = re.compile(r"(?<![A-Za-z0-9_])(_{1,3})(?=\S)(.+?)(?<=\S)\1(?![A-Za-z0-9_])")
+_STRIKEOUT_RE = re.compile(r"~~(?=\S)(.+?)(?<=\S)~~")
+_PLACEHOLDER_RE = re.compile(r"\[[^\]]*\](?!\()")
+_PROTECTED_RE = re.compile("\uE000(\\d+)\uE001")  # Private-use sentinels around protected text
+
+
+def _smart_punctuation(text):
+    """Pandoc's `smart` extension: curly quotes, en/em dashes and ellipses."""
+    text = text.replace("---", "—").replace("--", "–").replace("...", "…")
+    out = []
+    for i, ch in enumerate(text):
+        if ch not in "'\"":
+            out.append(ch)
+            continue
+        before = text[i - 1] if i else " "
+        after = text[i + 1] if i + 1 < len(text) else " "
+        opening = (before.isspace() or before in "([{—–") and not after.isspace()
+        if ch == '"':
+            out.append("“" if opening else "”")
+        elif before.isalnum() and after.isalnum():
+            out.append("’")  # Apostrophe
+        else:
+            out.append("‘" if opening else "’")
+    return "".join(out)
+
+
+def render_inline(text, smart=True):
+    """
+    Reduces Markdown inline markup to the plain text Pandoc would produce:
+    emphasis markers, links, raw HTML tags and escapes are removed, entities
+    decoded and (if smart) quotes/dashes/ellipses typeset. Code spans and
+    escaped characters are kept verbatim.
+    """
+    protected = []
+
+    def protect(value):
+        protected.append(value)
+        return f"\uE000{len(protected) - 1}\uE001"
+
+    text = _CODE_SPAN_RE.sub(lambda m: protect(m.group(2).strip()), text)
+    text = _ESCAPE_RE.sub(lambda m: protect(m.group(1)), text)
+    text = _AUTOLINK_RE.sub(lambda m: protect(m.group(1)), text)
+    text = _IMAGE_OR_LINK_RE.sub(r"\1", text)
+    text = _HTML_TAG_RE.sub("", text)
+    # Apply repeatedly so nested emphasis (***x***, **_x_**) is fully removed
+    previous = None
+    while previous != text:
+        previous = text
+        text = _STRONG_EMPH_RE.sub(r"\2", text)
+        text = _UNDERSCORE_EMPH_RE.sub(r"\2", text)
+        text = _STRIKEOUT_RE.sub(r"\1", text)
+    text = html.unescape(text)
+    if smart:
+        text = _smart_punctuation(text)
+    return _PROTECTED_RE.sub(lambda m: protected[int(m.group(1))], text)
+
+
+def _join_lines(lines, smart=True):
+    """Joins paragraph lines: soft breaks become spaces, hard breaks newlines."""
+    parts = []
+    for i, line in enumerate(lines):
+        last = i == len(lines) - 1
+        if not last and _HARD_BREAK_RE.search(line):
+            parts.append(render_inline(_HARD_BREAK_RE.sub("", line).strip(), smart) + "\n")
+        else:
+            parts.append(render_inline(line.strip(), smart) + ("" if last else " "))
+    return "".join(parts)
+
+
+def split_table_row(line):
+    """Splits a pipe-table row into its raw cell strings (escaped pipes kept)."""
+    line = line.strip()
+    if line.startswith("|"):
+        line = line[1:]
+    if line.endswith("|") and not line.endswith("\\|"):
+        line = line[:-1]
+    return [cell.strip() for cell in re.split(r"(?<!\\)\|", line)]
+
+
+def is_table_separator(line):
+    return "-" in line and bool(_TABLE_SEPARATOR_RE.match(line))
+
+
+def _is_table_start(lines, i):
+    return "|" in lines[i] and i + 1 < len(lines) and is_table_separator(lines[i + 1])
+
+
+def parse_markdown_blocks(markdown, smart=True):
+    """
+    Parses a Markdown response into a list of block dicts (see the module
+    comment for their shape). Runs in time linear in the response length.
+    """
+    lines = markdown.replace("\r\n", "\n").replace("\t", "    ").split("\n")
+    blocks = []
+    i, n = 0, len(lines)
+    list_stack = []  # Items of each open (possibly nested) list, to mark them loose
+
+    while i < n:
+        line = lines[i]
+        if not line.strip():
+            i += 1
+            continue
+        start = i
+
+        # Fenced code block
+        fence = _FENCE_RE.match(line)
+        if fence:
+            marker = fence.group(1)
+            i += 1
+            code = []
+            while i < n and not lines[i].strip().startswith(marker):
+                code.append(lines[i])
+                i += 1
+            blocks.append({"type": "code", "line": start, "text": "\n".join(code)})
+            i += 1
+            list_stack = []
+            continue
+
+        # ATX heading
+        heading = _ATX_HEADING_RE.match(line)
+        if heading:
+            blocks.append({"type": "heading", "line": start, "level": len(heading.group(1)),
+                           "text": render_inline(heading.group(2).strip(), smart)})
+            i += 1
+            list_stack = []
+            continue
+
+        # Horizontal rule (checked before lists: "- - -" is a rule)
+        if _RULE_RE.match(line):
+            blocks.append({"type": "rule", "line": start})
+            i += 1
+            list_stack = []
+            continue
+
+        # Pipe table: a row with pipes directly followed by a separator line
+        if _is_table_start(lines, i):
+            raw_rows = [split_table_row(lines[i])]
+            width = len(split_table_row(lines[i + 1]))
+            i += 2
+            while i < n and lines[i].strip() and "|" in lines[i]:
+                raw_rows.append(split_table_row(lines[i]))
+                i += 1
+            rows = [[render_inline(cell, smart) for cell in (row + [""] * width)[:width]] for row in raw_rows]
+            has_header = any(rows[0])
+            if not has_header:
+                rows = rows[1:]
+            blocks.append({"type": "table", "line": start, "rows": rows, "has_header": has_header,
+                           "raw_rows": raw_rows, "width": width})
+            list_stack = []
+            continue
+
+        # Block quote
+        if _QUOTE_RE.match(line):
+            quoted = []
+            while i < n and lines[i].strip() and (_QUOTE_RE.match(lines[i]) or quoted):
+                match = _QUOTE_RE.match(lines[i])
+                quoted.append(match.group(1) if match else lines[i])
+                i += 1
+            blocks.append({"type": "quote", "line": start, "text": _join_lines(quoted, smart)})
+            list_stack = []
+            continue
+
+        # List item (with its lazy continuation lines)
+        item = _LIST_RE.match(line)
+        if item:
+            marker = item.group(2)[-1] if item.group(2)[0].isdigit() else item.group(2)
+            indent = len(item.group(1))
+            while list_stack and list_stack[-1][0]["indent"] > indent:
+                list_stack.pop()  # Back out of nested lists
+            if list_stack and list_stack[-1][0]["indent"] == indent and list_stack[-1][0]["marker"] != marker:
+                list_stack.pop()  # A different bullet character or numbering delimiter starts a new list
+            current_list = list_stack[-1] if list_stack and list_stack[-1][0]["indent"] == indent else None
+            if current_list is not None and start > 0 and not lines[start - 1].strip():
+                # A blank line between items makes the whole list loose
+                for list_item in current_list:
+                    list_item["loose"] = True
+            item_lines = [item.group(3)]
+            i += 1
+            while (i < n and lines[i].strip() and not _LIST_RE.match(lines[i])
+                   and not _FENCE_RE.match(lines[i]) and not _is_table_start(lines, i)):
+                item_lines.append(lines[i])
+                i += 1
+            block = {"type": "list_item", "line": start, "text": _join_lines(item_lines, smart),
+                     "loose": bool(current_list) and current_list[0]["loose"],
+                     "ordered": item.group(2)[0].isdigit(), "marker": marker, "indent": indent}
+            if current_list is None:
+                current_list = []
+                list_stack.append(current_list)
+            current_list.append(block)
+            blocks.append(block)
+            # An indented paragraph after a blank line continues the item
+            while (i + 1 < n and not lines[i].strip() and lines[i + 1].startswith(("  ", "    "))
+                   and not _LIST_RE.match(lines[i + 1])):
+                i += 1
+                paragraph_start = i
+                paragraph = []
+                while i < n and lines[i].strip() and not _LIST_RE.match(lines[i]):
+                    paragraph.append(lines[i])
+                    i += 1
+                for list_item in current_list:
+                    list_item["loose"] = True
+                continuation = dict(block, line=paragraph_start, text=_join_lines(paragraph, smart),
+                                    loose=True, continuation=True)
+                current_list.append(continuation)
+                blocks.append(continuation)
+            continue
+
+        # Paragraph (or setext heading). Lists, headings and quotes do not
+        # interrupt a paragraph in Pandoc Markdown; fenced code does.
+        paragraph = [line]
+        i += 1
+        setext_level = None
+        while i < n and lines[i].strip() and not _FENCE_RE.match(lines[i]):
+            setext = _SETEXT_RE.match(lines[i])
+            if setext and len(paragraph) == 1 and not _is_table_start(lines, i - 1):
+                setext_level = 1 if setext.group(1)[0] == "=" else 2
+                i += 1
+                break
+            paragraph.append(lines[i])
+            i += 1
+        if setext_level:
+            blocks.append({"type": "heading", "line": start, "level": setext_level,
+                           "text": render_inline(paragraph[0].strip(), smart)})
+        else:
+            blocks.append({"type": "paragraph", "line": start, "text": _join_lines(paragraph, smart)})
+        list_stack = []
+
+    return blocks
+
+
+def table_row_line(table, row_index):
+    """Line number of a table's raw row (the separator line is not a row)."""
+    return table["line"] + (row_index + 1 if row_index else 0)
+
+
+def _normalize_cell(text):
+    return " ".join(render_inline(text, smart=False).split()).lower()
+
+
+def _is_fixed_cell(text):
+    # Template cells that must come back unchanged: not empty and not a
+    # "[item of information]" placeholder the model is meant to fill.
+    return bool(text.strip()) and not _PLACEHOLDER_RE.search(text)
+
+
+def validate_response(response, infilling_info):
+    """
+    Checks a (cleaned) response against the structure of the template
+    section it fills: every template table must come back, in order, with
+    the same columns and header labels, and every row must have that many cells;
+    Markdown headings in the template must be kept.
+
+    Returns:
+        list: Problem dicts, empty if the response is valid. Each has a
+              "kind" ("empty", "heading", "table_count", "width", "header"
+              or "row"), a "message", and for table problems the "table"
+              index and (for "header"/"row") the raw "row" index.
+    """
+    if not response.strip():
+        return [{"kind": "empty", "message": "empty response"}]
+    expected = parse_markdown_blocks(infilling_info, smart=False)
+    actual = parse_markdown_blocks(response, smart=False)
+    problems = []
+
+    headings = [_normalize_cell(b["text"]) for b in actual if b["type"] == "heading"]
+    for block in expected:
+        if block["type"] == "heading" and _normalize_cell(block["text"]) not in headings:
+            problems.append({"kind": "heading", "message": f"missing heading {block['text']!r}"})
+
+    expected_tables = [b for b in expected if b["type"] == "table"]
+    actual_tables = [b for b in actual if b["type"] == "table"]
+    if len(expected_tables) != len(actual_tables):
+        problems.append({"kind": "table_count",
+                         "message": f"expected {len(expected_tables)} table(s), got {len(actual_tables)}"})
+        return problems
+
+    for t, (template_table, table) in enumerate(zip(expected_tables, actual_tables)):
+        width = template_table["width"]
+        if table["width"] != width:
+            problems.append({"kind": "width", "table": t,
+                             "message": f"table {t + 1} has {table['width']} column(s), expected {width}"})
+            continue
+        header = table["raw_rows"][0]
+        if any(_is_fixed_cell(cell) and (c >= len(header) or _normalize_cell(header[c]) != _normalize_cell(cell))
+               for c, cell in enumerate(template_table["raw_rows"][0])):
+            problems.append({"kind": "header", "table": t, "row": 0,
+                             "message": f"table {t + 1} header differs from the template"})
+        for r, row in enumerate(table["raw_rows"][1:], start=1):
+            if len(row) != width:
+                problems.append({"kind": "row", "table": t, "row": r,
+                                 "message": f"table {t + 1} row {r} has {len(row)} cell(s), expected {width}"})
+    return problems
+
+
+def repair_headers(response, infilling_info, problems):
+    """
+    Fixes "header" problems locally by putting the template's header cells
+    back (headers must be kept exactly as in the template anyway). Cells
+    that were placeholders in the template keep the model's value.
+
+    Returns:
+        tuple: (response, remaining problems)
+    """
+    header_problems = [p for p in problems if p["kind"] == "header"]
+    if not header_problems:
+        return response, problems
+    template_tables = [b for b in parse_markdown_blocks(infilling_info, smart=False) if b["type"] == "table"]
+    tables = [b for b in parse_markdown_blocks(response, smart=False) if b["type"] == "table"]
+    lines = response.split("\n")
+    for problem in header_problems:
+        template_header = template_tables[problem["table"]]["raw_rows"][0]
+        header = (tables[problem["table"]]["raw_rows"][0] + [""] * len(template_header))[:len(template_header)]
+        cells = [cell if _is_fixed_cell(cell) else filled for cell, filled in zip(template_header, header)]
+        lines[table_row_line(tables[problem["table"]], 0)] = "| " + " | ".join(cells) + " |"
+    return "\n".join(lines), [p for p in problems if p["kind"] != "header"]
+
+
+def malformed_rows(response, problems):
+    """
+    The rows behind "row" problems, for a targeted re-request.
+
+    Returns:
+        list: (line_number, header_cells, raw_line) per malformed row.
+    """
+    tables = [b for b in parse_markdown_blocks(response, smart=False) if b["type"] == "table"]
+    lines = response.split("\n")
+    rows = []
+    for problem in problems:
+        if problem["kind"] == "row":
+            table = tables[problem["table"]]
+            line_number = table_row_line(table, problem["row"])
+            rows.append((line_number, table["raw_rows"][0], lines[line_number]))
+    return rows
+
+
+def patch_rows(response, rows, replacement_text):
+    """
+    Puts corrected rows (one Markdown table row per malformed row, in order,
+    as returned by the model) back into the response.
+
+    Returns:
+        str: The patched response, or None if the replacement does not have
+             exactly one row of the right width per malformed row.
+    """
+    replacements = [line.strip() for line in replacement_text.replace("`", "").split("\n")
+                    if "|" in line and not is_table_separator(line)]
+    if len(replacements) != len(rows):
+        return None
+    lines = response.split("\n")
+    for (line_number, header, _), replacement in zip(rows, replacements):
+        if len(split_table_row(replacement)) != len(header):
+            return None
+        lines[line_number] = replacement
+    return "\n".join(lines)
+
+
+# --- INFO_NOT_FOUND fields ---
+# The field runs to the next field, cell border or line end, minus trailing punctuation.
+MISSING_FIELD_RE = re.compile(r"INFO_NOT_FOUND:?[ \t]*((?:(?!INFO_NOT_FOUND)[^|\n])*?)(?=[ \t.,;]*(?:INFO_NOT_FOUND|\||\n|$))")
+_FIELD_ANSWER_RE = re.compile(r"^\s*(\d+)\s*[.:)]\s*(.*?)\s*$")
+
+
+def find_missing_fields(text):
+    """The distinct "<information>" parts of the INFO_NOT_FOUND fields in text, in order."""
+    fields = []
+    for match in MISSING_FIELD_RE.finditer(text):
+        field = match.group(1).strip()
+        if field and field not in fields:
+            fields.append(field)
+    return fields
+
+
+def parse_field_answers(text, fields):
+    """
+    Parses a field refill answer ("<number>: <value>" per line).
+
+    Returns:
+        dict: {field: value} for every field the model found a value for.
+              Fields answered INFO_NOT_FOUND (or not answered) are left out.
+    """
+    answers = {}
+    for line in text.replace("`", "").split("\n"):
+        match = _FIELD_ANSWER_RE.match(line)
+        if not match or not 1 <= int(match.group(1)) <= len(fields):
+            continue
+        value = " ".join(match.group(2).split())
+        if value and "INFO_NOT_FOUND" not in value:
+            answers[fields[int(match.group(1)) - 1]] = value
+    return answers
+
+
+def parse_schema_answers(text, count):
+    """
+    Parses the answer to a field schema request ("<number>: <value>", see
+    assemble_schema_prompt()). A value may go on over the following lines
+    (free-text fields); a line only starts the next answer if its number is
+    higher than the last one's, so a numbered list inside a free-text answer
+    stays part of it.
+
+    Returns:
+        dict: {number: value} for every field the model found a value for.
+              Fields answered INFO_NOT_FOUND (or not answered) are left out.
+    """
+    answers, current = {}, 0
+    for line in text.replace("`", "").split("\n"):
+        match = _FIELD_ANSWER_RE.match(line)
+        if match and current < int(match.group(1)) <= count:
+            current = int(match.group(1))
+            answers[current] = [match.group(2)]
+        elif current:
+            answers[current].append(line)
+    found = {}
+    for number, lines in answers.items():
+        value = "\n".join(lines).strip()
+        # A free-text answer may mention INFO_NOT_FOUND for some detail; only a bare one means missing
+        if value and not re.fullmatch(r"INFO_NOT_FOUND\b[^\n]*", value):
+            found[number] = value
+    return found
+
+
+# --- Packed requests ---
+# Several small sections can be filled with one request (see
+# fill_packed_sections()). Each template section is sent between these
+# delimiter lines, which the model repeats around each filled section.
+
+PACK_START = "<<<SECTION {n}>>>"
+PACK_END = "<<<END SECTION {n}>>>"
+_PACK_MARKER_RE = re.compile(r"^\s*<<<\s*(END\s+)?SECTION\s+(\d+)\s*>>>\s*$", re.I)
+
+
+def pack_sections(infilling_infos):
+    """The template sections, each between its numbered delimiters."""
+    return "\n\n".join(f"{PACK_START.format(n=n)}\n{info.strip()}\n{PACK_END.format(n=n)}"
+                        for n, info in enumerate(infilling_infos, start=1))
+
+
+def split_packed_response(response, count):
+    """
+    Splits the response to a packed request into its count section responses.
+
+    Returns:
+        list: The text between each pair of delimiters, in order, or None
+              unless every section came back exactly once, in order, with
+              only blank lines (or code fences) outside the delimiters.
+    """
+    parts, current = [], None
+    for line in response.split("\n"):
+        marker = _PACK_MARKER_RE.match(line)
+        if marker is None:
+            if current is not None:
+                current.append(line)
+            elif line.strip() and not line.strip().startswith("```"):
+                return None
+            continue
+        if int(marker.group(2)) != len(parts) + 1:
+            return None
+        if marker.group(1) is None:
+            if current is not None:
+                return None
+            current = []
+        else:
+            if current is None:
+                return None
+            parts.append("\n".join(current).strip("\n"))
+            current = None
+    if current is not None or len(parts) != count:
+        return None
+    return parts
+
+
+# --- Streaming ---
+# Responses can be checked while they are generated (see ask_gemini() and
+# ask_llama() with stream=...), so a response that has clearly gone wrong is
+# abandoned after a few lines instead of paid for in full. Only problems no
+# later text can fix, and that validate_response() would reject anyway (or
+# that would otherwise end up in the document), abort a stream.
+
+# Conversational openings ("Here is the completed section:", "Sure, ...")
+_COMMENTARY_RE = re.compile(
+    r"^\W*(?:here(?:'s| is| are)\b|sure\b|certainly\b|of course\b|okay\b|ok,|below (?:is|are)\b|"
+    r"i (?:have|will|can|am|could|would)\b|i'(?:ve|ll|m)\b|as an ai\b|absolutely\b)", re.I)
+
+
+class StreamDiverged(Exception):
+    """Raised by StreamingResponseParser.feed() when the response has clearly diverged from the template."""
+
+    def __init__(self, reason, partial_text):
+        super().__init__(reason)
+        self.reason = reason
+        self.partial_text = partial_text
+
+
+class StreamingResponseParser:
+    """
+    Incremental check of a response against the template section it fills,
+    fed chunk by chunk as the model generates it.
+
+    Complete lines are checked as they arrive, and feed() raises
+    StreamDiverged as soon as the response:
+      - opens with commentary instead of the section content,
+      - starts a table the template does not have, or
+      - starts a table with a different number of columns than the template's.
+
+    Args:
+        infilling_info (str): The template section (as sent to the model).
+        on_text (callable): Called with every chunk, e.g. to show the
+                            response live.
+    """
+
+    def __init__(self, infilling_info, on_text=None):
+        blocks = parse_markdown_blocks(infilling_info, smart=False)
+        self.table_widths = [block["width"] for block in blocks if block["type"] == "table"]
+        body_lines = [line for line in infilling_info.strip().split("\n")[1:] if line.strip()]
+        # A template that itself opens like commentary can't be told apart from it
+        self.check_commentary = not (body_lines and _COMMENTARY_RE.match(body_lines[0].replace("`", "")))
+        self.on_text = on_text
+        self.started = time.perf_counter()
+        self.first_content_s = None
+        self._parts = []
+        self._pending = ""
+        self._previous = ""
+        self._previous_opens_block = False  # the previous line followed a blank line
+        self._blank = True
+        self._seen_content = False
+        self._table = None  # index of the table being read
+        self._tables_seen = 0
+
+    @property
+    def text(self):
+        return "".join(self._parts)
+
+    def feed(self, chunk):
+        if not chunk:
+            return
+        self._parts.append(chunk)
+        if self.on_text:
+            self.on_text(chunk)
+        if self.first_content_s is None and chunk.strip():
+            self.first_content_s = time.perf_counter() - self.started
+        lines = (self._pending + chunk).split("\n")
+        self._pending = lines.pop()
+        for line in lines:
+            self._check_line(line.replace("`", ""))
+
+    def finish(self):
+        """Checks the last line and returns the whole response text."""
+        if self._pending:
+            self._check_line(self._pending.replace("`", ""))
+            self._pending = ""
+        return self.text
+
+    def _diverged(self, reason):
+        raise StreamDiverged(reason, self.text)
+
+    def _check_line(self, line):
+        if not line.strip():
+            self._table = None
+            self._previous, self._blank = line, True
+            return
+        if not self._seen_content:
+            self._seen_content = True
+            if self.check_commentary and _COMMENTARY_RE.match(line):
+                self._diverged(f"commentary instead of the section content ({line.strip()[:60]!r})")
+        if self._table is not None and "|" not in line:
+            self._table = None
+        # Only a table opening a block is one (see parse_markdown_blocks());
+        # rows straight under a paragraph are left to validate_response()
+        if self._table is None and self._previous_opens_block and "|" in self._previous and is_table_separator(line):
+            self._table = self._tables_seen
+            self._tables_seen += 1
+            if self._table >= len(self.table_widths):
+                self._diverged(f"table {self._table + 1} started; the template has {len(self.table_widths)}")
+            width = len(split_table_row(line))
+            if width != self.table_widths[self._table]:
+                self._diverged(f"table {self._table + 1} has {width} column(s), expected {self.table_widths[self._table]}")
+        self._previous_opens_block, self._blank = self._blank, False
+        self._previous = line
@@ -0,0 +1,251 @@
+import os
+import re
+import json
+from collections import Counter
+from context_index import ContextIndex, tokenize, estimate_tokens
+from context_manifest import file_sha256
+from context_manager import extract_pages
+from instrumentation import span
+
+RULEBOOK_INDEX_FILENAME = ".rulebook_index.json"
+# Bump whenever a change to the clause splitting alters the index.
+RULEBOOK_INDEX_VERSION = 1
+
+# Long clauses (e.g. a monitoring parameter table spanning pages) are split
+# into parts of about this many words, each citable by clause and page.
+CLAUSE_WORDS = 250
+
+# Clauses scoring below this fraction of the best match are not relevant enough to send.
+RELEVANCE_RATIO = 0.5
+# Added to a clause's BM25 score for the share of the PDD section title's terms
+# found in the clause's own or parent titles ("Baseline Scenario" -> 6.1
+# Area-based Approach, under 6 BASELINE SCENARIO).
+TITLE_WEIGHT = 5.0
+
+# Numbered headings ("8.2.1.2 Area-based Quantification ...", "A1.3 Performance
+# Benchmark", "APPENDIX 1: PERFORMANCE METHOD"). Contents-list lines (with
+# dot leaders) are excluded separately.
+_HEADING_RE = re.compile(r"^(?:APPENDIX\s+(\d{1,2})\s*:?\s*(\S.*)|(A?)(\d{1,2}(?:\.\d{1,2}){0,4})\s+([A-Z][^\n]{2,150}))$")
+_LEADER_RE = re.compile(r"\.{4,}|…{2,}")
+
+
+def _heading_key(match):
+    """Sortable key of a heading's number; appendix numbers sort after the body's."""
+    if match.group(1):
+        return (100 + int(match.group(1)),)
+    parts = [int(part) for part in match.group(4).split(".")]
+    if match.group(3):
+        parts[0] += 100
+    return tuple(parts)
+
+
+def _follows(key, last_key):
+    """
+    True if heading number key can come right after last_key: a first
+    subclause (4.3 -> 4.3.1), or the next number at some level (4.3 -> 4.4,
+    5), with any deeper levels starting at 1 (4.3 -> 5.1, if the heading of
+    5 itself was lost). The first appendix (A1) may follow any body clause.
+    """
+    if key == last_key + (1,):
+        return True
+    if key[0] == 101 and last_key[0] < 100:
+        return all(part == 1 for part in key[1:])
+    for level in range(len(last_key)):
+        if (key[:level] == last_key[:level] and len(key) > level and key[level] == last_key[level] + 1
+                and all(part == 1 for part in key[level + 1:])):
+            return True
+    return False
+
+
+def _looks_like_title(title):
+    """Headings are upper or title case; footnotes ("5 Land use category as defined ...") are sentences."""
+    words = [word for word in title.split() if len(word) > 3 and word[0].isalpha()]
+    return not title.endswith(".") and (not words or sum(word[0].isupper() for word in words) >= 0.75 * len(words))
+
+
+def _running_header(pages):
+    """The first line repeated on most pages (e.g. "VM0047, v1.1"), or None."""
+    first_lines = Counter(text.strip().split("\n", 1)[0].strip() for _, text in pages if text.strip())
+    if not first_lines:
+        return None
+    line, count = first_lines.most_common(1)[0]
+    return line if count > len(pages) / 2 else None
+
+
+def split_clauses(pages):
+    """
+    Splits a rulebook's pages into numbered clauses.
+
+    A line is taken as a heading only if its number follows the previous
+    heading's (see _follows()) and its title reads like one, which keeps
+    footnotes, numbered list items and table cells from being mistaken for
+    headings. Text before the first
+    heading (title page, contents) is dropped.
+
+    Args:
+        pages (list): (page_number, page_text) tuples.
+
+    Returns:
+        list: dicts with "number", "title", "parents" (titles of the
+              enclosing clauses), "pages" ([first, last]) and "text", long
+              clauses split into parts of about CLAUSE_WORDS words.
+    """
+    header = _running_header(pages)
+    clauses, current, last_key = [], None, (0,)
+    titles = {}
+    for page_number, page_text in pages:
+        for line in page_text.split("\n"):
+            line = line.strip()
+            if not line or line == header:
+                continue
+            match = _HEADING_RE.match(line) if not _LEADER_RE.search(line) else None
+            if match and _looks_like_title(match.group(2) or match.group(5)):
+                key = _heading_key(match)
+                if _follows(key, last_key):
+                    last_key = key
+                    number = f"Appendix {match.group(1)}" if match.group(1) else match.group(3) + match.group(4)
+                    title = (match.group(2) or match.group(5)).strip()
+                    titles[key] = title
+                    parents = " > ".join(titles[key[:i]] for i in range(1, len(key)) if key[:i] in titles)
+                    current = {"number": number, "title": title, "parents": parents,
+                               "pages": [page_number, page_number], "lines": [line], "words": 0}
+                    clauses.append(current)
+                    continue
+            if current is None:
+                continue
+            current["lines"].append(line)
+            current["pages"][1] = page_number
+            current["words"] += len(line.split())
+            if current["words"] >= CLAUSE_WORDS:
+                # Start the next part of the same clause
+                current = {"number": current["number"], "title": current["title"], "parents": current["parents"],
+                           "pages": [page_number, page_number],
+                           "lines": [f"{current['number']} {current['title']} (continued)"], "words": 0}
+                clauses.append(current)
+
+    return [{"number": c["number"], "title": c["title"], "parents": c["parents"], "pages": c["pages"], "text": "\n".join(c["lines"])}
+            for c in clauses if len(c["lines"]) > 1]
+
+
+class RulebookIndex(ContextIndex):
+    """
+    BM25 index over the numbered clauses of the methodology rulebooks in a
+    folder (e.g. VM0047), so each PDD section is sent only the clauses that
+    concern it, with their clause numbers and pages.
+
+    The index, including the clause text, is persisted in the rulebook folder
+    and rebuilt when a rulebook is added, removed or changed (by content hash).
+    """
+
+    def __init__(self, folder_path, clauses, postings, avg_length, files):
+        chunks = [[clause["file"], clause["pages"][0], 0, 0, clause["length"]] for clause in clauses]
+        super().__init__(folder_path, chunks, postings, avg_length)
+        self.clauses = clauses
+        self.files = files  # {filename: sha256} the index was built from
+
+    @staticmethod
+    def rulebook_files(folder_path):
+        """{filename: sha256} of the rulebooks in a folder."""
+        if not os.path.isdir(folder_path):
+            return {}
+        return {f: file_sha256(os.path.join(folder_path, f)) for f in sorted(os.listdir(folder_path))
+                if f.lower().endswith(('.pdf', '.docx')) and not f.startswith('~$')}
+
+    def is_current(self):
+        return self.files == self.rulebook_files(self.folder_path)
+
+    @classmethod
+    def build(cls, folder_path):
+        """Loads the persisted rulebook index, rebuilding it if any rulebook changed."""
+        files = cls.rulebook_files(folder_path)
+        index_path = os.path.join(folder_path, RULEBOOK_INDEX_FILENAME)
+        try:
+            with open(index_path, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+            if saved.get("files") == files and saved.get("version") == RULEBOOK_INDEX_VERSION:
+                return cls(folder_path, saved["clauses"], saved["postings"], saved["avg_length"], files)
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            pass
+        if not files:
+            return cls(folder_path, [], {}, 0.0, files)
+
+        print(f"Indexing rulebooks: {', '.join(files)}...")
+        clauses, postings = [], {}
+        for filename in files:
+            with span("rulebook.index", file=filename) as s:
+                file_clauses = split_clauses(extract_pages(os.path.join(folder_path, filename)))
+                s["clauses"] = len(file_clauses)
+            for clause in file_clauses:
+                terms = tokenize(f"{clause['parents']} {clause['title']} {clause['text']}")
+                clause_id = len(clauses)
+                clauses.append({"file": filename, "length": len(terms), **clause})
+                for term, frequency in Counter(terms).items():
+                    postings.setdefault(term, []).append([clause_id, frequency])
+        avg_length = sum(clause["length"] for clause in clauses) / len(clauses) if clauses else 0.0
+
+        tmp_path = index_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"version": RULEBOOK_INDEX_VERSION, "files": files, "clauses": clauses,
+                       "postings": postings, "avg_length": avg_length}, f)
+        os.replace(tmp_path, index_path)
+        print(f"...indexed {len(clauses)} clauses.")
+        return cls(folder_path, clauses, postings, avg_length, files)
+
+    def chunk_text(self, chunk_id):
+        return self.clauses[chunk_id]["text"]
+
+    def select(self, query, top_k=6, token_budget=2000, filenames=None, title=None, min_score=0.0):
+        """
+        Picks the clauses most relevant to a query, up to top_k clauses and
+        token_budget estimated tokens. Clauses whose own or parent titles
+        contain the terms of title rank higher; clauses under min_score, or well below the best
+        match (RELEVANCE_RATIO), are left out.
+
+        Returns:
+            list: dicts with file, number, title, parents, pages, score,
+                  tokens and text, in score order.
+        """
+        title_terms = set(tokenize(title or ""))
+        ranked = []
+        for clause_id, score in self.search(query, filenames):
+            if title_terms:
+                clause = self.clauses[clause_id]
+                clause_terms = set(tokenize(f"{clause['parents']} {clause['title']}"))
+                score += TITLE_WEIGHT * len(clause_terms & title_terms) / len(title_terms)
+            ranked.append((clause_id, score))
+        ranked.sort(key=lambda item: (-item[1], item[0]))
+
+        selected, used = [], 0
+        for clause_id, score in ranked:
+            if len(selected) >= top_k or score < max(min_score, ranked[0][1] * RELEVANCE_RATIO):
+                break
+            clause = self.clauses[clause_id]
+            tokens = estimate_tokens(clause["text"])
+            if used + tokens > token_budget:
+                continue
+            selected.append({**{k: clause[k] for k in ("file", "number", "title", "parents", "pages", "text")},
+                             "score": round(score, 3), "tokens": tokens})
+            used += tokens
+        return selected
+
+    def context_for_section(self, section_name, query, top_k=6, token_budget=2000, filenames=None, min_score=0.0):
+        """The clauses relevant to one PDD section, formatted for the prompt ("" if none)."""
+        with span("rulebook.retrieval", section=section_name) as s:
+            selected = self.select(query, top_k, token_budget, filenames, title=section_name, min_score=min_score)
+            s["clauses"] = len(selected)
+            s["context_tokens"] = sum(clause["tokens"] for clause in selected)
+        if selected:
+            print(f"  > Rulebook: {', '.join(clause['number'] for clause in selected)} "
+                  f"(~{sum(clause['tokens'] for clause in selected)} tokens)")
+        return format_clauses(selected)
+
+
+def format_clauses(selected):
+    """Formats selected clauses with their rulebook, clause number and pages."""
+    blocks = []
+    for clause in selected:
+        first, last = clause["pages"]
+        pages = f"page {first}" if first == last else f"pages {first}-{last}"
+        parents = f" ({clause['parents']})" if clause["parents"] else ""
+        blocks.append(f"--- {clause['file']}, {clause['number']} {clause['title']}{parents}, {pages} ---\n{clause['text']}")
+    return "\n\n".join(blocks)
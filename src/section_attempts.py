@@ -0,0 +1,53 @@
+import os
+import json
+import time
+
+ATTEMPTS_FILENAME = "section_attempts.json"
+
+
+class SectionAttempts:
+    """
+    Remembers which documents each section was last generated from, so a
+    SECTION_ATTEMPTED section can be refilled from only the documents added
+    since.
+
+    Stored in the project folder as {section: {"time": ..., "documents":
+    [shard key, ...]}}, using the same content-hash keys as the ContextStore,
+    so renaming a document does not make it look new.
+
+    Args:
+        folder_path (str): The project's document folder.
+        documents (dict): {filename: shard key} of the documents available
+                          now (see ContextStore.documents()).
+    """
+
+    def __init__(self, folder_path, documents):
+        self.path = os.path.join(folder_path, ATTEMPTS_FILENAME)
+        self.documents = documents
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.sections = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.sections = {}
+
+    def new_files_since(self, section):
+        """
+        Filenames of the documents added since the section's last attempt,
+        or None if there is no record of one.
+        """
+        record = self.sections.get(section)
+        if record is None:
+            return None
+        seen = set(record["documents"])
+        return [name for name, key in self.documents.items() if key not in seen]
+
+    def record(self, section):
+        """Records that the section was just generated from the current documents."""
+        self.sections[section] = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "documents": sorted(set(self.documents.values())),
+        }
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.sections, f, indent=4)
+        os.replace(tmp_path, self.path)
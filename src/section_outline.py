@@ -0,0 +1,140 @@
+import os
+import re
+import json
+from context_manifest import file_sha256
+from text_processing import retrieve_contents_list, get_pdd_targets
+from word_editor import load_word_doc_to_string
+from instrumentation import span
+
+OUTLINE_CACHE_FILENAME = ".template_outline.json"
+OUTLINE_VERSION = 2
+# The heading after the last target section. Adjust if your template differs.
+FINAL_END_MARKER = "Appendix"
+
+
+def _line_offsets(text):
+    """Maps each distinct stripped line to the character offset of its first occurrence."""
+    offsets = {}
+    char_count = 0
+    for line in text.splitlines():
+        stripped = line.strip()
+        if stripped and stripped not in offsets:
+            offsets[stripped] = char_count + line.find(stripped)
+        char_count += len(line) + 1  # +1 for the newline character
+    return offsets
+
+
+def _end_marker(pdd_targets, i):
+    """The paragraph that ends section i in DocumentSession.replace_section()."""
+    return pdd_targets[i + 1][1] if i + 1 < len(pdd_targets) else FINAL_END_MARKER
+
+
+def _final_end(text, start):
+    """Offset of the first FINAL_END_MARKER line after start, or len(text)."""
+    match = re.compile(rf"^[ \t]*{re.escape(FINAL_END_MARKER)}[ \t]*$", re.M).search(text, start + 1)
+    return match.start() if match else len(text)
+
+
+def build_outline(text, pdd_targets):
+    """
+    Locates every target section in a document's text in a single pass.
+
+    A section starts where find_target_location() would find it (the first
+    line consisting only of the subheading, falling back to the first
+    occurrence of the subheading anywhere) and runs to the start of the next
+    target. The last one runs to the first FINAL_END_MARKER line after it,
+    or to the end of the text, so every section covers the same range that
+    DocumentSession.replace_section() overwrites.
+
+    Args:
+        text (str): Document text, as from load_word_doc_to_string().
+        pdd_targets (list): Targets from get_pdd_targets().
+
+    Returns:
+        list: One dict per target, in order, with keys "target", "start",
+              "end", "end_marker" (the paragraph that ends the section in
+              the document), "status" (the section's status line, or "" if
+              it has none) and "body" (the section's text).
+    """
+    offsets = _line_offsets(text)
+    starts = []
+    for target in pdd_targets:
+        start = offsets.get(target[1])
+        starts.append(start if start is not None else text.find(target[1]))
+
+    outline = []
+    for i, target in enumerate(pdd_targets):
+        start = starts[i]
+        if i + 1 < len(starts) and starts[i + 1] != -1:
+            end = starts[i + 1]
+        else:
+            end = _final_end(text, start)
+        body = text[start:end]
+        lines = body.split("\n")
+        outline.append({
+            "target": target,
+            "start": start,
+            "end": end,
+            "end_marker": _end_marker(pdd_targets, i),
+            "status": lines[2] if len(lines) > 2 else "",
+            "body": body,
+        })
+    return outline
+
+
+def _find_template(template_folder):
+    for f in sorted(os.listdir(template_folder)):
+        if f.lower().endswith('.docx') and not f.startswith('~$'):
+            return os.path.join(template_folder, f)
+    raise FileNotFoundError(f"Error: No .docx template found in '{template_folder}'")
+
+
+def load_template_outline(template_folder="pdd_template"):
+    """
+    Returns the template's targets and section outline.
+
+    The parsed outline is cached next to the template, keyed by the SHA-256
+    of the template .docx, so an unchanged template is not opened with
+    python-docx again.
+
+    Returns:
+        tuple: (pdd_targets, outline) as from get_pdd_targets() and build_outline().
+    """
+    template_path = _find_template(template_folder)
+    template_hash = file_sha256(template_path)
+    cache_path = os.path.join(template_folder, OUTLINE_CACHE_FILENAME)
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+        if cached.get("sha256") == template_hash and cached.get("version") == OUTLINE_VERSION:
+            template_text = cached["text"]
+            pdd_targets = [tuple(target) for target in cached["targets"]]
+            outline = []
+            for i, (target, (start, end, status)) in enumerate(zip(pdd_targets, cached["sections"])):
+                outline.append({"target": target, "start": start, "end": end,
+                                "end_marker": _end_marker(pdd_targets, i), "status": status,
+                                "body": template_text[start:end]})
+            return pdd_targets, outline
+    except (FileNotFoundError, json.JSONDecodeError, KeyError, ValueError):
+        pass
+
+    print("Parsing template outline...")
+    with span("template.outline", file=os.path.basename(template_path)):
+        template_text = load_word_doc_to_string(template_path)
+        pdd_targets = get_pdd_targets(retrieve_contents_list(template_text))
+        outline = build_outline(template_text, pdd_targets)
+    if template_text.startswith("Error"):
+        # load_word_doc_to_string() reports failures as text; don't cache them.
+        return pdd_targets, outline
+
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({
+            "sha256": template_hash,
+            "version": OUTLINE_VERSION,
+            "text": template_text,
+            "targets": pdd_targets,
+            "sections": [[section["start"], section["end"], section["status"]] for section in outline],
+        }, f)
+    os.replace(tmp_path, cache_path)
+    return pdd_targets, outline
@@ -1,3 +1,7 @@
+from response_parser import validate_response, pack_sections
+from instrumentation import span
+
+
 
 
 def retrieve_contents_list(template_text: str) -> str:
@@ -37,34 +41,124 @@ def find_target_location(target,template_text):
 
 
 def cleanup_response(response):
-    revised_response = None
-    # Cleaning tables...
-    lines_containing_table = [0]*len(response.split("\n"))
-    lines_which_are_empty = [1]*len(response.split("\n"))
-    for line in response.split("\n"):
-        if "|" in line:
-            lines_containing_table[response.split("\n").index(line)] = 1
-        else:
-            if line.strip():
-                lines_which_are_empty[response.split("\n").index(line)] = 0
-
-    # If the line before or after a table is not empty, delete it
-    for i in range(1, len(response.split("\n")) - 1):
-        if (not lines_which_are_empty[i]) and ((lines_containing_table[i + 1]) or (lines_containing_table[i - 1])):
-            revised_response = response.replace(response.split("\n")[i], "")
-
-
-    revised_response = response.replace(f"`", "")
-    return revised_response
-
-    return response
-
-
-def assemble_user_prompt(infilling_info):
+    # Strip code formatting, and separate tables from the text around them
+    # with a blank line (otherwise Markdown reads a table as part of the
+    # paragraph before it). One pass over the lines.
+    with span("cleanup", chars=len(response)):
+        cleaned = []
+        previous_is_table = False
+        for line in response.replace("`", "").split("\n"):
+            is_table = "|" in line
+            if cleaned and cleaned[-1].strip() and line.strip() and is_table != previous_is_table:
+                cleaned.append("")
+            cleaned.append(line)
+            previous_is_table = is_table
+        return "\n".join(cleaned)
+
+
+def _source_blocks(context_text=None, rulebook_text=None):
+    # When retrieval is used, the relevant document excerpts travel inline
+    # instead of as an uploaded file. Methodology clauses (see rulebook_index.py)
+    # are requirements to follow, not project facts, so they get their own heading.
+    sources = []
+    if context_text:
+        sources.append(f"PROVIDED DOCUMENT EXCERPTS:\n{context_text}")
+    if rulebook_text:
+        sources.append(f"METHODOLOGY REQUIREMENTS (rulebook clauses the section must comply with; not project information):\n{rulebook_text}")
+    return sources
+
+def assemble_user_prompt(infilling_info, context_text=None, rulebook_text=None):
     # User prompt contains the exact information source from the TEMPLATE.
     user_prompt = infilling_info.strip()
+    sources = _source_blocks(context_text, rulebook_text)
+    if sources:
+        user_prompt = "\n\n".join(sources) + f"\n\nTEMPLATE TO FILL:\n{user_prompt}"
     return user_prompt
 
+def assemble_packed_prompt(infilling_infos, context_text=None, rulebook_text=None):
+    # Several small template sections in one request, each between numbered
+    # delimiters that must come back around its filled version, so the
+    # response can be split per section (see split_packed_response()).
+    instructions = (f"The template below has {len(infilling_infos)} separate sections. Fill in each one on its own. "
+                    "Return every filled section between the same <<<SECTION n>>> and <<<END SECTION n>>> lines "
+                    "as in the template, in the same order, with nothing outside them.")
+    return assemble_user_prompt(f"{instructions}\n\n{pack_sections(infilling_infos)}", context_text, rulebook_text)
+
+def assemble_schema_prompt(sections, context_text=None, rulebook_text=None):
+    # Asks only for the values of the fields compiled from one or more template
+    # sections (see field_schema.py), numbered across all of them; the
+    # sections are rendered locally from the answers.
+    # sections: (infilling_info, schema) tuples.
+    field_lines, templates, number = [], [], 0
+    for infilling_info, schema in sections:
+        heading = infilling_info.strip().split("\n", 1)[0]
+        field_lines.append(f"Section \"{heading}\":")
+        for field in schema["fields"]:
+            number += 1
+            if field["kind"] == "text":
+                field_lines.append(f"{number}. Free text answering: {field['label']}")
+            elif field["kind"] == "cell":
+                field_lines.append(f"{number}. {field['label']} (table cell)")
+            else:
+                field_lines.append(f"{number}. {field['label']} (in: \"{schema['body'][field['line']].strip()}\")")
+        templates.append(infilling_info.strip())
+    field_list = "\n".join(field_lines)
+    user_prompt = f"""Give the value of each numbered field below, as found in the provided documents.
+Respond with one answer per field, in order, in the form "<number>: <value>", using "<number>: INFO_NOT_FOUND" where the documents do not contain it, and no other text.
+Table cells and other values go on a single line; a free text answer may take several lines.
+
+FIELDS TO ANSWER:
+{field_list}
+
+THE TEMPLATE, FOR CONTEXT:
+""" + "\n\n".join(templates)
+    return "\n\n".join(_source_blocks(context_text, rulebook_text) + [user_prompt])
+
+def assemble_row_repair_prompt(infilling_info, rows, context_text=None, rulebook_text=None):
+    # Asks only for the malformed table rows of an otherwise valid response.
+    # rows: (line_number, header_cells, raw_line) tuples from malformed_rows().
+    row_list = "\n".join(f"Columns: | {' | '.join(header)} |\nRow: {raw_line}" for _, header, raw_line in rows)
+    user_prompt = f"""The following table rows from your filled template do not have the right number of cells.
+Rewrite each row as a single Markdown table row with exactly one cell per column, in the same order.
+Respond with ONLY the {len(rows)} corrected row(s), one per line, and no other text.
+
+{row_list}
+
+The template section these rows belong to:
+{infilling_info.strip()}"""
+    return "\n\n".join(_source_blocks(context_text, rulebook_text) + [user_prompt])
+
+def assemble_field_refill_prompt(section_text, fields, context_text=None, rulebook_text=None):
+    # Asks only for the fields of an already filled section that were not found before.
+    field_list = "\n".join(f"{i}. {field}" for i, field in enumerate(fields, start=1))
+    user_prompt = f"""The section below was filled in from earlier documents, but these fields were not found:
+{field_list}
+
+New documents have been provided since. For each numbered field, give its value as found in the provided document excerpts.
+Respond with exactly one line per field in the form "<number>: <value>", using "<number>: INFO_NOT_FOUND" where the excerpts do not contain it, and no other text.
+
+THE SECTION, FOR CONTEXT:
+{section_text.strip()}"""
+    return "\n\n".join(_source_blocks(context_text, rulebook_text) + [user_prompt])
+
+def assemble_field_refill_system_prompt():
+    return """You are a document analysis assistant completing missing fields of a project template with information from provided documents.
+
+- Only use information explicitly stated in the provided document excerpts; never infer, assume, calculate or use general knowledge.
+- Copy values exactly as written, without rounding, converting units or rephrasing.
+- Keep each value on a single line, and do not use the "|" character.
+- If a field is not explicitly stated in the excerpts, answer INFO_NOT_FOUND for it.
+- Respond with only the numbered answers, with no explanations or commentary."""
+
+def assemble_schema_system_prompt():
+    return """You are a document analysis assistant extracting the values of numbered template fields from provided documents.
+
+- Only use information explicitly stated in the provided documents; never infer, assume, calculate or use general knowledge.
+- Copy values exactly as written, without rounding, converting units or rephrasing.
+- Free text answers must contain only what the documents say about the instruction they answer.
+- If a field is not explicitly stated in the documents, answer INFO_NOT_FOUND for it.
+- Respond with only the numbered answers, with no explanations or commentary."""
+
 def assemble_system_prompt():
 
     system_prompt = """You are a document analysis assistant filling out a project template with information from provided documents.
@@ -183,6 +277,6 @@ OUTPUT CONSTRAINTS:
     return system_prompt
 
 def is_valid_response(response, infilling_info):
-    # For now make no checks
-    return True
+    # Structural checks against the template section (tables, headers, row widths)
+    return not validate_response(cleanup_response(response), infilling_info)
 
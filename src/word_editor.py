@@ -1,10 +1,18 @@
-import docx
 import os
 import shutil
-import pypandoc
 import tempfile
-from docx.oxml.text.paragraph import CT_P
-from docx.oxml.table import CT_Tbl
+from itertools import zip_longest
+from lazy_import import lazy_import
+from response_parser import parse_markdown_blocks, MISSING_FIELD_RE
+from instrumentation import span
+
+docx = lazy_import("docx")
+
+# How section content is turned into Word elements: "native" builds OOXML
+# directly from the parsed Markdown; "pandoc" converts through a temporary
+# .docx (slower, needs pandoc installed). Both give the same result; see
+# compare_renderers().
+DEFAULT_RENDERER = "native"
 
 # --- HELPER FUNCTIONS (UNCHANGED and WORKING) ---
 def _iter_block_items(parent):
@@ -16,9 +24,9 @@ def _iter_block_items(parent):
         raise ValueError("Parent must be a Document or _Cell object")
     
     for child in parent_elm.iterchildren():
-        if isinstance(child, CT_P):
+        if isinstance(child, docx.oxml.text.paragraph.CT_P):
             yield docx.text.paragraph.Paragraph(child, parent)
-        elif isinstance(child, CT_Tbl):
+        elif isinstance(child, docx.oxml.table.CT_Tbl):
             yield docx.table.Table(child, parent)
 
 def load_word_doc_to_string(folder_path):
@@ -77,8 +85,12 @@ def _insert_content_from_document(source_doc, target_doc, anchor_element):
     """
     Reads elements from the source_doc and intelligently recreates them in the
     target_doc after the anchor_element, preserving formatting.
+
+    Returns:
+        list: The inserted elements, in document order.
     """
     cursor = anchor_element # This is the last known element in the target document
+    inserted = []
 
     # Iterate through each block (paragraph or table) in the source document
     for block in _iter_block_items(source_doc):
@@ -87,6 +99,7 @@ def _insert_content_from_document(source_doc, target_doc, anchor_element):
             new_p = target_doc.add_paragraph(text=block.text, style=block.style)
             cursor.addnext(new_p._element)
             cursor = new_p._element # Move the cursor
+            inserted.append(cursor)
         
         elif isinstance(block, docx.table.Table):
             # It's a table - recreate it cell by cell
@@ -104,75 +117,352 @@ def _insert_content_from_document(source_doc, target_doc, anchor_element):
             
             cursor.addnext(new_table._element)
             cursor = new_table._element # Move the cursor
+            inserted.append(cursor)
 
+    return inserted
 
-# --- FINAL MAIN FUNCTION ---
-def replace_section_in_word_doc(doc_path, start_marker, end_marker, new_content_str):
+
+# --- NATIVE MARKDOWN RENDERING ---
+# Paragraph styles are the ones the Pandoc path ends up with: Pandoc's docx
+# writer styles a paragraph "First Paragraph" unless it directly follows a
+# paragraph or table, tight list items "Compact", loose ones "Normal".
+_PARAGRAPH_STYLES = {"quote": "BlockText", "code": "SourceCode", "rule": "Normal"}
+_TABLE_STYLE = "Table"
+
+
+def _new_paragraph(text, style_id):
+    # Same XML as target_doc.add_paragraph(text, style) produces.
+    p = docx.oxml.OxmlElement('w:p')
+    if text:
+        p.add_r().text = text
+    if style_id:
+        p.style = style_id
+    return p
+
+
+def _new_table(rows, width):
+    # Same XML as target_doc.add_table() followed by setting each cell's text,
+    # but filled row by row instead of through per-cell lookups.
+    tbl = docx.oxml.table.CT_Tbl.new_tbl(len(rows), len(rows[0]), width)
+    tbl.tblStyle_val = _TABLE_STYLE
+    for tr, row in zip(tbl.tr_lst, rows):
+        for tc, text in zip(tr.tc_lst, row):
+            tc.clear_content()
+            tc.add_p().add_r().text = text
+    return tbl
+
+
+def _render_markdown_blocks(markdown, block_width):
+    """Turns Markdown into a list of new w:p / w:tbl elements."""
+    elements = []
+    previous = None
+    for block in parse_markdown_blocks(markdown):
+        kind = block["type"]
+        if kind == "table":
+            if not block["rows"] or not block["rows"][0]:
+                continue
+            if previous == "table":
+                # Pandoc separates adjacent tables with an empty paragraph
+                elements.append(_new_paragraph("", "Normal"))
+            elements.append(_new_table(block["rows"], block_width))
+        elif kind == "heading":
+            elements.append(_new_paragraph(block["text"], f"Heading{block['level']}"))
+        elif kind == "paragraph":
+            style_id = "BodyText" if previous in ("paragraph", "table") else "FirstParagraph"
+            elements.append(_new_paragraph(block["text"], style_id))
+        elif kind == "list_item":
+            elements.append(_new_paragraph(block["text"], "Normal" if block["loose"] else "Compact"))
+        else:
+            elements.append(_new_paragraph(block.get("text", ""), _PARAGRAPH_STYLES[kind]))
+        previous = kind
+    return elements
+
+
+def _insert_markdown_content(target_doc, anchor_element, markdown):
     """
-    Uses Pandoc to create a temporary, perfectly-formatted doc, then performs a
-    high-level copy of its contents into the main document.
+    Renders Markdown straight into target_doc after anchor_element, with no
+    subprocess or temporary file.
+
+    Returns:
+        list: The inserted elements, in document order.
     """
+    cursor = anchor_element
+    inserted = _render_markdown_blocks(markdown, target_doc._block_width)
+    for element in inserted:
+        cursor.addnext(element)
+        cursor = element
+    return inserted
+
+
+def _insert_markdown_with_pandoc(target_doc, anchor_element, markdown):
+    """
+    Renders Markdown with Pandoc into a temporary .docx and copies its
+    content into target_doc after anchor_element.
+
+    Returns:
+        list: The inserted elements, in document order.
+    """
+    import pypandoc
+
     temp_file_handle, temp_docx_path = tempfile.mkstemp(suffix=".docx")
     os.close(temp_file_handle)
-
     try:
-        # STEP 1: Parse the incoming AI response
-        lines = new_content_str.strip().split('\n')
-        status_line = lines[0] if lines else "SECTION_ATTEMPTED"
-        markdown_content = "\n".join(lines[2:])
-
-        # STEP 2: Use Pandoc to create a physical temporary DOCX file
-        pypandoc.convert_text(markdown_content, 'docx', format='md', outputfile=temp_docx_path)
-        
-        # STEP 3: Open both the main doc and the perfect temporary doc
+        pypandoc.convert_text(markdown, 'docx', format='md', outputfile=temp_docx_path)
         temp_doc = docx.Document(temp_docx_path)
-        main_doc = docx.Document(doc_path)
-        
-        blocks = list(_iter_block_items(main_doc))
-
-        start_index, end_index = -1, -1
-        for i, block in enumerate(blocks):
-            if isinstance(block, docx.text.paragraph.Paragraph) and block.text.strip() == start_marker:
-                start_index = i
-            elif start_index != -1 and isinstance(block, docx.text.paragraph.Paragraph) and block.text.strip() == end_marker:
-                end_index = i
-                break
-        
-        if start_index == -1:
-            print(f"Warning: Start marker '{start_marker}' not found. Cannot update.")
-            return
+        return _insert_content_from_document(temp_doc, target_doc, anchor_element)
+    finally:
+        # Always clean up the temporary file
+        if os.path.exists(temp_docx_path):
+            os.remove(temp_docx_path)
 
-        if end_index == -1:
-            end_index = len(blocks)
-        
-        # STEP 4: Delete all old content to create a clean slate
-        if end_index > start_index + 1:
-            for i in range(end_index - 1, start_index, -1):
-                _delete_element(blocks[i])
 
-        # STEP 5: Perform the new, robust, high-level copy
-        anchor = blocks[start_index]._element
-        
-        status_p = main_doc.add_paragraph(status_line)
-        anchor.addnext(status_p._element)
-        anchor_for_copy = status_p._element
-
-        _insert_content_from_document(temp_doc, main_doc, anchor_for_copy)
-
-        main_doc.save(doc_path)
-        print(f"Successfully updated section '{start_marker}' in {os.path.basename(doc_path)}.")
-
-    except ImportError:
-        # Error handling remains the same
-        print("\nFATAL ERROR: pypandoc is not installed...")
-        exit()
-    except OSError as e:
-        print(f"\nFATAL ERROR: Pandoc application not found or failed. Error: {e}")
-        exit()
-    except Exception as e:
-        print(f"FATAL ERROR during document generation for '{start_marker}': {e}")
+_RENDERERS = {"native": _insert_markdown_content, "pandoc": _insert_markdown_with_pandoc}
 
-    finally:
-        # STEP 6: Always clean up the temporary file
-        if os.path.exists(temp_docx_path):
-            os.remove(temp_docx_path)
\ No newline at end of file
+
+def compare_renderers(markdown, doc_path):
+    """
+    Renders the same Markdown through the Pandoc and native paths into the
+    document at doc_path (in memory only) and reports where they differ.
+
+    Returns:
+        list: (block_index, pandoc_xml, native_xml) for every differing block.
+              Empty if both renderers produced identical OOXML.
+    """
+    rendered = []
+    for renderer in ("pandoc", "native"):
+        document = docx.Document(doc_path)
+        anchor = document.add_paragraph()._element
+        rendered.append([element.xml for element in _RENDERERS[renderer](document, anchor, markdown)])
+    return [
+        (i, pandoc_xml, native_xml)
+        for i, (pandoc_xml, native_xml) in enumerate(zip_longest(*rendered))
+        if pandoc_xml != native_xml
+    ]
+
+
+# --- DOCUMENT SESSION ---
+class DocumentSession:
+    """
+    Keeps the output document open in memory so many sections can be
+    replaced with a single parse and a single save.
+
+    The session indexes every body paragraph by its stripped text once, when
+    the document is loaded, and keeps that index up to date as sections are
+    deleted and inserted. Finding a section's start/end markers is then a
+    dictionary lookup for the candidate paragraphs, plus one body.index()
+    per candidate (usually one or two) to order them: still linear in the
+    document's length, but a cheap scan of element references instead of
+    building the text of every paragraph.
+
+    Usage:
+        with DocumentSession(output_path, checkpoint_every=10) as session:
+            session.replace_section(start_marker, end_marker, response)
+        # The document is saved once on exit (and every checkpoint_every
+        # replacements, for crash safety).
+
+    Args:
+        doc_path (str): Path of the .docx to edit in place.
+        checkpoint_every (int): Save to disk after this many replacements.
+                                0 saves only on save()/exit.
+        renderer (str): "native" or "pandoc" (see DEFAULT_RENDERER).
+    """
+
+    def __init__(self, doc_path, checkpoint_every=0, renderer=DEFAULT_RENDERER):
+        self.doc_path = doc_path
+        self.checkpoint_every = checkpoint_every
+        self.renderer = renderer
+        self.document = docx.Document(doc_path)
+        self._body = self.document.element.body
+        self._unsaved = 0
+        self._index = {}
+        for child in self._body.iterchildren():
+            if isinstance(child, docx.oxml.text.paragraph.CT_P):
+                self._add_to_index(child)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self._unsaved:
+            self.save()
+
+    def _text(self, element):
+        return docx.text.paragraph.Paragraph(element, self.document._body).text.strip()
+
+    def _add_to_index(self, element):
+        self._index.setdefault(self._text(element), []).append(element)
+
+    def _remove_from_index(self, element):
+        entries = self._index.get(self._text(element))
+        if entries and element in entries:
+            entries.remove(element)
+
+    def _find_section(self, start_marker, end_marker):
+        """
+        Locates a section the same way the block scan always did: the end is
+        the first end_marker paragraph after the first start_marker paragraph,
+        and the start is the last start_marker paragraph before that end.
+        Each candidate's position costs one O(n) body.index().
+
+        Returns:
+            tuple: (start_element, end_element). end_element is None if the
+                   section runs to the end of the document; start_element is
+                   None if the start marker does not exist.
+        """
+        starts = sorted((self._body.index(el), el) for el in self._index.get(start_marker, []))
+        if not starts:
+            return None, None
+        first_start = starts[0][0]
+        ends = [(self._body.index(el), el) for el in self._index.get(end_marker, [])]
+        ends = [(position, el) for position, el in ends if position > first_start]
+        if not ends:
+            return starts[-1][1], None
+        end_position, end_element = min(ends, key=lambda item: item[0])
+        start_element = [el for position, el in starts if position < end_position][-1]
+        return start_element, end_element
+
+    def replace_section(self, start_marker, end_marker, new_content_str):
+        """
+        Replaces the content between start_marker and end_marker (both kept)
+        with a status line and the rendered Markdown of new_content_str.
+
+        Returns:
+            bool: True if the section was found and replaced.
+        """
+        with span("docx.replace_section", section=start_marker, renderer=self.renderer):
+            try:
+                # STEP 1: Parse the incoming AI response
+                lines = new_content_str.strip().split('\n')
+                status_line = lines[0] if lines else "SECTION_ATTEMPTED"
+                markdown_content = "\n".join(lines[2:])
+
+                # STEP 2: Find the section through the paragraph index
+                start_element, end_element = self._find_section(start_marker, end_marker)
+                if start_element is None:
+                    print(f"Warning: Start marker '{start_marker}' not found. Cannot update.")
+                    return False
+
+                # STEP 3: Insert the status line, then the rendered content after it.
+                # Rendering happens before anything is deleted, so a failure leaves
+                # the old section content in place.
+                status_p = self.document.add_paragraph(status_line)
+                start_element.addnext(status_p._element)
+                try:
+                    inserted = _RENDERERS[self.renderer](self.document, status_p._element, markdown_content)
+                except Exception:
+                    self._body.remove(status_p._element)
+                    raise
+                self._add_to_index(status_p._element)
+                for element in inserted:
+                    if isinstance(element, docx.oxml.text.paragraph.CT_P):
+                        self._add_to_index(element)
+
+                # STEP 4: Delete all old content between the new content and the end marker
+                element = (inserted[-1] if inserted else status_p._element).getnext()
+                while element is not None and element is not end_element:
+                    next_element = element.getnext()
+                    if isinstance(element, docx.oxml.text.paragraph.CT_P):
+                        self._remove_from_index(element)
+                        self._body.remove(element)
+                    elif isinstance(element, docx.oxml.table.CT_Tbl):
+                        self._body.remove(element)
+                    element = next_element
+
+                self._unsaved += 1
+                print(f"Successfully updated section '{start_marker}' in {os.path.basename(self.doc_path)}.")
+                if self.checkpoint_every and self._unsaved >= self.checkpoint_every:
+                    self.save()
+                return True
+
+            except ImportError:
+                # Error handling remains the same
+                print("\nFATAL ERROR: pypandoc is not installed...")
+                exit()
+            except OSError as e:
+                print(f"\nFATAL ERROR: Pandoc application not found or failed. Error: {e}")
+                exit()
+            except Exception as e:
+                print(f"FATAL ERROR during document generation for '{start_marker}': {e}")
+                return False
+
+    def patch_fields(self, start_marker, end_marker, answers):
+        """
+        Replaces INFO_NOT_FOUND fields of a section in place, leaving the
+        rest of its content (and formatting) untouched. The status line
+        becomes SECTION_COMPLETE once no INFO_NOT_FOUND field is left.
+
+        Args:
+            answers (dict): {field: value}, where field is the "<information>"
+                            part of "INFO_NOT_FOUND: <information>".
+
+        Returns:
+            tuple: (patched, left): the number of fields replaced and the
+                   number of INFO_NOT_FOUND fields still in the section, or
+                   (-1, -1) if the section was not found.
+        """
+        with span("docx.patch_fields", section=start_marker, fields=len(answers)):
+            start_element, end_element = self._find_section(start_marker, end_marker)
+            if start_element is None:
+                print(f"Warning: Start marker '{start_marker}' not found. Cannot update.")
+                return -1, -1
+
+            patched = 0
+
+            def replace_field(match):
+                nonlocal patched
+                value = answers.get(match.group(1).strip())
+                if value is None:
+                    return match.group(0)
+                patched += 1
+                return value
+
+            left = 0
+            element = start_element.getnext()
+            while element is not None and element is not end_element:
+                top_level = isinstance(element, docx.oxml.text.paragraph.CT_P)
+                for p in ([element] if top_level else element.iter(docx.oxml.ns.qn('w:p'))):
+                    paragraph = docx.text.paragraph.Paragraph(p, self.document._body)
+                    if "INFO_NOT_FOUND" not in paragraph.text:
+                        continue
+                    if top_level:
+                        self._remove_from_index(p)
+                    for run in paragraph.runs:
+                        run.text = MISSING_FIELD_RE.sub(replace_field, run.text)
+                    if any(field.strip() in answers for field in MISSING_FIELD_RE.findall(paragraph.text)):
+                        # A field split across runs: rewrite the paragraph as a single run
+                        paragraph.text = MISSING_FIELD_RE.sub(replace_field, paragraph.text)
+                    left += paragraph.text.count("INFO_NOT_FOUND")
+                    if top_level:
+                        self._add_to_index(p)
+                element = element.getnext()
+
+            # Update the status line written by replace_section()
+            status_element = start_element.getnext()
+            if patched and not left and isinstance(status_element, docx.oxml.text.paragraph.CT_P):
+                status = docx.text.paragraph.Paragraph(status_element, self.document._body)
+                if status.text.startswith("SECTION_ATTEMPTED"):
+                    self._remove_from_index(status_element)
+                    status.text = "SECTION_COMPLETE"
+                    self._add_to_index(status_element)
+
+            if patched:
+                self._unsaved += 1
+                print(f"Successfully patched {patched} field(s) in section '{start_marker}' in {os.path.basename(self.doc_path)}.")
+                if self.checkpoint_every and self._unsaved >= self.checkpoint_every:
+                    self.save()
+            return patched, left
+
+    def save(self):
+        with span("docx.save"):
+            self.document.save(self.doc_path)
+        self._unsaved = 0
+
+
+# --- FINAL MAIN FUNCTION ---
+def replace_section_in_word_doc(doc_path, start_marker, end_marker, new_content_str):
+    """
+    Replaces one section of a document on disk. Loads and saves the whole
+    document; use a DocumentSession to apply many sections in one pass.
+    """
+    with DocumentSession(doc_path) as session:
+        session.replace_section(start_marker, end_marker, new_content_str)